@@ -11,6 +11,7 @@ from gobcore.model.sa.management import Base
 
 sys.path.append('.')
 from gobworkflow.config import GOB_MGMT_DB
+import gobworkflow.storage.tables  # noqa: F401, register the workflow tables in Base.metadata
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -34,7 +35,12 @@ target_metadata = Base.metadata
 
 def include_object(object, name, type_, reflected, compare_to):
     skip_objects = [
-        'spatial_ref_sys'
+        'spatial_ref_sys',
+        # Created by migrations on tables of the management model, the model does not declare them
+        'uq_service_tasks_service_id_name',
+        'ix_tasks_queued',
+        'ix_tasks_queued_start',
+        'ix_tasks_stepid_name',
     ]
 
     return not name in skip_objects
@@ -0,0 +1,40 @@
+"""log counts
+
+The counts are initialised from the logs that are in the logs table.
+Logs that have already been archived are not counted.
+
+Revision ID: 3b7f2a91c4d8
+Revises: f74c5e6ff1a3
+Create Date: 2026-10-18 12:21:05.804412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b7f2a91c4d8'
+down_revision = 'f74c5e6ff1a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('log_counts',
+    sa.Column('jobid', sa.Integer(), nullable=False),
+    sa.Column('stepid', sa.Integer(), nullable=False),
+    sa.Column('level', sa.String(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('jobid', 'stepid', 'level')
+    )
+    op.execute("""
+INSERT INTO log_counts (jobid, stepid, level, count)
+SELECT jobid, stepid, level, count(*)
+FROM   logs
+WHERE  jobid IS NOT NULL AND stepid IS NOT NULL AND level IS NOT NULL
+GROUP BY jobid, stepid, level
+""")
+
+
+def downgrade():
+    op.drop_table('log_counts')
@@ -0,0 +1,36 @@
+"""service tasks unique
+
+Service tasks are identified by their service and name.
+
+Duplicate tasks (the most recent is kept) and tasks without a service are deleted before the constraint is added.
+The index of the constraint serves lookups on service_id, no separate index on service_id is created.
+
+Revision ID: 8a4c1e7d2b90
+Revises: 3b7f2a91c4d8
+Create Date: 2026-10-18 13:42:16.380957
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4c1e7d2b90'
+down_revision = '3b7f2a91c4d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("DELETE FROM service_tasks WHERE service_id IS NULL")
+    op.execute("""
+DELETE FROM service_tasks
+USING  service_tasks newer
+WHERE  newer.service_id = service_tasks.service_id
+AND    newer.name = service_tasks.name
+AND    newer.id > service_tasks.id
+""")
+    op.create_unique_constraint('uq_service_tasks_service_id_name', 'service_tasks', ['service_id', 'name'])
+
+
+def downgrade():
+    op.drop_constraint('uq_service_tasks_service_id_name', 'service_tasks', type_='unique')
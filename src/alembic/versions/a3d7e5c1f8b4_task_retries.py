@@ -0,0 +1,27 @@
+"""task retries
+
+Revision ID: a3d7e5c1f8b4
+Revises: f1a6c3e9d2b7
+Create Date: 2026-10-18 20:08:51.302664
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3d7e5c1f8b4'
+down_revision = 'f1a6c3e9d2b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('task_scheduling', sa.Column('retries', sa.Integer(), server_default='0', nullable=False))
+    op.create_index('ix_tasks_queued_start', 'tasks', ['key_prefix', 'start'], unique=False,
+                    postgresql_where=sa.text("status = 'queued'"))
+
+
+def downgrade():
+    op.drop_index('ix_tasks_queued_start', table_name='tasks')
+    op.drop_column('task_scheduling', 'retries')
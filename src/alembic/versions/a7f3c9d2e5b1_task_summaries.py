@@ -0,0 +1,47 @@
+"""task summaries
+
+The warnings and errors of the tasks are counted and sampled per jobstep.
+The counts and samples are initialised from the summaries of the tasks that are in the tasks table.
+
+Revision ID: a7f3c9d2e5b1
+Revises: d4b8e2f61a37
+Create Date: 2026-10-18 16:20:41.593127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7f3c9d2e5b1'
+down_revision = 'd4b8e2f61a37'
+branch_labels = None
+depends_on = None
+
+SAMPLE_SIZE = 100
+
+
+def upgrade():
+    for category in ['warnings', 'errors']:
+        op.add_column('task_counts', sa.Column(category, sa.Integer(), nullable=False, server_default='0'))
+        op.add_column('task_counts', sa.Column(f'{category}_sample', sa.JSON(), nullable=False,
+                                               server_default='[]'))
+        op.execute(f"""
+UPDATE task_counts
+SET    {category} = items.count,
+       {category}_sample = items.sample
+FROM  (SELECT tasks.stepid,
+              count(*) AS count,
+              array_to_json((array_agg(item.value))[1:{SAMPLE_SIZE}]) AS sample
+       FROM   tasks,
+              json_array_elements(tasks.summary -> '{category}') AS item
+       WHERE  tasks.status IN ('completed', 'failed')
+       GROUP BY tasks.stepid) AS items
+WHERE  task_counts.stepid = items.stepid
+""")
+
+
+def downgrade():
+    for category in ['warnings', 'errors']:
+        op.drop_column('task_counts', f'{category}_sample')
+        op.drop_column('task_counts', category)
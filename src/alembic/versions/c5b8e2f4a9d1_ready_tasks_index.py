@@ -0,0 +1,25 @@
+"""ready tasks index
+
+The dependencies of a task are looked up by jobstep and name to check whether a task is ready.
+
+Revision ID: c5b8e2f4a9d1
+Revises: a3d7e5c1f8b4
+Create Date: 2026-10-18 21:02:37.518304
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5b8e2f4a9d1'
+down_revision = 'a3d7e5c1f8b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_tasks_stepid_name', 'tasks', ['stepid', 'name'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_tasks_stepid_name', table_name='tasks')
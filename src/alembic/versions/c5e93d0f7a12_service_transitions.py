@@ -0,0 +1,34 @@
+"""service transitions
+
+Revision ID: c5e93d0f7a12
+Revises: 8a4c1e7d2b90
+Create Date: 2026-10-18 14:35:52.117263
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e93d0f7a12'
+down_revision = '8a4c1e7d2b90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('service_transitions',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('host', sa.String(), nullable=True),
+    sa.Column('event', sa.String(), nullable=False),
+    sa.Column('task', sa.String(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_service_transitions_timestamp'), 'service_transitions', ['timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_service_transitions_timestamp'), table_name='service_transitions')
+    op.drop_table('service_transitions')
@@ -0,0 +1,44 @@
+"""task counts
+
+The counts are initialised from the tasks that are in the tasks table.
+
+Revision ID: d4b8e2f61a37
+Revises: c5e93d0f7a12
+Create Date: 2026-10-18 15:42:18.260931
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4b8e2f61a37'
+down_revision = 'c5e93d0f7a12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('task_counts',
+    sa.Column('stepid', sa.Integer(), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=False),
+    sa.Column('completed', sa.Integer(), nullable=False),
+    sa.Column('failed', sa.Integer(), nullable=False),
+    sa.Column('aborted', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('stepid')
+    )
+    op.execute("""
+INSERT INTO task_counts (stepid, total, completed, failed, aborted)
+SELECT stepid,
+       count(*),
+       count(*) FILTER (WHERE status = 'completed'),
+       count(*) FILTER (WHERE status = 'failed'),
+       count(*) FILTER (WHERE status = 'aborted')
+FROM   tasks
+WHERE  stepid IS NOT NULL
+GROUP BY stepid
+""")
+
+
+def downgrade():
+    op.drop_table('task_counts')
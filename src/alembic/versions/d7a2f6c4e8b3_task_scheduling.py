@@ -0,0 +1,33 @@
+"""task scheduling
+
+Scheduling data of the tasks, maintained by the workflow service, with the topological level of each task.
+Every existing task gets a row, their level is NULL because it has not been stored when the task was created.
+
+Revision ID: d7a2f6c4e8b3
+Revises: a7f3c9d2e5b1
+Create Date: 2026-10-18 17:05:26.738412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7a2f6c4e8b3'
+down_revision = 'a7f3c9d2e5b1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('task_scheduling',
+    sa.Column('taskid', sa.Integer(), nullable=False),
+    sa.Column('level', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['taskid'], ['tasks.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('taskid')
+    )
+    op.execute("INSERT INTO task_scheduling (taskid) SELECT id FROM tasks")
+
+
+def downgrade():
+    op.drop_table('task_scheduling')
@@ -0,0 +1,46 @@
+"""task durations
+
+The durations are initialised from the completed tasks that are in the tasks table.
+
+Revision ID: e8c4a1f7b3d9
+Revises: d7a2f6c4e8b3
+Create Date: 2026-10-18 18:12:44.517093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8c4a1f7b3d9'
+down_revision = 'd7a2f6c4e8b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('task_durations',
+    sa.Column('key_prefix', sa.String(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('duration', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('key_prefix', 'name')
+    )
+    op.execute("""
+INSERT INTO task_durations (key_prefix, name, count, duration)
+SELECT key_prefix,
+       name,
+       count(*),
+       avg(extract(epoch FROM "end" - start))
+FROM   tasks
+WHERE  status = 'completed'
+AND    key_prefix IS NOT NULL
+AND    name IS NOT NULL
+AND    start IS NOT NULL
+AND    "end" IS NOT NULL
+GROUP BY key_prefix, name
+""")
+
+
+def downgrade():
+    op.drop_table('task_durations')
@@ -0,0 +1,108 @@
+"""partition logs
+
+Convert the logs table to a table that is partitioned by month on timestamp.
+
+The existing logs table is attached as a single partition for all logs up to the start of next month.
+Its indexes are renamed and attached to the indexes of the partitioned table, so no data is copied
+and no indexes are rebuilt. There is no default partition, a row in a default partition
+would block the creation of the partition for its range. Legacy logs without a timestamp get the start of their job.
+
+Before the legacy table is attached a check constraint that matches the partition bound is added as NOT VALID
+and then validated. VALIDATE CONSTRAINT scans the legacy table once, ATTACH PARTITION then skips its own scan.
+The migration runs in one transaction, the legacy table stays locked (ACCESS EXCLUSIVE, taken by the rename)
+until the migration has been committed, so the logs cannot be read or written during the scan.
+
+The partitioned logs table has no primary key, a primary key on a partitioned table has to include
+the partition key. Only the legacy partition keeps its primary key logs_pkey on logid,
+the monthly partitions have no primary key, logid is unique because it is taken from the sequence.
+Monthly partitions do not have foreign keys on jobid and stepid, the legacy partition keeps its foreign keys.
+New monthly partitions are created by the log partition maintenance of the workflow service.
+
+Revision ID: e9d0529353ca
+Revises: 9c0cb17f8956
+Create Date: 2026-10-18 10:12:31.527104
+
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e9d0529353ca'
+down_revision = '9c0cb17f8956'
+branch_labels = None
+depends_on = None
+
+# Index name => indexed columns
+LOG_INDEXES = {
+    'ix_logs_application': ['application'],
+    'ix_logs_catalogue': ['catalogue'],
+    'ix_logs_destination': ['destination'],
+    'ix_logs_entity': ['entity'],
+    'ix_logs_process_id': ['process_id'],
+    'ix_logs_source': ['source'],
+    'ix_logs_jobid': ['jobid'],
+    'ix_logs_logid': ['logid'],
+    'ix_logs_stepid': ['stepid'],
+    'ix_logs_logid_desc': [sa.text('logid DESC')],
+}
+
+# Number of monthly partitions to create after the legacy partition
+PARTITIONS_AHEAD = 2
+
+
+def _add_months(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def upgrade():
+    next_month = _add_months(datetime.date.today().replace(day=1), 1)
+
+    op.execute("ALTER TABLE logs RENAME TO logs_legacy")
+    for name in LOG_INDEXES.keys():
+        op.execute(f"ALTER INDEX {name} RENAME TO {name.replace('ix_logs_', 'ix_logs_legacy_')}")
+
+    op.execute("CREATE TABLE logs (LIKE logs_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (timestamp)")
+    op.execute("ALTER SEQUENCE logs_logid_seq OWNED BY logs.logid")
+
+    # Logs without a timestamp cannot be stored in a range partition
+    op.execute("""
+UPDATE logs_legacy
+SET    timestamp = COALESCE((SELECT start FROM jobs WHERE jobs.id = logs_legacy.jobid), '1970-01-01')
+WHERE  timestamp IS NULL
+""")
+
+    # Attaching a table that has a valid constraint that implies the partition bound skips the validation scan.
+    # The constraint is validated separately, this scans the legacy table once
+    op.execute(f"ALTER TABLE logs_legacy ADD CONSTRAINT logs_legacy_timestamp_check "
+               f"CHECK (timestamp IS NOT NULL AND timestamp < '{next_month}') NOT VALID")
+    op.execute("ALTER TABLE logs_legacy VALIDATE CONSTRAINT logs_legacy_timestamp_check")
+    op.execute(f"ALTER TABLE logs ATTACH PARTITION logs_legacy FOR VALUES FROM (MINVALUE) TO ('{next_month}')")
+    op.execute("ALTER TABLE logs_legacy DROP CONSTRAINT logs_legacy_timestamp_check")
+    for offset in range(PARTITIONS_AHEAD):
+        start, end = _add_months(next_month, offset), _add_months(next_month, offset + 1)
+        op.execute(f"CREATE TABLE logs_y{start.year}m{start.month:02d} PARTITION OF logs "
+                   f"FOR VALUES FROM ('{start}') TO ('{end}')")
+
+    # Existing indexes on the legacy partition are attached, not rebuilt
+    for name, columns in LOG_INDEXES.items():
+        op.create_index(name, 'logs', columns, unique=False)
+
+
+def downgrade():
+    op.execute("CREATE TABLE logs_flat (LIKE logs INCLUDING DEFAULTS)")
+    op.execute("INSERT INTO logs_flat SELECT * FROM logs")
+    op.execute("ALTER SEQUENCE logs_logid_seq OWNED BY logs_flat.logid")
+
+    # Drops all partitions
+    op.execute("DROP TABLE logs")
+    op.execute("ALTER TABLE logs_flat RENAME TO logs")
+
+    op.create_primary_key('logs_pkey', 'logs', ['logid'])
+    op.create_foreign_key('logs_jobid_fkey', 'logs', 'jobs', ['jobid'], ['id'])
+    op.create_foreign_key('logs_stepid_fkey', 'logs', 'jobsteps', ['stepid'], ['id'])
+    for name, columns in LOG_INDEXES.items():
+        op.create_index(name, 'logs', columns, unique=False)
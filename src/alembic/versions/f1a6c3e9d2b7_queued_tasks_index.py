@@ -0,0 +1,43 @@
+"""queued tasks index and waiting tasks
+
+The queued tasks are counted per key prefix and jobstep.
+Ready tasks that are held back by the limits of their key prefix wait in waiting_tasks,
+they are queued per jobstep, the task with the longest critical path first.
+
+Revision ID: f1a6c3e9d2b7
+Revises: e8c4a1f7b3d9
+Create Date: 2026-10-18 19:24:08.946235
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1a6c3e9d2b7'
+down_revision = 'e8c4a1f7b3d9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_tasks_queued', 'tasks', ['key_prefix', 'stepid'], unique=False,
+                    postgresql_where=sa.text("status = 'queued'"))
+    op.create_table('waiting_tasks',
+    sa.Column('taskid', sa.Integer(), nullable=False),
+    sa.Column('stepid', sa.Integer(), nullable=False),
+    sa.Column('key_prefix', sa.String(), nullable=False),
+    sa.Column('path', sa.Float(), nullable=False),
+    sa.Column('priority', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['taskid'], ['tasks.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('taskid')
+    )
+    op.create_index('ix_waiting_tasks_key_prefix_stepid', 'waiting_tasks', ['key_prefix', 'stepid'], unique=False)
+    op.create_index('ix_waiting_tasks_stepid_path', 'waiting_tasks', ['stepid', 'path'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_waiting_tasks_stepid_path', table_name='waiting_tasks')
+    op.drop_index('ix_waiting_tasks_key_prefix_stepid', table_name='waiting_tasks')
+    op.drop_table('waiting_tasks')
+    op.drop_index('ix_tasks_queued', table_name='tasks')
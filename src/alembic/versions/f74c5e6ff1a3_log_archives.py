@@ -0,0 +1,31 @@
+"""log archives
+
+Revision ID: f74c5e6ff1a3
+Revises: e9d0529353ca
+Create Date: 2026-10-18 11:02:47.193316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f74c5e6ff1a3'
+down_revision = 'e9d0529353ca'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('log_archives',
+    sa.Column('jobid', sa.Integer(), nullable=False),
+    sa.Column('path', sa.String(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['jobid'], ['jobs.id'], ),
+    sa.PrimaryKeyConstraint('jobid')
+    )
+
+
+def downgrade():
+    op.drop_table('log_archives')
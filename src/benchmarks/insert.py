@@ -0,0 +1,98 @@
+"""Insert benchmark
+
+Compares the per call latency of storing jobs and jobsteps via the ORM unit of work
+with the Core insert statements that are used by job_save and step_save, one record per call.
+
+Requires a running management database. The benchmark jobs and jobsteps are removed afterwards.
+
+    python -m benchmarks.insert [number of calls]
+"""
+import datetime
+import statistics
+import sys
+import time
+
+from gobcore.model.sa.management import Job, JobStep
+
+from gobworkflow.storage import storage
+
+JOB_TYPE = "insert benchmark"
+
+
+def _job_info(n):
+    return {
+        "name": f"{JOB_TYPE}.{n}",
+        "type": JOB_TYPE,
+        "args": [str(n)],
+        "start": datetime.datetime.now(),
+        "end": None,
+        "status": "started",
+        "user": None,
+    }
+
+
+def _step_info(n, jobid):
+    return {
+        "jobid": jobid,
+        "name": f"step {n}",
+        "start": None,
+        "end": None,
+        "status": "scheduled",
+    }
+
+
+def orm_save(model, values):
+    """Store a record via the ORM, as job_save and step_save did before
+
+    :param model: the model class, eg Job
+    :param values: dict with attribute values
+    :return: the id of the new record
+    """
+    record = model(**values)
+    storage.session.add(record)
+    storage.session.commit()
+    return record.id
+
+
+def measure(func, calls):
+    """Measure the latency of the given function
+
+    :param func: the function to measure, it is called with the number of the call
+    :param calls: the number of calls
+    :return: list with the duration of each call in microseconds
+    """
+    durations = []
+    for n in range(calls):
+        start = time.perf_counter()
+        func(n)
+        durations.append((time.perf_counter() - start) * 1_000_000)
+    return durations
+
+
+def report(name, durations):
+    print(f"{name:12s} mean {statistics.mean(durations):8.0f} us, "
+          f"median {statistics.median(durations):8.0f} us, "
+          f"max {max(durations):8.0f} us")
+
+
+def main(calls):
+    storage.connect()
+    jobid = storage.job_save(_job_info(-1))
+    try:
+        for name, func in [
+            ("ORM job", lambda n: orm_save(Job, _job_info(n))),
+            ("Core job", lambda n: storage.job_save(_job_info(n))),
+            ("ORM step", lambda n: orm_save(JobStep, _step_info(n, jobid))),
+            ("Core step", lambda n: storage.step_save(_step_info(n, jobid))),
+        ]:
+            report(name, measure(func, calls))
+    finally:
+        jobids = storage.session.query(Job.id).filter(Job.type == JOB_TYPE)
+        storage.session.query(JobStep).filter(JobStep.jobid.in_(jobids.subquery())).delete(synchronize_session=False)
+        storage.session.query(Job).filter(Job.type == JOB_TYPE).delete(synchronize_session=False)
+        storage.session.commit()
+        storage.disconnect()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,119 @@
+"""Task scheduler benchmark
+
+Schedules all tasks of a step with a random dependency graph,
+using the dependents in the step graph and using a full scan of the tasks on every result (as before).
+
+For each task result the full scan reads all tasks of the step and checks the dependencies of every new task,
+with the step graph only the dependents of the completed task and their dependencies are read.
+The number of task rows that are read is reported for both.
+
+The full scan is only run for steps up to LEGACY_MAX_TASKS tasks, it takes hours for larger steps.
+
+Does not require a database.
+
+    python -m benchmarks.scheduler [number of tasks ...]
+"""
+import random
+import sys
+import time
+
+from collections import deque
+
+from gobworkflow.task.scheduler import StepGraph
+
+MAX_DEPENDENCIES = 3  # Maximum number of dependencies of a task
+WINDOW = 100  # Dependencies are chosen from the WINDOW preceding tasks
+LEGACY_MAX_TASKS = 10000  # Largest step for which the full scan is run
+
+
+def _tasks(n):
+    """Create a random dependency graph of n tasks
+
+    :return: list of (id, name, dependencies)
+    """
+    random.seed(n)
+    tasks = []
+    for i in range(n):
+        candidates = range(max(0, i - WINDOW), i)
+        dependencies = random.sample(candidates, min(len(candidates), random.randint(0, MAX_DEPENDENCIES)))
+        tasks.append((i, f"task {i}", [f"task {d}" for d in dependencies]))
+    return tasks
+
+
+def schedule_graph(tasks):
+    """Schedule the tasks by checking the dependents of each completed task
+
+    :return: tuple (number of scheduled tasks, number of task rows read)
+    """
+    graph = StepGraph([(name, dependencies) for _, name, dependencies in tasks])
+    dependencies = {name: dependencies for _, name, dependencies in tasks}
+    status = {name: 'new' for _, name, _ in tasks}
+    rows = 0
+
+    def queue_ready_tasks(names):
+        nonlocal rows
+        rows += sum(1 + len(dependencies[name]) for name in names)
+        ready = [name for name in names
+                 if status[name] == 'new' and all(status[dep] == 'completed' for dep in dependencies[name])]
+        for name in ready:
+            status[name] = 'queued'
+        return ready
+
+    queued = deque(queue_ready_tasks(list(status)))
+    scheduled = 0
+    while queued:
+        name = queued.popleft()
+        scheduled += 1
+        status[name] = 'completed'
+        queued.extend(queue_ready_tasks(graph.dependents.get(name, [])))
+    return scheduled, rows
+
+
+def schedule_scan(tasks):
+    """Schedule the tasks by scanning all tasks on every result
+
+    :return: tuple (number of scheduled tasks, number of task rows read)
+    """
+    status = {name: 'new' for _, name, _ in tasks}
+    rows = 0
+
+    def queue_free_tasks():
+        nonlocal rows
+        rows += len(tasks)
+        completed = {name for name, value in status.items() if value == 'completed'}
+        free = [name for _, name, dependencies in tasks
+                if status[name] == 'new' and all(dep in completed for dep in dependencies)]
+        for name in free:
+            status[name] = 'queued'
+        return free
+
+    queued = deque(queue_free_tasks())
+    scheduled = 0
+    while queued:
+        name = queued.popleft()
+        scheduled += 1
+        status[name] = 'completed'
+        queued.extend(queue_free_tasks())
+    return scheduled, rows
+
+
+def run(name, schedule, tasks):
+    start = time.perf_counter()
+    scheduled, rows = schedule(tasks)
+    duration = time.perf_counter() - start
+    assert scheduled == len(tasks), f"{name} scheduled {scheduled} of {len(tasks)} tasks"
+    print(f"{name:>6}: {len(tasks):8d} tasks, {rows:12d} rows read, {duration:8.2f} secs")
+
+
+def main(sizes):
+    for n in sizes:
+        tasks = _tasks(n)
+        run("graph", schedule_graph, tasks)
+        if n <= LEGACY_MAX_TASKS:
+            run("scan", schedule_scan, tasks)
+        else:
+            print(f"{'scan':>6}: {n:8d} tasks, skipped")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000])
@@ -0,0 +1,80 @@
+"""Session soak benchmark
+
+Handles a large number of simulated task result messages and reports the memory usage of the process
+and the number of objects in the identity map of the session.
+
+With a session scope per message the memory usage should stay flat.
+Without it (--no-scope) every loaded object stays in the identity map of the single session.
+
+Requires a running management database. The benchmark job is removed afterwards.
+
+    python -m benchmarks.session_soak [number of messages] [--no-scope]
+"""
+import datetime
+import resource
+import sys
+
+from gobcore.model.sa.management import Job, JobStep, Task
+
+from gobworkflow.storage import storage
+from gobworkflow.storage.tables import task_counts
+
+TASKS = 100  # Number of tasks in the benchmark step
+REPORT_INTERVAL = 10000  # Report memory usage every REPORT_INTERVAL messages
+
+
+def _setup():
+    """Create a job with one step and TASKS tasks
+
+    :return: the ids of the job and the step
+    """
+    now = datetime.datetime.utcnow()
+    jobid = storage.job_save({"name": "session soak benchmark", "type": "benchmark", "start": now})
+    stepid = storage.step_save({"jobid": jobid, "name": "benchmark", "start": now})
+    storage.tasks_save(stepid, [{"name": f"task {n}", "dependencies": [], "status": "new", "jobid": jobid,
+                                 "stepid": stepid, "key_prefix": "benchmark", "extra_msg": {}, "extra_header": {}}
+                                for n in range(TASKS)], {f"task {n}": 0 for n in range(TASKS)})
+    return jobid, stepid
+
+
+def _teardown(jobid, stepid):
+    storage.session.query(Task).filter(Task.stepid == stepid).delete()
+    storage.session.execute(task_counts.delete().where(task_counts.c.stepid == stepid))
+    storage.session.query(JobStep).filter(JobStep.id == stepid).delete()
+    storage.session.query(Job).filter(Job.id == jobid).delete()
+    storage.session.commit()
+
+
+def handle_message(jobid, stepid, n):
+    """Simulate the database access of handling a task result message
+
+    :return: None
+    """
+    storage.get_job_step(jobid, stepid)
+    tasks = storage.get_tasks_for_stepid(stepid)
+    task = tasks[n % len(tasks)]
+    storage.task_get(task.id)
+
+
+def report(n):
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{n:8d} messages, max RSS {max_rss // 1024:6d} MB, identity map {len(storage.session.identity_map):6d}")
+
+
+def main(messages, scoped):
+    storage.connect()
+    jobid, stepid = _setup()
+    handler = storage.session_scope(handle_message) if scoped else handle_message
+    try:
+        for n in range(1, messages + 1):
+            handler(jobid, stepid, n)
+            if n % REPORT_INTERVAL == 0:
+                report(n)
+    finally:
+        _teardown(jobid, stepid)
+        storage.disconnect()
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    main(int(args[0]) if args else 100000, '--no-scope' not in sys.argv)
@@ -2,26 +2,38 @@
 
 The workflow manager subscribes to the workflow and log queues.
 
-Log messages are simply printed (for now)
+Log messages are stored in the management database in batches
 Workflow messages consist of proposals. A proposal is evaluated (for now always OK) and then routed as a request
 to the service that can handle the proposal.
 
 """
 import argparse
+import time
 
-from gobcore.status.heartbeat import STATUS_OK, STATUS_FAIL
+from gobcore.status.heartbeat import Heartbeat, STATUS_OK, STATUS_FAIL, HEARTBEAT_INTERVAL
+from gobcore.message_broker import publish
 from gobcore.message_broker.config import HEARTBEAT_QUEUE, TASK_QUEUE, TASK_RESULT_QUEUE, PROGRESS_QUEUE, \
     WORKFLOW_QUEUE
 from gobcore.message_broker.config import JOBSTEP_RESULT_QUEUE, LOG_QUEUE, AUDIT_LOG_QUEUE
 from gobcore.message_broker.messagedriven_service import messagedriven_service
 from gobcore.logging.logger import logger
 
-from gobworkflow.storage.storage import connect, save_log, save_audit_log
+from gobworkflow.config import LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, CONSUMER_GROUPS, HEARTBEAT_BATCH_SIZE, \
+    HEARTBEAT_FLUSH_INTERVAL, LOG_SPOOL_DIR
+from gobworkflow.consumer import BatchConsumer, QueueConsumer
+from gobworkflow.periodic import Periodic
+from gobworkflow.storage.archive import archive_logs, ARCHIVE_INTERVAL
+from gobworkflow.storage.bulk import copy_logs, copy_audit_logs, replay_spools, SPOOL_REPLAY_INTERVAL
+from gobworkflow.storage.log_writer import BufferedWriter
+from gobworkflow.storage.partitions import maintain_log_partitions, MAINTENANCE_INTERVAL
+from gobworkflow.storage.spool import lock_spool_dir
+from gobworkflow.storage.storage import connect, is_connected, session_scope
 from gobworkflow.workflow.jobs import step_status
 from gobworkflow.workflow.workflow import Workflow
-from gobworkflow.heartbeats import on_heartbeat
+from gobworkflow.heartbeats import on_heartbeat, on_heartbeats, check_services, SERVICE_SWEEP_INTERVAL
 from gobworkflow.storage.storage import get_job_step
-from gobworkflow.task.queue import TaskQueue
+from gobworkflow.task.queue import TaskQueue, WATCHDOG_INTERVAL
+from gobworkflow.task.summary import remove_old_details, CLEANUP_INTERVAL
 
 from gobworkflow.workflow import hooks
 
@@ -91,43 +103,82 @@ def on_workflow_progress(msg):
     hooks.on_workflow_progress(msg)
 
 
+SERVICE_NAME = "Workflow"
+
 task_queue = TaskQueue()
 
+# Every message is handled in its own session
 SERVICEDEFINITION = {
     'step_completed': {
         'queue': JOBSTEP_RESULT_QUEUE,
-        'handler': handle_result
+        'handler': session_scope(handle_result)
     },
     'start_workflow': {
         'queue': WORKFLOW_QUEUE,
-        'handler': start_workflow
-    },
-    'save_logs': {
-        'queue': LOG_QUEUE,
-        'handler': save_log
-    },
-    'save_audit_logs': {
-        'queue': AUDIT_LOG_QUEUE,
-        'handler': save_audit_log,
+        'handler': session_scope(start_workflow)
     },
     'heartbeat_monitor': {
         'queue': HEARTBEAT_QUEUE,
-        'handler': on_heartbeat
+        'handler': session_scope(on_heartbeat)
     },
     'workflow_progress': {
         'queue': PROGRESS_QUEUE,
-        'handler': on_workflow_progress
+        'handler': session_scope(on_workflow_progress)
     },
     'start_tasks': {
         'queue': TASK_QUEUE,
-        'handler': task_queue.on_start_tasks,
+        'handler': session_scope(task_queue.on_start_tasks),
     },
     'task_completed': {
         'queue': TASK_RESULT_QUEUE,
-        'handler': task_queue.on_task_result
+        'handler': session_scope(task_queue.on_task_result)
     },
 }
 
+
+class HeartbeatConnection:
+    """Publishes each heartbeat on its own message broker connection
+
+    The heartbeat is sent every HEARTBEAT_INTERVAL seconds,
+    a connection that is kept open in between would miss the message broker heartbeats
+    """
+
+    def publish(self, exchange, key, msg):
+        publish(exchange, key, msg)
+
+
+def send_heartbeats(consumers):
+    """Send the heartbeat of the service, like the message driven service does, while all consumers are alive
+
+    :param consumers: the consumer threads
+    :return: None
+    """
+    heartbeat = Heartbeat(HeartbeatConnection(), SERVICE_NAME)
+    while all(consumer.is_alive() for consumer in consumers):
+        try:
+            heartbeat.send()
+        except Exception as e:
+            print(f"Heartbeat failed: {str(e)}")
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
+def run_threaded():
+    """Consume the queues of each consumer group on its own thread
+
+    Latency critical workflow messages are then not delayed by bulk traffic on other queues
+    The main thread sends the heartbeats of the service
+
+    :return: None
+    """
+    groups = {name: ({key: SERVICEDEFINITION[key] for key in keys if key in SERVICEDEFINITION}, prefetch_count)
+              for name, (keys, prefetch_count) in CONSUMER_GROUPS.items()}
+    consumers = [QueueConsumer(name, servicedefinition, prefetch_count)
+                 for name, (servicedefinition, prefetch_count) in groups.items() if servicedefinition]
+    for consumer in consumers:
+        consumer.start()
+    send_heartbeats(consumers)
+
+
 parser = argparse.ArgumentParser(
     prog="python -m gobworkflow",
     description="GOB Workflow manager"
@@ -137,6 +188,14 @@ parser.add_argument('--migrate',
                     action='store_true',
                     default=False,
                     help='migrate the management database')
+parser.add_argument('--threaded',
+                    action='store_true',
+                    default=False,
+                    help='consume each group of queues on its own thread')
+parser.add_argument('--coalesce-heartbeats',
+                    action='store_true',
+                    default=False,
+                    help='handle heartbeats in batches, only the newest heartbeat of each service is handled')
 args = parser.parse_args()
 
 if args.migrate:
@@ -145,8 +204,38 @@ if args.migrate:
 else:
     connect()
 
-    params = {
-        "prefetch_count": 1,
-        "load_message": False
-    }
-    messagedriven_service(SERVICEDEFINITION, "Workflow", params)
+    # The spool directory of this instance is not replayed by other instances while this instance runs
+    spool_dir_lock = lock_spool_dir(LOG_SPOOL_DIR)
+
+    # Log messages are consumed separately and saved in batches
+    BatchConsumer(LOG_QUEUE, BufferedWriter(copy_logs, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL), is_connected).start()
+    BatchConsumer(AUDIT_LOG_QUEUE, BufferedWriter(copy_audit_logs, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL),
+                  is_connected).start()
+    # Log messages that have been spooled during a database outage
+    Periodic(SPOOL_REPLAY_INTERVAL, replay_spools).start()
+
+    # Keep the partitions of the logs table up-to-date
+    Periodic(MAINTENANCE_INTERVAL, maintain_log_partitions).start()
+    # Move the logs of old jobs out of the logs table
+    Periodic(ARCHIVE_INTERVAL, archive_logs).start()
+    # Remove old task summary details files
+    Periodic(CLEANUP_INTERVAL, remove_old_details).start()
+    # Mark or remove services that have not sent a heartbeat for some time
+    Periodic(SERVICE_SWEEP_INTERVAL, check_services).start()
+    # Publish queued tasks that have not been published or that have timed out again
+    Periodic(WATCHDOG_INTERVAL, session_scope(task_queue.check_timeouts)).start()
+
+    if args.coalesce_heartbeats:
+        # Heartbeats are consumed separately, a backlog of heartbeats is handled in a few transactions
+        del SERVICEDEFINITION['heartbeat_monitor']
+        BatchConsumer(HEARTBEAT_QUEUE, BufferedWriter(on_heartbeats, HEARTBEAT_BATCH_SIZE, HEARTBEAT_FLUSH_INTERVAL),
+                      is_connected).start()
+
+    if args.threaded:
+        run_threaded()
+    else:
+        params = {
+            "prefetch_count": 1,
+            "load_message": False
+        }
+        messagedriven_service(SERVICEDEFINITION, SERVICE_NAME, params)
@@ -1,4 +1,6 @@
+import json
 import os
+import socket
 
 GOB_MGMT_DB = {
     'drivername': 'postgres',
@@ -10,3 +12,61 @@ GOB_MGMT_DB = {
 }
 
 API_HOST = os.getenv('API_HOST', 'http://localhost:8141')
+
+# Log messages are stored in batches.
+# A batch is written when it reaches LOG_BATCH_SIZE messages or when its oldest message
+# has been waiting for LOG_FLUSH_INTERVAL seconds
+LOG_BATCH_SIZE = int(os.getenv('LOG_BATCH_SIZE', 1000))
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL', 1))
+
+# The logs table is partitioned by month.
+# Partitions older than LOG_PARTITION_RETENTION months are detached from the logs table (0 = never)
+LOG_PARTITION_RETENTION = int(os.getenv('LOG_PARTITION_RETENTION', 0))
+
+GOB_SHARED_DIR = os.getenv('GOB_SHARED_DIR', '/app/shared')
+
+# The logs of jobs that ended more than LOG_ARCHIVE_AGE days ago are moved to compressed files (0 = never)
+LOG_ARCHIVE_AGE = int(os.getenv('LOG_ARCHIVE_AGE', 0))
+LOG_ARCHIVE_DIR = os.path.join(GOB_SHARED_DIR, 'log_archive')
+
+# Consumer groups for the threaded mode of the workflow service.
+# Every group consumes its queues on its own thread with its own connections.
+# Group name => (names of the service definitions to consume, prefetch count)
+CONSUMER_GROUPS = {
+    'workflow': (['step_completed', 'start_workflow', 'workflow_progress'],
+                 int(os.getenv('WORKFLOW_PREFETCH_COUNT', 1))),
+    'tasks': (['start_tasks', 'task_completed'],
+              int(os.getenv('TASK_PREFETCH_COUNT', 1))),
+    'heartbeats': (['heartbeat_monitor'],
+                   int(os.getenv('HEARTBEAT_PREFETCH_COUNT', 10))),
+}
+
+# While the management database is unreachable, log messages are spooled to files in LOG_SPOOL_DIR
+# Every workflow instance has its own spool directory in LOG_SPOOL_ROOT.
+# The spool directories of instances that have stopped are replayed by the running instances
+LOG_SPOOL_ROOT = os.getenv('LOG_SPOOL_ROOT', os.path.join(GOB_SHARED_DIR, 'log_spool'))
+LOG_SPOOL_DIR = os.getenv('LOG_SPOOL_DIR', os.path.join(LOG_SPOOL_ROOT, socket.gethostname()))
+
+# When heartbeats are coalesced, a batch of heartbeats is handled when it reaches HEARTBEAT_BATCH_SIZE messages
+# or when its oldest message has been waiting for HEARTBEAT_FLUSH_INTERVAL seconds
+HEARTBEAT_BATCH_SIZE = int(os.getenv('HEARTBEAT_BATCH_SIZE', 1000))
+HEARTBEAT_FLUSH_INTERVAL = float(os.getenv('HEARTBEAT_FLUSH_INTERVAL', 1))
+
+# The warnings and errors of the tasks of a jobstep are counted and at most TASK_SUMMARY_SAMPLE_SIZE of each
+# are kept for the completion message of the jobstep. All warnings and errors are written to TASK_SUMMARY_DIR
+TASK_SUMMARY_SAMPLE_SIZE = int(os.getenv('TASK_SUMMARY_SAMPLE_SIZE', 100))
+TASK_SUMMARY_DIR = os.getenv('TASK_SUMMARY_DIR', os.path.join(GOB_SHARED_DIR, 'task_summaries'))
+# Details files that have not been written to for TASK_SUMMARY_RETENTION days are removed (0 = never)
+TASK_SUMMARY_RETENTION = int(os.getenv('TASK_SUMMARY_RETENTION', 30))
+
+# Maximum number of queued tasks per key prefix over all jobsteps and per jobstep, for example
+# TASK_LIMITS='{"prepare": 20}' and TASK_STEP_LIMITS='{"prepare": 5}'. Key prefixes that are not listed have no limits.
+# Tasks that exceed the limits stay new until a task with the same key prefix ends
+TASK_LIMITS = json.loads(os.getenv('TASK_LIMITS', '{}'))
+TASK_STEP_LIMITS = json.loads(os.getenv('TASK_STEP_LIMITS', '{}'))
+
+# Queued tasks that have not ended within the timeout in seconds of their key prefix are published again,
+# eg TASK_TIMEOUTS='{"prepare": 3600}'. The timeout doubles with every attempt.
+# A task that has not ended after TASK_MAX_ATTEMPTS attempts fails. Key prefixes that are not listed have no timeout
+TASK_TIMEOUTS = json.loads(os.getenv('TASK_TIMEOUTS', '{}'))
+TASK_MAX_ATTEMPTS = int(os.getenv('TASK_MAX_ATTEMPTS', 3))
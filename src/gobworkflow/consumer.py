@@ -0,0 +1,166 @@
+"""Consumers
+
+Consumers consume message broker queues on their own thread with their own connection.
+
+The BatchConsumer consumes a queue and hands the messages to a BufferedWriter.
+Messages are only acknowledged after the writer has successfully saved them.
+If saving fails because the storage is unreachable, the messages are returned to the queue to be delivered again.
+Otherwise the failure is reported and the messages are acknowledged, a batch that cannot be saved
+would be delivered again forever. Messages that cannot be decoded are reported and skipped.
+
+The QueueConsumer consumes one or more queues and handles the messages one by one,
+like the message driven service does.
+"""
+import abc
+import json
+import threading
+import time
+
+import pika
+
+from gobcore.message_broker.config import CONNECTION_PARAMS
+
+RECONNECT_INTERVAL = 10  # Duration in seconds to wait before consuming again after a failure
+
+
+class Consumer(threading.Thread, metaclass=abc.ABCMeta):
+
+    def run(self):
+        """Consume
+
+        Any failure, eg a lost connection, restarts consumption after RECONNECT_INTERVAL seconds
+        Unacknowledged messages are then redelivered by the message broker
+
+        :return: None
+        """
+        while True:
+            try:
+                self.consume()
+            except Exception as e:
+                print(f"{self.name} failed: {str(e)}")
+                time.sleep(RECONNECT_INTERVAL)
+
+    @abc.abstractmethod
+    def consume(self):
+        """Consume until the connection fails
+
+        :return: None
+        """
+
+
+class BatchConsumer(Consumer):
+
+    def __init__(self, queue, writer, is_connected):
+        """Constructor
+
+        :param queue: the name of the queue to consume
+        :param writer: the BufferedWriter that saves the messages
+        :param is_connected: Function that tells whether the storage is reachable
+        """
+        super().__init__(name=f"BatchConsumer {queue}", daemon=True)
+        self.queue = queue
+        self.writer = writer
+        self.is_connected = is_connected
+        self._last_tag = None
+
+    def consume(self):
+        """Consume the queue and save the messages in batches
+
+        The prefetch count equals the batch size so that a full batch can be received before it is acknowledged
+
+        :return: None
+        """
+        # Any messages left from a previous failure will be redelivered
+        self.writer.discard()
+        with pika.BlockingConnection(CONNECTION_PARAMS) as connection:
+            channel = connection.channel()
+            channel.basic_qos(prefetch_count=self.writer.max_size)
+            for method, _, body in channel.consume(self.queue, inactivity_timeout=self.writer.max_wait):
+                if method is not None:
+                    self.add(channel, method.delivery_tag, body)
+                if self.writer.is_due():
+                    self.flush(channel)
+
+    def add(self, channel, delivery_tag, body):
+        """Add a message to the writer
+
+        A message that cannot be decoded is skipped. It is acknowledged together with the next batch,
+        or at once if no messages are waiting to be saved
+
+        :param channel: the channel on which the message has been received
+        :param delivery_tag: the delivery tag of the message
+        :param body: the message body
+        :return: None
+        """
+        self._last_tag = delivery_tag
+        try:
+            msg = json.loads(body)
+        except ValueError as e:
+            print(f"{self.name} skips invalid message: {str(e)}")
+            if not len(self.writer):
+                channel.basic_ack(delivery_tag=delivery_tag)
+            return
+        self.writer.add(msg)
+
+    def flush(self, channel):
+        """Flush the writer and acknowledge all messages that have been received so far
+
+        If saving fails while the storage is unreachable the messages are rejected and requeued.
+        Any other failure is reported and the messages are acknowledged
+
+        :param channel: the channel on which the messages have been received
+        :return: None
+        """
+        try:
+            self.writer.flush()
+        except Exception as e:
+            if not self.is_connected():
+                print(f"{self.name} failed to save messages, storage unreachable: {str(e)}")
+                channel.basic_nack(delivery_tag=self._last_tag, multiple=True, requeue=True)
+                return
+            print(f"{self.name} failed to save messages, messages are dropped: {str(e)}")
+        channel.basic_ack(delivery_tag=self._last_tag, multiple=True)
+
+
+class QueueConsumer(Consumer):
+
+    def __init__(self, name, servicedefinition, prefetch_count):
+        """Constructor
+
+        :param name: the name of the consumer
+        :param servicedefinition: the queues to consume and their handlers, like for the message driven service
+        :param prefetch_count: the maximum number of unacknowledged messages per queue
+        """
+        super().__init__(name=f"QueueConsumer {name}", daemon=True)
+        self.servicedefinition = servicedefinition
+        self.prefetch_count = prefetch_count
+
+    def consume(self):
+        """Consume the queues and handle the messages one by one
+
+        :return: None
+        """
+        with pika.BlockingConnection(CONNECTION_PARAMS) as connection:
+            channel = connection.channel()
+            channel.basic_qos(prefetch_count=self.prefetch_count)
+            for definition in self.servicedefinition.values():
+                channel.basic_consume(self._on_message(definition['handler']), queue=definition['queue'])
+            channel.start_consuming()
+
+    def _on_message(self, handler):
+        """Get the callback that handles a message
+
+        Like for the message driven service, the message is acknowledged after it has been handled,
+        also when handling fails
+
+        :param handler: the message handler
+        :return: the callback function for the message broker
+        """
+        def on_message(channel, method, properties, body):
+            try:
+                handler(json.loads(body))
+            except Exception as e:
+                print(f"{self.name} message handling has failed: {str(e)}")
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+
+        return on_message
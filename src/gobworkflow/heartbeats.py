@@ -4,31 +4,110 @@ Use heartbeats to monitor the status of the components and their tasks
 
 The status is stored in both memory and storage
 
-On every heartbeat all currently known services are checked for heartbeat interval timeout
-
 The memory storage is used to compare the status with the last registered status
 If the status has changed the change is written to the storage
+and recorded in the append-only service transitions (up, down, removed, thread started or stopped)
+The timestamp of an unchanged service is refreshed in the storage with a timestamp-only update.
+Every heartbeat is written through, so all workflow instances that consume heartbeats see the last heartbeats.
+An unchanged service that is stored with another liveness, eg because it has been marked as dead
+by another workflow instance, is stored as a change
+
+Every SERVICE_SWEEP_INTERVAL seconds all services are checked for heartbeat interval timeout
 
+Heartbeats can also be handled in batches, only the newest heartbeat of each service in a batch is then handled
 
 """
 import datetime
+import threading
+
+from dateutil import parser
 
 from gobcore.status.heartbeat import HEARTBEAT_INTERVAL
-from gobworkflow.storage.storage import update_service, remove_service, get_services, mark_service_dead
+from gobworkflow.storage.storage import refresh_services, update_services, sweep_services
 
 # Remove a service after not having received anything for SERVICE_REMOVAL_TIMEOUT seconds
 _SERVICE_REMOVAL_TIMEOUT = HEARTBEAT_INTERVAL * 60
 
+# Duration in seconds between two checks for services that have timed out
+SERVICE_SWEEP_INTERVAL = HEARTBEAT_INTERVAL
 
-def on_heartbeat(msg):
-    """On heartbeat message
 
-    Register the current status
-    Store the status
-    Check all services for timeout on heartbeat interval
+class ServiceRegistry:
+    """In memory registry of the services and their tasks
+
+    Services are identified by their name and host.
+    For each service the registry holds the status that has last been stored by this workflow instance.
+    The registry is only used to skip writing unchanged services in full, the timestamp of every heartbeat is stored.
+    Whether the stored liveness is still the registered liveness is checked when the timestamp is refreshed,
+    so the registry may safely be out of date when multiple workflow instances consume heartbeats.
+    """
+
+    def __init__(self):
+        self._services = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(service):
+        return service["name"], service["host"]
+
+    @staticmethod
+    def _status(service, tasks):
+        return service["is_alive"], service["pid"], frozenset((task["name"], task["is_alive"]) for task in tasks)
+
+    def needs_update(self, service, tasks):
+        """Tells whether the service should be written to storage
+
+        The service is written when it is new or when its status or tasks have changed
+
+        :param service: the service as received in the heartbeat
+        :param tasks: the tasks of the service
+        :return: True if the service should be written to storage
+        """
+        with self._lock:
+            return self._services.get(self._key(service)) != self._status(service, tasks)
+
+    def register(self, service, tasks):
+        """Register the status of a service that has been written to storage
+
+        :param service: the service as received in the heartbeat
+        :param tasks: the tasks of the service
+        :return: None
+        """
+        with self._lock:
+            self._services[self._key(service)] = self._status(service, tasks)
+
+    def mark_dead(self, service):
+        """Register that a service has been marked as dead in storage
+
+        The next heartbeat of the service will be a change
+
+        :param service: the service
+        :return: None
+        """
+        with self._lock:
+            registered = self._services.get(self._key(service))
+            if registered:
+                _, pid, _ = registered
+                self._services[self._key(service)] = (False, pid, frozenset())
+
+    def remove(self, service):
+        """Remove a service from the registry
+
+        :param service: the service
+        :return: None
+        """
+        with self._lock:
+            self._services.pop(self._key(service), None)
+
+
+registry = ServiceRegistry()
+
+
+def _get_service(msg):
+    """Get the service and its tasks from a heartbeat message
 
     :param msg: heartbeat message
-    :return: None
+    :return: tuple (service, tasks)
     """
     service_name = msg["name"]
 
@@ -46,28 +125,83 @@ def on_heartbeat(msg):
         "is_alive": thread["is_alive"]
     } for thread in msg["threads"]] if service["is_alive"] else []
 
-    # Update in storage
-    update_service(service, service_tasks)
+    return service, service_tasks
+
+
+def _store(services):
+    """Store the last heartbeats of services
+
+    Changed services are stored in one transaction, the timestamps of the other services are refreshed.
+    Services that could not be refreshed because their stored liveness differs are stored as well.
+
+    :param services: list of (service, tasks) with the last heartbeat of each service
+    :return: None
+    """
+    changed = [registry.needs_update(service, tasks) for service, tasks in services]
+    refreshed = refresh_services([(service["name"], service["host"], service["is_alive"],
+                                   parser.parse(service["timestamp"]))
+                                  for (service, _), is_changed in zip(services, changed) if not is_changed])
+    stored = [(service, tasks) for (service, tasks), is_changed in zip(services, changed)
+              if is_changed or (service["name"], service["host"]) not in refreshed]
+    if stored:
+        update_services(stored)
+    for service, tasks in stored:
+        registry.register(service, tasks)
+
+
+def on_heartbeat(msg):
+    """On heartbeat message
+
+    Register the current status
+    Store the status if it has changed, otherwise refresh the timestamp of the service
+
+    :param msg: heartbeat message
+    :return: None
+    """
+    _store([_get_service(msg)])
+
 
-    # timeout of heartbeat interval check
-    check_services()
+def on_heartbeats(msgs):
+    """On a batch of heartbeat messages
+
+    Only the newest heartbeat of each service is handled, invalid heartbeats are skipped.
+    The services that have changed are stored in one transaction,
+    the timestamps of the other services are refreshed with one statement.
+
+    :param msgs: list of heartbeat messages
+    :return: None
+    """
+    newest = {}
+    for msg in msgs:
+        try:
+            service, service_tasks = _get_service(msg)
+            timestamp = parser.parse(service["timestamp"])
+        except Exception as e:
+            print(f"Skip invalid heartbeat: {str(e)}")
+            continue
+        key = service["name"], service["host"]
+        if key not in newest or timestamp >= newest[key][0]:
+            newest[key] = timestamp, service, service_tasks
+
+    _store([(service, service_tasks) for _, service, service_tasks in newest.values()])
 
 
 def check_services():
     """Check services on heartbeat timeout
 
-    If a heartbeat has not been received in the heartbeat timeour interval mark the process as dead
+    If a heartbeat has not been received in the heartbeat timeout interval mark the process as dead
+    If nothing has been received in the service removal timeout interval remove the process
+
+    All services are checked at once in storage, the registry is updated with the result
 
     :return: None
     """
     now = datetime.datetime.utcnow()
-    for service in get_services():
-        # Only check services that are currently marked as alive
-        last_heartbeat = service.timestamp
-        time_ago = now - last_heartbeat
-        if time_ago.total_seconds() > _SERVICE_REMOVAL_TIMEOUT:
-            # Final timeout reached, remove the service
-            remove_service(service)
-        elif time_ago.total_seconds() > HEARTBEAT_INTERVAL:
-            # Heartbeat timeout, register as dead
-            mark_service_dead(service)
+    dead, removed = sweep_services(dead_before=now - datetime.timedelta(seconds=HEARTBEAT_INTERVAL),
+                                   remove_before=now - datetime.timedelta(seconds=_SERVICE_REMOVAL_TIMEOUT))
+    for name, host in dead:
+        print(f"Service {name} on {host} is dead")
+        registry.mark_dead({"name": name, "host": host})
+    for name, host in removed:
+        print(f"Service {name} on {host} is removed")
+        registry.remove({"name": name, "host": host})
@@ -0,0 +1,60 @@
+"""Read the logs of a job
+
+Writes the logs of a job or of a single step of a job to stdout as ndjson, e.g.:
+
+     python -m gobworkflow.logs 123 --step 456
+
+By default all logs are written in logid order.
+With --limit a single page of logs is written, newest logs first.
+The logid to pass with --before to get the next page is written to stderr.
+"""
+import argparse
+import contextlib
+import sys
+
+from gobworkflow.storage.storage import connect, log_to_json
+from gobworkflow.storage.logs import get_logs, export_logs
+
+
+def _parse_arguments(args):
+    parser = argparse.ArgumentParser(
+        prog='python -m gobworkflow.logs',
+        description='Read the logs of a GOB job',
+        epilog='Generieke Ontsluiting Basisregistraties'
+    )
+    parser.add_argument('jobid', type=int, help='Id of the job')
+    parser.add_argument('--step', type=int, help='Id of the step, only the logs of this step are read')
+    parser.add_argument('--limit', type=int, help='Read a single page of at most LIMIT logs')
+    parser.add_argument('--before', type=int, help='Start the page below this logid')
+    return parser.parse_args(args)
+
+
+def read_logs(args):
+    """Write the logs that are selected by the arguments to stdout
+
+    :param args: the parsed command line arguments
+    :return: None
+    """
+    if args.limit is None:
+        export_logs(args.jobid, sys.stdout, args.step)
+        return
+
+    logs, before = get_logs(args.jobid, args.step, before=args.before, limit=args.limit)
+    for log in logs:
+        sys.stdout.write(log_to_json(log) + '\n')
+    if before is not None:
+        print(f"Next page: --before {before}", file=sys.stderr)
+
+
+def init():
+    if __name__ == '__main__':
+        args = _parse_arguments(sys.argv[1:])
+        # Keep stdout for the logs
+        with contextlib.redirect_stdout(sys.stderr):
+            connected = connect()
+        if not connected:
+            exit(1)
+        read_logs(args)
+
+
+init()
@@ -0,0 +1,42 @@
+"""Periodic
+
+Runs a function on a regular interval on its own thread.
+
+Used for maintenance tasks of the workflow service that are not triggered by messages.
+"""
+import threading
+
+
+class Periodic(threading.Thread):
+
+    def __init__(self, interval, func):
+        """Constructor
+
+        :param interval: Duration in seconds between two consecutive runs
+        :param func: Function to run, it is run immediately after start and then every interval seconds
+        """
+        super().__init__(name=f"Periodic {func.__name__}", daemon=True)
+        self.interval = interval
+        self.func = func
+        self._stopped = threading.Event()
+
+    def run(self):
+        """Run the function until stopped
+
+        Any exception is reported, the function will be run again on the next interval
+
+        :return: None
+        """
+        while not self._stopped.is_set():
+            try:
+                self.func()
+            except Exception as e:
+                print(f"{self.name} failed: {str(e)}")
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        """Stop running the function
+
+        :return: None
+        """
+        self._stopped.set()
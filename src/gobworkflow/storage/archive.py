@@ -0,0 +1,136 @@
+"""Log archive
+
+The logs of jobs that have ended more than LOG_ARCHIVE_AGE days ago are moved out of the logs table.
+
+The logs of each job are written to a gzip compressed ndjson file in LOG_ARCHIVE_DIR.
+The log_archives table registers for each archived job where its logs have been stored.
+Writing the archive entry and deleting the logs from the logs table is done in one transaction.
+"""
+import datetime
+import gzip
+import json
+import os
+
+from sqlalchemy import select, and_, exists
+
+from gobcore.model.sa.management import Job, Log
+
+from gobworkflow.config import LOG_ARCHIVE_AGE, LOG_ARCHIVE_DIR
+from gobworkflow.storage import storage
+from gobworkflow.storage.storage import session_auto_reconnect, log_to_json
+from gobworkflow.storage.tables import log_archives
+
+ARCHIVE_INTERVAL = 60 * 60  # Duration in seconds between two archive runs
+ARCHIVE_BATCH_SIZE = 100  # Maximum number of jobs to archive in one run
+
+
+def _archive_path(jobid):
+    return os.path.join(LOG_ARCHIVE_DIR, f"{jobid}.ndjson.gz")
+
+
+def _write_archive(connection, jobid, path):
+    """Write all logs of a job to a compressed ndjson file
+
+    The logs are read using a server side cursor so that only a small part of the logs is in memory at any time
+
+    :param connection: database connection
+    :param jobid: the id of the job
+    :param path: the path of the archive file
+    :return: the number of logs that have been written
+    """
+    logs = Log.__table__
+    query = select([logs]).where(logs.c.jobid == jobid).order_by(logs.c.logid)
+    result = connection.execution_options(stream_results=True).execute(query)
+
+    count = 0
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, 'wt') as file:
+        for row in result:
+            file.write(log_to_json(row) + '\n')
+            count += 1
+    os.replace(tmp_path, path)
+    return count
+
+
+@session_auto_reconnect
+def archive_job_logs(jobid):
+    """Archive the logs of a job
+
+    :param jobid: the id of the job
+    :return: the number of logs that have been archived
+    """
+    logs = Log.__table__
+    path = _archive_path(jobid)
+    with storage.engine.begin() as connection:
+        count = _write_archive(connection, jobid, path)
+        connection.execute(log_archives.insert().values(
+            jobid=jobid,
+            path=path,
+            count=count,
+            timestamp=datetime.datetime.now()
+        ))
+        connection.execute(logs.delete().where(logs.c.jobid == jobid))
+    return count
+
+
+@session_auto_reconnect
+def get_jobs_to_archive(ended_before, limit=ARCHIVE_BATCH_SIZE):
+    """Get the jobs that have ended before the given time and that have not yet been archived
+
+    :param ended_before: the end time before which the jobs have ended
+    :param limit: the maximum number of jobs to return
+    :return: list of job ids
+    """
+    jobs = Job.__table__
+    query = select([jobs.c.id]) \
+        .where(and_(jobs.c.end < ended_before, ~exists().where(log_archives.c.jobid == jobs.c.id))) \
+        .order_by(jobs.c.id) \
+        .limit(limit)
+    with storage.engine.connect() as connection:
+        return [jobid for jobid, in connection.execute(query)]
+
+
+def archive_logs():
+    """Archive the logs of all jobs that have ended more than LOG_ARCHIVE_AGE days ago
+
+    At most ARCHIVE_BATCH_SIZE jobs are archived in one run
+
+    :return: None
+    """
+    if not LOG_ARCHIVE_AGE:
+        return
+
+    # Job end times are in UTC
+    ended_before = datetime.datetime.utcnow() - datetime.timedelta(days=LOG_ARCHIVE_AGE)
+    os.makedirs(LOG_ARCHIVE_DIR, exist_ok=True)
+    for jobid in get_jobs_to_archive(ended_before):
+        count = archive_job_logs(jobid)
+        print(f"Archived {count} logs of job {jobid}")
+
+
+@session_auto_reconnect
+def get_log_archive(jobid):
+    """Get the archive entry for a job
+
+    :param jobid: the id of the job
+    :return: the log_archives row for the job or None if the logs of the job have not been archived
+    """
+    with storage.engine.connect() as connection:
+        return connection.execute(log_archives.select().where(log_archives.c.jobid == jobid)).first()
+
+
+def read_archived_logs(jobid):
+    """Read the archived logs of a job
+
+    The logs are streamed from the archive file
+
+    :param jobid: the id of the job
+    :return: generator of log dicts in logid order, nothing if the logs of the job have not been archived
+    """
+    archive = get_log_archive(jobid)
+    if archive is None:
+        return
+
+    with gzip.open(archive.path, 'rt') as file:
+        for line in file:
+            yield json.loads(line)
@@ -8,8 +8,12 @@ This might for instance trying to execute a rollback for when the wrapper is use
 
 On a regular interval (RECONNECT_INTERVAL) the wrapper will try to restore the connection.
 When the connection is restored, the failed command is re-executed
+
+The connection may be shared by multiple threads. Reconnects are serialized,
+a thread that has waited for the reconnect of another thread only retries its command.
 """
 import functools
+import threading
 from time import sleep
 
 RECONNECT_INTERVAL = 60  # Duration in seconds to try to reconnect
@@ -34,8 +38,20 @@ class AutoReconnector:
         self.is_connected = is_connected
         self.connect = connect
         self.disconnect = disconnect
+        self._lock = threading.Lock()
 
     def reconnect(self, try_times=MAX_TRY_RECONNECT):
+        """Reconnect, one thread at a time
+
+        The connection is not restored again when another thread has restored it in the meantime
+
+        :return:
+        """
+        with self._lock:
+            if not self.is_connected():
+                self._reconnect(try_times)
+
+    def _reconnect(self, try_times):
         """Reconnect
 
         First the connection is closed. This allows for cleanup the connection data and probably do some error recovery
@@ -58,7 +74,7 @@ class AutoReconnector:
                 raise TooManyReconnectsException("Maximum number of reconnects retries reached")
             print(f"Try to reconnect in {RECONNECT_INTERVAL} seconds...")
             sleep(RECONNECT_INTERVAL)
-            self.reconnect(try_times)  # Try again...
+            self._reconnect(try_times)  # Try again...
 
     def exec(self, func, *args, **kwargs):
         """Execute a method and catch any connection problems
@@ -0,0 +1,213 @@
+"""Bulk writer
+
+Log and audit log messages are written to the database with COPY ... FROM STDIN,
+which is much faster than inserting the rows one by one or even in batches.
+
+COPY is all or nothing. If it fails, the rows are inserted one by one so that
+only the rows that cannot be stored are lost, not the whole batch.
+Messages that cannot be converted to a row (eg an invalid timestamp) are skipped.
+
+The log counts are updated in the same transaction as the logs are stored.
+"""
+import datetime
+import io
+import json
+import os
+
+import psycopg2
+from sqlalchemy import JSON
+from sqlalchemy.exc import DBAPIError
+
+from gobcore.typesystem.json import GobTypeJSONEncoder
+from gobcore.model.sa.management import Log, AuditLog
+
+from gobworkflow.config import LOG_BATCH_SIZE, LOG_SPOOL_ROOT, LOG_SPOOL_DIR
+from gobworkflow.storage import storage
+from gobworkflow.storage.spool import Spool, replay_orphaned_spool_dirs
+from gobworkflow.storage.storage import spool_logs, spool_audit_logs, log_spool, audit_log_spool, \
+    update_log_counts, _column_values, _log_values, _audit_log_values
+
+SPOOL_REPLAY_INTERVAL = 10  # Duration in seconds between two checks for spooled messages to replay
+
+# Characters that need to be escaped in the COPY text format
+_COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
+
+_COPY_NULL = '\\N'
+
+
+def _copy_value(column, value):
+    """Convert a value to its COPY text representation
+
+    JSON columns are encoded in the same way as SQLAlchemy does when the value is stored via the model
+
+    :param column: the table column that will hold the value
+    :param value: the value to convert
+    :return: the COPY text representation of the value
+    """
+    if value is None:
+        return _COPY_NULL
+    if isinstance(column.type, JSON):
+        value = json.dumps(value, cls=GobTypeJSONEncoder)
+    elif isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def _copy_data(table, columns, rows):
+    """Get the COPY text data for the given rows
+
+    :param table: the table to copy the rows into
+    :param columns: the names of the columns to copy
+    :param rows: list of dicts with column values
+    :return: file like object with the COPY data
+    """
+    data = io.StringIO()
+    for row in rows:
+        data.write('\t'.join(_copy_value(table.c[column], row[column]) for column in columns))
+        data.write('\n')
+    data.seek(0)
+    return data
+
+
+def _copy(table, rows, on_save=None):
+    """Copy rows into a table in one transaction
+
+    :param table: the table to copy the rows into
+    :param rows: list of dicts with column values, all having the same keys
+    :param on_save: optional function(connection, rows) that is called within the copy transaction
+    :return: None
+    """
+    columns = list(rows[0].keys())
+    data = _copy_data(table, columns, rows)
+
+    with storage.engine.begin() as connection:
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN", data)
+        if on_save:
+            on_save(connection, rows)
+
+
+def _insert_rows(table, rows, on_save=None):
+    """Insert rows one by one, each in its own transaction
+
+    Rows that cannot be inserted are skipped.
+    Connection problems are raised so that the whole batch can be retried.
+
+    :param table: the table to insert the rows into
+    :param rows: list of dicts with column values
+    :param on_save: optional function(connection, rows) that is called within the transaction of each row
+    :return: None
+    """
+    for row in rows:
+        try:
+            with storage.engine.begin() as connection:
+                connection.execute(table.insert().values(row))
+                if on_save:
+                    on_save(connection, [row])
+        except DBAPIError as e:
+            if not storage.is_connected():
+                raise e
+            print(f"Skip row for {table.name}: {str(e)}")
+
+
+def _to_rows(model, get_values, msgs):
+    """Convert messages to table rows
+
+    Messages that cannot be converted are skipped.
+
+    :param model: the model class of the rows
+    :param get_values: function that gets the model attribute values for a message
+    :param msgs: list of messages
+    :return: list of dicts with column values
+    """
+    rows = []
+    for msg in msgs:
+        try:
+            rows.append(_column_values(model, get_values(msg)))
+        except Exception as e:
+            print(f"Skip invalid message for {model.__tablename__}: {str(e)}")
+    return rows
+
+
+def _bulk_save(model, get_values, msgs, on_save=None):
+    """Save messages using COPY, fall back to row inserts if COPY fails
+
+    :param model: the model class of the rows
+    :param get_values: function that gets the model attribute values for a message
+    :param msgs: list of messages
+    :param on_save: optional function(connection, rows) that is called in the transaction that saves the rows
+    :return: None
+    """
+    rows = _to_rows(model, get_values, msgs)
+    if not rows:
+        return
+
+    try:
+        _copy(model.__table__, rows, on_save)
+    except (psycopg2.Error, DBAPIError) as e:
+        print(f"Copy into {model.__tablename__} failed, insert rows one by one: {str(e)}")
+        _insert_rows(model.__table__, rows, on_save)
+
+
+def _copy_logs(msgs):
+    """Save a batch of log messages and update the log counts
+
+    :param msgs: list of log messages
+    :return: None
+    """
+    _bulk_save(Log, _log_values, msgs, on_save=update_log_counts)
+
+
+def _copy_audit_logs(msgs):
+    """Save a batch of audit log messages
+
+    :param msgs: list of audit log messages
+    :return: None
+    """
+    _bulk_save(AuditLog, _audit_log_values, msgs)
+
+
+# While the database is unreachable the messages are spooled
+copy_logs = spool_logs(_copy_logs)
+copy_audit_logs = spool_audit_logs(_copy_audit_logs)
+
+
+def _replay(spools):
+    """Replay spools
+
+    :param spools: list of (spool, function that saves a list of messages)
+    :return: None
+    """
+    for spool, save in spools:
+        count = spool.replay(save, LOG_BATCH_SIZE)
+        if count:
+            print(f"Replayed {count} spooled messages from {spool.path}")
+
+
+def _replay_spool_dir(path):
+    """Replay the spools in the spool directory of another instance
+
+    :param path: the path of the spool directory
+    :return: None
+    """
+    _replay([(Spool(os.path.join(path, os.path.basename(spool.path))), save)
+             for spool, save in [(log_spool, _copy_logs), (audit_log_spool, _copy_audit_logs)]])
+
+
+def replay_spools():
+    """Save the spooled log messages once the database is reachable
+
+    The spools of instances that have stopped are replayed as well
+
+    :return: None
+    """
+    if not (storage.is_connected() or storage.connect()):
+        return
+
+    _replay([(log_spool, _copy_logs), (audit_log_spool, _copy_audit_logs)])
+    replay_orphaned_spool_dirs(LOG_SPOOL_ROOT, LOG_SPOOL_DIR, _replay_spool_dir)
@@ -0,0 +1,66 @@
+"""Buffered log writer
+
+Log messages arrive one at a time but they are stored most efficiently in bulk.
+
+The buffered writer collects messages and saves them in one go
+when either the buffer is full or the oldest message in the buffer has been waiting long enough.
+"""
+import time
+
+
+class BufferedWriter:
+
+    def __init__(self, save, max_size, max_wait):
+        """Constructor
+
+        :param save: Function that saves a list of messages
+        :param max_size: Save the messages when the buffer contains max_size messages
+        :param max_wait: Save the messages when the oldest message has been waiting max_wait seconds
+        """
+        self.save = save
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._buffer = []
+        self._since = None
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def add(self, msg):
+        """Add a message to the buffer
+
+        :param msg: the message to save
+        :return: None
+        """
+        if not self._buffer:
+            self._since = time.monotonic()
+        self._buffer.append(msg)
+
+    def is_due(self):
+        """Tells whether the buffer should be flushed
+
+        :return: True when the buffer is full or when its oldest message has waited long enough
+        """
+        if not self._buffer:
+            return False
+        return len(self._buffer) >= self.max_size or time.monotonic() - self._since >= self.max_wait
+
+    def discard(self):
+        """Empty the buffer without saving its messages
+
+        :return: None
+        """
+        self._buffer = []
+
+    def flush(self):
+        """Save all buffered messages
+
+        The buffer is emptied, also when saving fails.
+        The caller is responsible for having the messages of a failed flush redelivered.
+
+        :return: the number of messages that have been saved
+        """
+        msgs, self._buffer = self._buffer, []
+        if msgs:
+            self.save(msgs)
+        return len(msgs)
@@ -0,0 +1,85 @@
+"""Log reader
+
+Reads the logs of a job or of a single step of a job.
+
+Logs are read in pages using keyset pagination on logid, newest logs first.
+Each page starts below the lowest logid of the previous page, so reading a page
+does not depend on the number of preceding pages (as with OFFSET) and can use the ix_logs_logid_desc index.
+
+All logs of a job can also be streamed through a server side cursor,
+so that only a small part of the logs is in memory at any time.
+"""
+from sqlalchemy import select, and_
+
+from gobcore.model.sa.management import Log
+
+from gobworkflow.storage import storage
+from gobworkflow.storage.storage import session_auto_reconnect, log_to_json
+from gobworkflow.storage.archive import get_log_archive, read_archived_logs
+
+LOG_PAGE_SIZE = 1000  # Default number of logs in a page
+
+
+def _logs_filter(jobid, stepid):
+    logs = Log.__table__
+    condition = logs.c.jobid == jobid
+    if stepid is not None:
+        condition = and_(condition, logs.c.stepid == stepid)
+    return condition
+
+
+@session_auto_reconnect
+def get_logs(jobid, stepid=None, before=None, limit=LOG_PAGE_SIZE):
+    """Get a page of logs of a job or step, newest logs first
+
+    :param jobid: the id of the job
+    :param stepid: the id of the step, if None the logs of all steps of the job are returned
+    :param before: only return logs with a logid below this logid, if None the page starts at the newest log
+    :param limit: the maximum number of logs in the page
+    :return: tuple (logs, next) with the logs as dicts and the value of before for the next page,
+        next is None when there are no more logs
+    """
+    logs = Log.__table__
+    condition = _logs_filter(jobid, stepid)
+    if before is not None:
+        condition = and_(condition, logs.c.logid < before)
+    query = select([logs]).where(condition).order_by(logs.c.logid.desc()).limit(limit)
+
+    with storage.engine.connect() as connection:
+        rows = [dict(row) for row in connection.execute(query)]
+    return rows, rows[-1]['logid'] if len(rows) == limit else None
+
+
+def stream_logs(jobid, stepid=None):
+    """Stream all logs of a job or step in logid order
+
+    The logs of archived jobs are read from the archive
+
+    :param jobid: the id of the job
+    :param stepid: the id of the step, if None the logs of all steps of the job are returned
+    :return: generator of log dicts
+    """
+    if get_log_archive(jobid) is not None:
+        yield from (log for log in read_archived_logs(jobid) if stepid is None or log['stepid'] == stepid)
+        return
+
+    logs = Log.__table__
+    query = select([logs]).where(_logs_filter(jobid, stepid)).order_by(logs.c.logid)
+    with storage.engine.connect() as connection:
+        for row in connection.execution_options(stream_results=True).execute(query):
+            yield dict(row)
+
+
+def export_logs(jobid, file, stepid=None):
+    """Write all logs of a job or step to a file as ndjson
+
+    :param jobid: the id of the job
+    :param file: the file to write to
+    :param stepid: the id of the step, if None the logs of all steps of the job are written
+    :return: the number of logs that have been written
+    """
+    count = 0
+    for log in stream_logs(jobid, stepid):
+        file.write(log_to_json(log) + '\n')
+        count += 1
+    return count
@@ -0,0 +1,101 @@
+"""Log partitions
+
+The logs table is partitioned by month on timestamp.
+Monthly partitions are named logs_yYYYYmMM, eg logs_y2020m06.
+
+Partition maintenance makes sure that partitions exist for the coming months
+and detaches partitions that are older than the retention period.
+Detached partitions are regular tables that can be archived or dropped.
+"""
+import datetime
+import re
+
+from gobworkflow.config import LOG_PARTITION_RETENTION
+from gobworkflow.storage import storage
+from gobworkflow.storage.storage import session_auto_reconnect
+
+PARTITIONS_AHEAD = 2  # Create partitions for the next PARTITIONS_AHEAD months
+MAINTENANCE_INTERVAL = 60 * 60  # Duration in seconds between two partition maintenance runs
+
+_PARTITION_NAME = re.compile(r"^logs_y(\d{4})m(\d{2})$")
+
+
+def _add_months(month, n):
+    """Add n months to the given month
+
+    :param month: date of the first day of a month
+    :param n: number of months to add, may be negative
+    :return: date of the first day of the resulting month
+    """
+    index = month.year * 12 + month.month - 1 + n
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def _partition_name(month):
+    return f"logs_y{month.year}m{month.month:02d}"
+
+
+def _get_partitions(connection):
+    """Get the monthly partitions of the logs table
+
+    :param connection: database connection
+    :return: sorted list with the first day of the month of each monthly partition
+    """
+    rows = connection.execute("""
+SELECT child.relname
+FROM   pg_inherits
+JOIN   pg_class parent ON parent.oid = pg_inherits.inhparent
+JOIN   pg_class child ON child.oid = pg_inherits.inhrelid
+WHERE  parent.relname = 'logs'
+""")
+    matches = [_PARTITION_NAME.match(name) for name, in rows]
+    return sorted(datetime.date(int(match.group(1)), int(match.group(2)), 1) for match in matches if match)
+
+
+def _create_partitions(connection, partitions, this_month):
+    """Create the partitions for the coming months
+
+    Partitions are only created after the last existing partition to prevent overlap with the legacy partition
+
+    :param connection: database connection
+    :param partitions: the existing monthly partitions
+    :param this_month: the first day of the current month
+    :return: None
+    """
+    month = _add_months(partitions[-1] if partitions else this_month, 1)
+    last = _add_months(this_month, PARTITIONS_AHEAD)
+    while month <= last:
+        print(f"Create log partition {_partition_name(month)}")
+        connection.execute(f"CREATE TABLE {_partition_name(month)} PARTITION OF logs "
+                           f"FOR VALUES FROM ('{month}') TO ('{_add_months(month, 1)}')")
+        month = _add_months(month, 1)
+
+
+def _detach_partitions(connection, partitions, this_month):
+    """Detach the partitions that are older than the retention period
+
+    :param connection: database connection
+    :param partitions: the existing monthly partitions
+    :param this_month: the first day of the current month
+    :return: None
+    """
+    if not LOG_PARTITION_RETENTION:
+        return
+
+    oldest = _add_months(this_month, -LOG_PARTITION_RETENTION)
+    for month in [month for month in partitions if month < oldest]:
+        print(f"Detach log partition {_partition_name(month)}")
+        connection.execute(f"ALTER TABLE logs DETACH PARTITION {_partition_name(month)}")
+
+
+@session_auto_reconnect
+def maintain_log_partitions():
+    """Create upcoming and detach old partitions of the logs table
+
+    :return: None
+    """
+    this_month = datetime.date.today().replace(day=1)
+    with storage.engine.begin() as connection:
+        partitions = _get_partitions(connection)
+        _create_partitions(connection, partitions, this_month)
+        _detach_partitions(connection, partitions, this_month)
@@ -0,0 +1,218 @@
+"""Spool
+
+A spool is an append-only ndjson file that holds messages that could not be stored
+because the connection with the storage was lost.
+
+While a spool holds messages, new messages are appended to the spool without trying the storage first.
+This keeps the order of the messages and prevents waiting for connection timeouts on every message.
+
+When the connection is restored the spool is replayed, ie its messages are stored in batches.
+During replay new messages are stored directly again.
+Messages are replayed at least once; if replay is interrupted the whole spool will be replayed again.
+
+Every instance spools to its own directory and holds a lock on it while it runs.
+The directories of instances that have stopped, eg after a redeploy, are no longer locked.
+They are claimed and replayed by any running instance.
+"""
+import fcntl
+import functools
+import json
+import os
+import shutil
+import threading
+
+LOCK_FILE = '.lock'
+
+
+def _read_batches(file, batch_size):
+    """Read the messages from a spool file in batches
+
+    Lines that cannot be decoded, eg a line that was being written when the process stopped, are skipped
+
+    :param file: the spool file
+    :param batch_size: the maximum number of messages in a batch
+    :return: generator of lists of messages
+    """
+    batch = []
+    for line in file:
+        try:
+            batch.append(json.loads(line))
+        except ValueError as e:
+            print(f"Skip invalid spooled message: {str(e)}")
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Spool:
+
+    def __init__(self, path):
+        """Constructor
+
+        :param path: the path of the spool file
+        """
+        self.path = path
+        self.replay_path = f"{path}.replay"
+        self._lock = threading.Lock()
+
+    def is_active(self):
+        """Tells whether the spool holds messages that have not yet been replayed
+
+        :return: True if new messages should be appended to the spool
+        """
+        return os.path.exists(self.path)
+
+    def append(self, msgs):
+        """Append messages to the spool
+
+        :param msgs: a single message or a list of messages
+        :return: None
+        """
+        msgs = msgs if isinstance(msgs, list) else [msgs]
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a') as file:
+                for msg in msgs:
+                    file.write(json.dumps(msg) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+
+    def exec(self, func, msgs, is_connected):
+        """Store messages, append them to the spool if the storage is unreachable
+
+        :param func: the function that stores the messages
+        :param msgs: a single message or a list of messages
+        :param is_connected: Function that tells whether the connection is alive and working OK
+        :return: the function result, None if the messages have been spooled
+        """
+        if not self.is_active():
+            try:
+                return func(msgs)
+            except Exception as e:
+                if is_connected():
+                    raise e
+                print(f"Connection problem, spool messages: {str(e)}")
+        self.append(msgs)
+
+    def _start_replay(self):
+        """Move the spool file aside so that new messages are no longer appended to it
+
+        A spool file of an earlier replay that did not complete is replayed first
+
+        :return: True if there is anything to replay
+        """
+        with self._lock:
+            if not os.path.exists(self.replay_path) and os.path.exists(self.path):
+                os.replace(self.path, self.replay_path)
+            return os.path.exists(self.replay_path)
+
+    def replay(self, save, batch_size):
+        """Replay the spool
+
+        If saving fails the spool is kept to be replayed again
+
+        :param save: function that saves a list of messages
+        :param batch_size: the maximum number of messages to save at once
+        :return: the number of messages that have been replayed
+        """
+        if not self._start_replay():
+            return 0
+
+        count = 0
+        with open(self.replay_path) as file:
+            for batch in _read_batches(file, batch_size):
+                save(batch)
+                count += len(batch)
+        os.remove(self.replay_path)
+        return count
+
+
+def spool_wrapper(spool, is_connected):
+    """Spool wrapper
+
+    This function returns a wrapper for functions that store messages.
+    If the storage is unreachable, the messages are appended to the spool instead of being stored.
+
+    The wrapped function accepts either a single message or a list of messages.
+
+    :param spool: the spool to append the messages to
+    :param is_connected: Function that tells whether the connection is alive and working OK
+    :return: A wrapper function
+    """
+    def wrapper(func):
+        @functools.wraps(func)
+        def inner_wrapper(msgs):
+            return spool.exec(func, msgs, is_connected)
+
+        return inner_wrapper
+
+    return wrapper
+
+
+def _lock(path, blocking):
+    """Lock a spool directory
+
+    The lock is held until the returned file is closed or the process stops
+
+    :param path: the path of the spool directory
+    :param blocking: wait for the lock if it is held by another process
+    :return: the lock file, None if the directory is locked by another process
+    """
+    file = open(os.path.join(path, LOCK_FILE), 'a')
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        file.close()
+        return None
+    return file
+
+
+def lock_spool_dir(path):
+    """Lock the spool directory of this instance for as long as the instance runs
+
+    Waits while the directory is being replayed by another instance
+
+    :param path: the path of the spool directory
+    :return: the lock file, keep a reference to it to keep the lock
+    """
+    os.makedirs(path, exist_ok=True)
+    return _lock(path, blocking=True)
+
+
+def _spool_dirs(root, own):
+    """Get the spool directories of the other instances
+
+    :param root: the directory that holds the spool directories of all instances
+    :param own: the spool directory of this instance
+    :return: list of paths
+    """
+    if not os.path.isdir(root):
+        return []
+    paths = [os.path.join(root, name) for name in sorted(os.listdir(root))]
+    return [path for path in paths if os.path.isdir(path) and os.path.abspath(path) != os.path.abspath(own)]
+
+
+def replay_orphaned_spool_dirs(root, own, replay):
+    """Replay the spool directories of instances that have stopped
+
+    A directory that can be locked is no longer used by its instance.
+    It is replayed and removed while the lock is held, so it is replayed by only one instance.
+    If replay fails the directory is kept to be replayed again.
+
+    :param root: the directory that holds the spool directories of all instances
+    :param own: the spool directory of this instance
+    :param replay: function that replays the spools in a spool directory
+    :return: None
+    """
+    for path in _spool_dirs(root, own):
+        lock = _lock(path, blocking=False)
+        if lock is None:
+            # The instance is still running
+            continue
+        try:
+            replay(path)
+            shutil.rmtree(path)
+        finally:
+            lock.close()
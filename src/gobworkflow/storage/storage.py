@@ -2,35 +2,48 @@
 
 This module encapsulates the GOB Management storage.
 """
+import collections
 import datetime
+import functools
 import json
+import os
 
 from alembic.runtime import migration
 import alembic.config
 import alembic.script
 
-from sqlalchemy import create_engine, or_, and_
+from sqlalchemy import create_engine, inspect, or_, and_, any_, exists, select, text, tuple_
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import DBAPIError
 from sqlalchemy.engine.url import URL
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.sql import functions
 
+from gobcore.exceptions import GOBException
 from gobcore.typesystem.json import GobTypeJSONEncoder
 
-from gobcore.model.sa.management import Base, Job, JobStep, Log, Service, ServiceTask, Task, AuditLog
+from gobcore.model.sa.management import Base, Job, JobStep, Service, ServiceTask, Task
 
-from gobworkflow.config import GOB_MGMT_DB
+from gobworkflow.config import GOB_MGMT_DB, LOG_SPOOL_DIR, TASK_SUMMARY_SAMPLE_SIZE
 from gobworkflow.storage.auto_reconnect_wrapper import auto_reconnect_wrapper
+from gobworkflow.storage.spool import Spool, spool_wrapper
+from gobworkflow.storage.tables import log_counts, service_transitions, task_counts, task_durations, task_scheduling, \
+    waiting_tasks, SERVICE_UP, SERVICE_DOWN, SERVICE_REMOVED, THREAD_STARTED, THREAD_STOPPED, TASK_NEW, TASK_QUEUED, \
+    TASK_COMPLETED, TASK_END_STATUSES, TASK_SUMMARY_CATEGORIES
 
 session = None
 engine = None
 
+TASK_INSERT_BATCH_SIZE = 1000  # Maximum number of tasks in one insert statement
+
 
 def connect(force_migrate=False):
     """Module initialisation
 
     The connection with the underlying storage is initialised.
     Meta information is available via the Base variale.
-    Data retrieval is facilitated via the session object
+    Data retrieval is facilitated via the session object.
+    Every thread has its own session, see session_scope
 
     :return: True when the connection has been established
     """
@@ -44,7 +57,7 @@ def connect(force_migrate=False):
         # Declarative base model to create database tables and classes
         Base.metadata.bind = engine
 
-        session = Session(engine)
+        session = scoped_session(sessionmaker(bind=engine))
     except DBAPIError as e:
         # Catch any connection errors
         print(f"Connect failed: {str(e)}")
@@ -127,6 +140,8 @@ def is_connected():
     Tells whether the database connection is alive
 
     A simple statement is executed to test if the database communication is OK
+    The statement is executed on a connection of its own, not in the session of the current thread,
+    so that a failed transaction in one thread does not cause a reconnect for all threads
 
     :return: True when the database connection is OK
     """
@@ -134,168 +149,405 @@ def is_connected():
         return False
     else:
         try:
-            session.execute("SELECT 1")
+            with engine.connect() as connection:
+                connection.execute("SELECT 1")
             return True
         except Exception:
             return False
 
 
+def end_session():
+    """End the session of the current thread
+
+    Any open transaction is rolled back and all objects are removed from the identity map.
+    The next use of the session starts a new one.
+
+    :return: None
+    """
+    if session is not None:
+        session.remove()
+
+
+def session_scope(func):
+    """Run each call of func in its own session
+
+    Use it for message handlers so that the objects that are loaded while handling a message
+    do not stay in memory after the message has been handled.
+
+    :param func: the function to wrap
+    :return: the wrapped function
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            end_session()
+
+    return wrapper
+
+
 # Create a wrapper to protect database functions against connection loss
 # Any failed operation will automatically be retried when the connection becomes available again
 session_auto_reconnect = auto_reconnect_wrapper(is_connected=is_connected, connect=connect, disconnect=disconnect)
 
+# Log messages are not retried but spooled to file while the database is unreachable
+# The spools are replayed once the connection becomes available again, see bulk.replay_spools
+log_spool = Spool(os.path.join(LOG_SPOOL_DIR, 'logs.ndjson'))
+audit_log_spool = Spool(os.path.join(LOG_SPOOL_DIR, 'audit_logs.ndjson'))
+spool_logs = spool_wrapper(log_spool, is_connected=is_connected)
+spool_audit_logs = spool_wrapper(audit_log_spool, is_connected=is_connected)
 
-@session_auto_reconnect
-def save_log(msg):
+
+def _log_values(msg):
+    """Get the Log attribute values for a log message
+
+    :param msg: the log message
+    :return: dict with the Log attribute values
+    """
     # Encode the json data
     json_data = json.dumps(msg.get('data', None), cls=GobTypeJSONEncoder)
 
-    # Create the log record
-    record = Log(
-        timestamp=datetime.datetime.strptime(msg['timestamp'], '%Y-%m-%dT%H:%M:%S.%f'),
-        process_id=msg.get('process_id', None),
-        source=msg.get('source', None),
-        application=msg.get('application', None),
-        destination=msg.get('destination', None),
-        catalogue=msg.get('catalogue', None),
-        entity=msg.get('entity', None),
-        level=msg.get('level', None),
-        name=msg.get('name', None),
-        msgid=msg.get('id', None),
-        msg=msg.get('msg', None),
-        jobid=msg.get('jobid', None),
-        stepid=msg.get('stepid', None),
-        data=json_data,
-    )
-    session.add(record)
-    session.commit()
+    return {
+        'timestamp': datetime.datetime.strptime(msg['timestamp'], '%Y-%m-%dT%H:%M:%S.%f'),
+        'process_id': msg.get('process_id', None),
+        'source': msg.get('source', None),
+        'application': msg.get('application', None),
+        'destination': msg.get('destination', None),
+        'catalogue': msg.get('catalogue', None),
+        'entity': msg.get('entity', None),
+        'level': msg.get('level', None),
+        'name': msg.get('name', None),
+        'msgid': msg.get('id', None),
+        'msg': msg.get('msg', None),
+        'jobid': msg.get('jobid', None),
+        'stepid': msg.get('stepid', None),
+        'data': json_data,
+    }
+
+
+def log_to_json(log):
+    """Convert a log row to a json string
+
+    Used for the ndjson files of archived and exported logs
+
+    :param log: row from the logs table or a log dict
+    :return: json string
+    """
+    values = dict(log)
+    if isinstance(values['timestamp'], datetime.datetime):
+        values['timestamp'] = values['timestamp'].isoformat()
+    return json.dumps(values)
 
 
-@session_auto_reconnect
-def save_audit_log(msg):
-    record = AuditLog(
-        timestamp=datetime.datetime.strptime(msg['timestamp'], '%Y-%m-%dT%H:%M:%S.%f'),
-        source=msg.get('source'),
-        destination=msg.get('destination'),
-        type=msg.get('type'),
-        data=msg.get('data'),
-        request_uuid=msg.get('request_uuid'),
-    )
-    session.add(record)
-    session.commit()
+def _column_values(model, values):
+    """Translate model attribute values to table column values
 
+    Core statements address columns by column name, not by model attribute name (eg Log.msgid is column id)
 
-@session_auto_reconnect
-def get_services():
-    """Get services
+    :param model: the model class, eg Log
+    :param values: dict with attribute values
+    :return: dict with column values
+    """
+    mapper = inspect(model)
+    return {mapper.get_property(attr).columns[0].key: value for attr, value in values.items()}
 
-    :return: All current services (alive or dead)
+
+def _insert(model, values, on_insert=None):
+    """Insert a single row with a Core insert statement
+
+    The ORM unit of work (identity map registration, flush and expiry after commit) is bypassed.
+    Use it for records that are written but not read back via the session.
+
+    :param model: the model class, eg Log
+    :param values: dict with attribute values
+    :param on_insert: optional function(connection, rows) that is called within the insert transaction
+    :return: the primary key of the new row
     """
-    return session.query(Service).all()
+    table = model.__table__
+    row = _column_values(model, values)
+    statement = table.insert().values(row).returning(*table.primary_key.columns)
+    with engine.begin() as connection:
+        pk = connection.execute(statement).scalar()
+        if on_insert:
+            on_insert(connection, [row])
+        return pk
 
 
-@session_auto_reconnect
-def mark_service_dead(service):
-    """Mark a service as not being alive anymore
+def _log_level_counts(rows):
+    """Count log rows per job, step and level
+
+    Logs without a job, step or level are not counted
 
-    :param service: the service to mark as dead
+    :param rows: list of dicts with log column values
+    :return: Counter with the number of logs per (jobid, stepid, level)
+    """
+    keys = [(row.get('jobid'), row.get('stepid'), row.get('level')) for row in rows]
+    return collections.Counter(key for key in keys if None not in key)
+
+
+def update_log_counts(connection, rows):
+    """Add the given log rows to the log counts
+
+    All counts are updated with one upsert statement, to be executed in the transaction that stores the logs.
+    The counts are updated in key order so that concurrent updates cannot deadlock.
+
+    :param connection: database connection
+    :param rows: list of dicts with log column values
     :return: None
     """
-    # mark as dead
-    service.is_alive = False
-    # remove any tasks
-    _update_servicetasks(service, [])
+    counts = _log_level_counts(rows)
+    if not counts:
+        return
+
+    statement = insert(log_counts).values([
+        {'jobid': jobid, 'stepid': stepid, 'level': level, 'count': count}
+        for (jobid, stepid, level), count in sorted(counts.items())
+    ])
+    statement = statement.on_conflict_do_update(
+        index_elements=[log_counts.c.jobid, log_counts.c.stepid, log_counts.c.level],
+        set_={'count': log_counts.c.count + statement.excluded.count}
+    )
+    connection.execute(statement)
 
-    session.commit()
+
+@session_auto_reconnect
+def get_log_counts(jobid, stepid=None):
+    """Get the number of logs per level for a job or for a single step of a job
+
+    :param jobid: the id of the job
+    :param stepid: the id of the step, if None the counts of all steps of the job are summed
+    :return: dict with the number of logs per level
+    """
+    query = select([log_counts.c.level, functions.sum(log_counts.c.count)]) \
+        .where(log_counts.c.jobid == jobid) \
+        .group_by(log_counts.c.level)
+    if stepid is not None:
+        query = query.where(log_counts.c.stepid == stepid)
+    with engine.connect() as connection:
+        return {level: int(count) for level, count in connection.execute(query)}
+
+
+def _audit_log_values(msg):
+    """Get the AuditLog attribute values for an audit log message
+
+    :param msg: the audit log message
+    :return: dict with the AuditLog attribute values
+    """
+    return {
+        'timestamp': datetime.datetime.strptime(msg['timestamp'], '%Y-%m-%dT%H:%M:%S.%f'),
+        'source': msg.get('source'),
+        'destination': msg.get('destination'),
+        'type': msg.get('type'),
+        'data': msg.get('data'),
+        'request_uuid': msg.get('request_uuid'),
+    }
+
+
+# Refresh the timestamps of the services that are stored with the liveness of their last heartbeat
+_REFRESH_SERVICES = text("""
+UPDATE services
+SET    timestamp = GREATEST(services.timestamp, heartbeats.timestamp)
+FROM   unnest(CAST(:names AS varchar[]), CAST(:hosts AS varchar[]), CAST(:alive AS boolean[]),
+              CAST(:timestamps AS timestamp[]))
+       AS heartbeats(name, host, is_alive, timestamp)
+WHERE  services.name = heartbeats.name
+AND    services.host IS NOT DISTINCT FROM heartbeats.host
+AND    services.is_alive = heartbeats.is_alive
+RETURNING services.name, services.host
+""")
+
+# Mark the services that have timed out as dead, delete their tasks and record the transition
+_MARK_SERVICES_DEAD = text("""
+WITH dead AS (
+    UPDATE services
+    SET    is_alive = FALSE
+    WHERE  timestamp < :dead_before
+    AND    is_alive
+    RETURNING id, name, host
+), tasks AS (
+    DELETE FROM service_tasks
+    WHERE  service_id IN (SELECT id FROM dead)
+), transitions AS (
+    INSERT INTO service_transitions (timestamp, name, host, event)
+    SELECT timezone('utc', now()), name, host, :event FROM dead
+)
+SELECT name, host FROM dead
+""")
+
+# Remove the services that have finally timed out and their tasks and record the transition
+_REMOVE_SERVICES = text("""
+WITH removed AS (
+    DELETE FROM services
+    WHERE  timestamp < :remove_before
+    RETURNING id, name, host
+), tasks AS (
+    DELETE FROM service_tasks
+    WHERE  service_id IN (SELECT id FROM removed)
+), transitions AS (
+    INSERT INTO service_transitions (timestamp, name, host, event)
+    SELECT timezone('utc', now()), name, host, :event FROM removed
+)
+SELECT name, host FROM removed
+""")
 
 
 @session_auto_reconnect
-def remove_service(service):
-    """Remove a service
+def refresh_services(heartbeats):
+    """Refresh the timestamps of services with their last heartbeats, in one statement
 
-    :param service: the servie to remove
-    :return: None
+    Only services that are stored with the liveness of the heartbeat are refreshed.
+    The other services, eg services that have been marked as dead meanwhile, should be updated with update_services.
+
+    :param heartbeats: list of (name, host, is_alive, timestamp) with the last heartbeat of services
+    :return: set of (name, host) of the services that have been refreshed
     """
-    # remove any tasks
-    _update_servicetasks(service, [])
-    # remove service
-    session.query(Service) \
-        .filter(Service.host == service.host) \
-        .filter(Service.name == service.name) \
-        .delete()
+    if not heartbeats:
+        return set()
 
-    session.commit()
+    names, hosts, alive, timestamps = zip(*heartbeats)
+    with engine.begin() as connection:
+        return {tuple(row) for row in connection.execute(_REFRESH_SERVICES, names=list(names), hosts=list(hosts),
+                                                         alive=list(alive), timestamps=list(timestamps))}
 
 
 @session_auto_reconnect
-def update_service(service, tasks):
-    """Update service state in storage
+def sweep_services(dead_before, remove_before):
+    """Mark services as dead and remove services on heartbeat timeout
 
-    :param service:
-    :param tasks:
-    :return: None
+    All timed out services are handled with one statement for dead and one for removed services, in one transaction.
+    The timestamps of the services are up to date, every heartbeat is written through (see refresh_services),
+    whichever workflow instance has received it.
+
+    :param dead_before: services without a heartbeat since this time are marked as dead
+    :param remove_before: services without a heartbeat since this time are removed
+    :return: tuple (dead, removed) with lists of (name, host) of the services that have been marked dead and removed
     """
-    # Get the current service or create it if not yet exists
-    current = session.query(Service)\
-        .filter(or_(Service.host == service["host"], Service.host == None))\
-        .filter(Service.name == service["name"])\
-        .first()  # noqa: E711
-
-    if current:
-        current.is_alive = service["is_alive"]
-        current.timestamp = service["timestamp"]
-        current.host = service["host"]
-        current.pid = service["pid"]
-    else:
-        current = Service(**service)
-        session.add(current)
-        session.commit()
+    with engine.begin() as connection:
+        removed = [tuple(row) for row in connection.execute(_REMOVE_SERVICES,
+                                                            remove_before=remove_before, event=SERVICE_REMOVED)]
+        dead = [tuple(row) for row in connection.execute(_MARK_SERVICES_DEAD,
+                                                         dead_before=dead_before, event=SERVICE_DOWN)]
+    return dead, removed
 
-    # Update status with current tasks
-    _update_servicetasks(current, tasks)
 
-    session.commit()
+def _save_service(connection, service):
+    """Update a service or add it if it does not yet exist
+
+    A service is identified by its name and host, a service without host is taken over by the first host
+
+    :param connection: database connection
+    :param service: the service values
+    :return: tuple (id, was_alive) with the id of the service and its previous liveness, None for a new service
+    """
+    services = Service.__table__
+    previous = select([services.c.id, services.c.is_alive]) \
+        .where(and_(services.c.name == service["name"],
+                    or_(services.c.host == service["host"], services.c.host == None))) \
+        .limit(1) \
+        .with_for_update() \
+        .alias('previous')  # noqa: E711
+    row = connection.execute(services.update()
+                             .where(services.c.id == previous.c.id)
+                             .values(service)
+                             .returning(services.c.id, previous.c.is_alive)).first()
+    if row is None:
+        return connection.execute(services.insert().values(service).returning(services.c.id)).scalar(), None
+    return tuple(row)
+
+
+def _sync_servicetasks(connection, service_id, tasks):
+    """Synchronise the tasks of a service
+
+    The registered tasks are compared with the given tasks by name.
+    New and changed tasks are upserted in one statement, ended tasks are deleted in one statement.
+
+    :param connection: database connection
+    :param service_id: the id of the service
+    :param tasks: the current tasks of the service
+    :return: tuple (started, stopped) with the names of the tasks that have started and stopped
+    """
+    service_tasks = ServiceTask.__table__
+    current = dict(connection.execute(select([service_tasks.c.name, service_tasks.c.is_alive])
+                                      .where(service_tasks.c.service_id == service_id)).fetchall())
+    tasks = {task["name"]: task for task in tasks}
+
+    changed = [{**task, "service_id": service_id} for name, task in tasks.items()
+               if name not in current or current[name] != task["is_alive"]]
+    if changed:
+        statement = insert(service_tasks).values(changed)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[service_tasks.c.service_id, service_tasks.c.name],
+            set_={"is_alive": statement.excluded.is_alive}
+        ))
+
+    ended = current.keys() - tasks.keys()
+    if ended:
+        connection.execute(service_tasks.delete().where(and_(service_tasks.c.service_id == service_id,
+                                                             service_tasks.c.name.in_(ended))))
+
+    started = [task["name"] for task in changed if task["is_alive"] and not current.get(task["name"])]
+    stopped = [task["name"] for task in changed if not task["is_alive"] and current.get(task["name"])] + \
+        [name for name in ended if current[name]]
+    return started, stopped
+
+
+def _service_transitions(service, was_alive, started, stopped):
+    """Get the state changes of a service
+
+    A service that is down has no running tasks, its tasks are not reported as stopped
+
+    :param service: the service values
+    :param was_alive: the previous liveness of the service, None for a new service
+    :param started: the names of the tasks that have started
+    :param stopped: the names of the tasks that have stopped
+    :return: list of service_transitions rows
+    """
+    events = []
+    if bool(was_alive) != bool(service["is_alive"]):
+        events.append((SERVICE_UP if service["is_alive"] else SERVICE_DOWN, None))
+    if service["is_alive"]:
+        events.extend([(THREAD_STARTED, name) for name in sorted(started)] +
+                      [(THREAD_STOPPED, name) for name in sorted(stopped)])
+    return [{
+        "timestamp": service["timestamp"],
+        "name": service["name"],
+        "host": service["host"],
+        "event": event,
+        "task": task
+    } for event, task in events]
 
 
 @session_auto_reconnect
-def _update_servicetasks(service, tasks):
-    """Update tasks
+def update_services(services):
+    """Update the state of services in storage
 
-    Delete all current tasks that are not in tasks
-    Update or add all taska with the current status
+    All services and their tasks are updated in one transaction
+    Any state changes are recorded in the service transitions
 
-    :param current_tasks:
-    :param tasks:
-    :return:
+    :param services: list of (service values, current tasks of the service)
+    :return: None
     """
-    # Update db and refresh model
-    session.commit()
+    with engine.begin() as connection:
+        transitions = []
+        for service, tasks in services:
+            service_id, was_alive = _save_service(connection, service)
+            started, stopped = _sync_servicetasks(connection, service_id, tasks)
+            transitions.extend(_service_transitions(service, was_alive, started, stopped))
+        if transitions:
+            connection.execute(service_transitions.insert().values(transitions))
 
-    # Remove any dangling tasks
-    session.query(ServiceTask).filter(ServiceTask.service_id == None).delete()  # noqa: E711
-    session.commit()
 
-    # Get currently registered tasks for the service
-    current_tasks = session.query(ServiceTask).filter(ServiceTask.service_id == service.id).all()
-
-    # Delete tasks that have ended
-    for task in current_tasks:
-        matches = [t for t in tasks if t["name"] == task.name]
-        if len(matches) == 0:
-            session.delete(task)
-            session.commit()
+def update_service(service, tasks):
+    """Update service state in storage
 
-    # Add or update tasks that are active
-    for task in tasks:
-        matches = [t for t in current_tasks if t.name == task["name"]]
-        if len(matches) == 0:
-            task = ServiceTask(**task)
-            task.service_id = service.id
-            session.add(task)
-        else:
-            matches[0].is_alive = task["is_alive"]
+    The service and its tasks are updated in one transaction
 
-    # Commit is done by the caller
+    :param service: the service values
+    :param tasks: the current tasks of the service
+    :return: None
+    """
+    update_services([(service, tasks)])
 
 
 @session_auto_reconnect
@@ -333,12 +585,9 @@ def job_save(job_info):
     """
     Create Job using the information in job_info and store it
     :param job_info: Job attributes
-    :return: Job instance
+    :return: id of the new Job
     """
-    job = Job(**job_info)
-    session.add(job)
-    session.commit()
-    return job
+    return _insert(Job, job_info)
 
 
 @session_auto_reconnect
@@ -360,12 +609,9 @@ def step_save(step_info):
     """
     Create JobStep using the information in step_info and store it
     :param step_info: JobStep attributes
-    :return: JobStep instance
+    :return: id of the new JobStep
     """
-    step = JobStep(**step_info)
-    session.add(step)
-    session.commit()
-    return step
+    return _insert(JobStep, step_info)
 
 
 @session_auto_reconnect
@@ -392,59 +638,418 @@ def task_get(task_id):
     return session.query(Task).get(task_id)
 
 
+def tasks_save(stepid, tasks_info, levels):
+    """
+    Create all tasks of a jobstep in one transaction
+
+    The tasks are inserted with multi-row inserts of at most TASK_INSERT_BATCH_SIZE rows.
+    The jobstep is locked while the tasks are inserted, tasks are only created for a jobstep that has no tasks yet.
+    The task counts of the jobstep are initialised and the scheduling data of the tasks is stored
+    in the same transaction.
+
+    :param stepid: id of the jobstep
+    :param tasks_info: list of Task attributes, all having the same keys. Task names are unique within the jobstep
+    :param levels: dict with the topological level of each task by task name
+    :return: ids of the new Tasks in the order of tasks_info
+    """
+    ids = _insert_tasks(stepid, tasks_info, levels)
+    if ids is None:
+        raise GOBException(f"Already have tasks for jobstep {stepid}")
+    return ids
+
+
 @session_auto_reconnect
-def task_save(task_info):
+def _insert_tasks(stepid, tasks_info, levels):
     """
-    Create Task using the information in task_info and store it
+    Insert the tasks of a jobstep, see tasks_save
 
-    :param task_info:
-    :return:
+    :param stepid: id of the jobstep
+    :param tasks_info: list of Task attributes
+    :param levels: dict with the topological level of each task by task name
+    :return: ids of the new Tasks in the order of tasks_info, None if the jobstep already has tasks
     """
-    task = Task(**task_info)
-    session.add(task)
-    session.commit()
-    return task
+    tasks = Task.__table__
+    steps = JobStep.__table__
+    rows = [_column_values(Task, {**task_info, 'stepid': stepid}) for task_info in tasks_info]
+
+    ids = {}
+    with engine.begin() as connection:
+        connection.execute(select([steps.c.id]).where(steps.c.id == stepid).with_for_update())
+        existing = connection.execute(select([tasks.c.id]).where(tasks.c.stepid == stepid).limit(1)).first()
+        if existing is not None:
+            return None
+
+        for start in range(0, len(rows), TASK_INSERT_BATCH_SIZE):
+            batch = rows[start:start + TASK_INSERT_BATCH_SIZE]
+            result = connection.execute(tasks.insert().values(batch).returning(tasks.c.id, tasks.c.name))
+            batch_ids = {name: task_id for task_id, name in result}
+            connection.execute(task_scheduling.insert().values([
+                {'taskid': task_id, 'level': levels[name]} for name, task_id in batch_ids.items()]))
+            ids.update(batch_ids)
+
+        connection.execute(task_counts.insert().values(stepid=stepid, total=len(rows)))
+    return [ids[row['name']] for row in rows]
+
+
+def _count_ended_tasks(connection, stepid, status, count, summary=None):
+    """Add tasks that have ended with the given status to the task counts of a jobstep
+
+    The warnings and errors in the summary are counted as well.
+    They are added to the samples of the jobstep until the samples have reached TASK_SUMMARY_SAMPLE_SIZE items.
+
+    :param connection: the connection of the transaction in which the status of the tasks has changed
+    :param stepid: id of the jobstep
+    :param status: the new status of the tasks, only end statuses are counted
+    :param count: the number of tasks
+    :param summary: the summary of the task, if a single task has ended
+    :return: the task counts of the jobstep, None if nothing has been counted
+    """
+    if status not in TASK_END_STATUSES or not count:
+        return None
+
+    items = {category: (summary or {}).get(category) or [] for category in TASK_SUMMARY_CATEGORIES}
+    values = {task_counts.c[status]: task_counts.c[status] + count}
+    values.update({task_counts.c[category]: task_counts.c[category] + len(items[category])
+                   for category in TASK_SUMMARY_CATEGORIES if items[category]})
+    statement = task_counts.update() \
+        .where(task_counts.c.stepid == stepid) \
+        .values(values) \
+        .returning(*task_counts.columns)
+    row = connection.execute(statement).first()
+    if row is None:
+        return None
+    counts = dict(row)
+
+    # The row is locked by the update, the samples can safely be extended
+    samples = {f"{category}_sample": (counts[f"{category}_sample"] + items[category])[:TASK_SUMMARY_SAMPLE_SIZE]
+               for category in TASK_SUMMARY_CATEGORIES
+               if items[category] and len(counts[f"{category}_sample"]) < TASK_SUMMARY_SAMPLE_SIZE}
+    if samples:
+        connection.execute(task_counts.update().where(task_counts.c.stepid == stepid).values(samples))
+        counts.update(samples)
+    return counts
 
 
 @session_auto_reconnect
-def task_update(task_info):
+def task_end(task_info):
     """
-    Update JobStep using the information in step_info
-    :param step_info: JobStep attributes
-    :return: JobStep instance
+    Set the end status of a Task and count it in the task counts of its jobstep, in one transaction
+
+    Tasks that have already ended are not updated, so a result that is delivered twice is counted once.
+    The warnings and errors in the summary of the Task are aggregated in the task counts.
+
+    :param task_info: Task attributes, including the id, the end status and the summary
+    :return: the task counts of the jobstep after the update, None if the Task had already ended
     """
-    task = session.query(Task).get(task_info["id"])
-    for key, value in task_info.items():
-        setattr(task, key, value)
-    session.commit()
-    return task
+    tasks = Task.__table__
+    statement = tasks.update() \
+        .where(and_(tasks.c.id == task_info['id'], tasks.c.status.notin_(TASK_END_STATUSES))) \
+        .values(_column_values(Task, task_info)) \
+        .returning(tasks.c.stepid, tasks.c.key_prefix, tasks.c.name, tasks.c.start, tasks.c.end)
+    with engine.begin() as connection:
+        row = connection.execute(statement).first()
+        if row is None:
+            return None
+        if task_info['status'] == TASK_COMPLETED and row.start and row.end:
+            _record_duration(connection, row.key_prefix, row.name, (row.end - row.start).total_seconds())
+        return _count_ended_tasks(connection, row.stepid, task_info['status'], 1, task_info.get('summary'))
+
+
+def _record_duration(connection, key_prefix, name, duration):
+    """Add the duration of a completed task to the average duration of its key prefix and name
+
+    :param connection: the connection of the transaction in which the task is completed
+    :param key_prefix: the key prefix of the task
+    :param name: the name of the task
+    :param duration: the duration of the task in seconds
+    :return: None
+    """
+    statement = insert(task_durations).values(key_prefix=key_prefix, name=name, count=1, duration=duration)
+    statement = statement.on_conflict_do_update(
+        index_elements=[task_durations.c.key_prefix, task_durations.c.name],
+        set_={
+            'count': task_durations.c.count + 1,
+            'duration': task_durations.c.duration +
+            (statement.excluded.duration - task_durations.c.duration) / (task_durations.c.count + 1)
+        })
+    connection.execute(statement)
 
 
 @session_auto_reconnect
-def task_lock(task):
-    """Places the current timestamp in the 'lock' attribute of the Task.
+def get_task_durations(key_prefix):
+    """Get the average duration of the completed tasks with the given key prefix
 
-    :param task:
-    :return:
+    :param key_prefix: the key prefix of the tasks
+    :return: dict with the average duration in seconds by task name
     """
-    step_cnt = session.query(Task).filter(and_(Task.id == task.id, Task.lock == None)) \
-        .update({'lock': int(datetime.datetime.now().timestamp())})  # noqa: E711 (== None)
-    session.commit()
+    query = select([task_durations.c.name, task_durations.c.duration]).where(task_durations.c.key_prefix == key_prefix)
+    with engine.connect() as connection:
+        return {name: duration for name, duration in connection.execute(query)}
+
+
+@session_auto_reconnect
+def get_task_counts(stepid):
+    """Get the progress of the tasks of a jobstep
+
+    :param stepid: id of the jobstep
+    :return: dict with the total number of tasks, the number of completed, failed and aborted tasks
+        and the number and a sample of the warnings and errors, None if no tasks have been created for the jobstep
+    """
+    with engine.connect() as connection:
+        row = connection.execute(task_counts.select().where(task_counts.c.stepid == stepid)).first()
+    return dict(row) if row else None
+
+
+def _ready(tasks):
+    """Condition for new tasks of which all dependencies have been completed
 
-    return step_cnt > 0
+    The dependencies of a task are the names of other tasks in the same jobstep
+
+    :param tasks: the tasks table
+    :return: the condition
+    """
+    dependency = tasks.alias('dependency')
+    uncompleted = exists().where(and_(dependency.c.stepid == tasks.c.stepid,
+                                      dependency.c.name == any_(tasks.c.dependencies),
+                                      dependency.c.status != TASK_COMPLETED))
+    return and_(tasks.c.status == TASK_NEW, tasks.c.lock.is_(None), ~uncompleted)
 
 
 @session_auto_reconnect
-def task_unlock(task):
-    """Removes the lock from a Task
+def get_ready_tasks(stepid, names=None):
+    """Get the new tasks of a jobstep of which all dependencies have been completed
 
-    :param task:
-    :return:
+    The status of the dependencies is read from storage,
+    so completions that have been handled by any workflow instance are taken into account.
+
+    :param stepid: id of the jobstep
+    :param names: names of the tasks to check, None to check all tasks of the jobstep
+    :return: list of (id, name) of the ready tasks
     """
-    step_cnt = session.query(Task).filter(and_(Task.id == task.id, Task.lock != None)) \
-        .update({'lock': None})  # noqa: E711 (!= None)
-    session.commit()
-    assert step_cnt > 0, "Task was already unlocked. That can't be right."
+    if names is not None and not names:
+        return []
+
+    tasks = Task.__table__
+    condition = and_(tasks.c.stepid == stepid, _ready(tasks))
+    if names is not None:
+        condition = and_(condition, tasks.c.name.in_(names))
+    query = select([tasks.c.id, tasks.c.name]).where(condition)
+    with engine.connect() as connection:
+        return [(task_id, name) for task_id, name in connection.execute(query)]
+
+
+@session_auto_reconnect
+def tasks_wait(stepid, key_prefix, tasks):
+    """Register ready tasks of a jobstep that wait for the limits of their key prefix
+
+    Tasks that are already waiting are skipped, a task may be found ready by multiple workflow instances.
+
+    :param stepid: id of the jobstep
+    :param key_prefix: the key prefix of the tasks
+    :param tasks: list of (id, critical path, message priority) of the ready tasks
+    :return: None
+    """
+    if not tasks:
+        return
+
+    statement = insert(waiting_tasks).values([{
+        'taskid': task_id,
+        'stepid': stepid,
+        'key_prefix': key_prefix,
+        'path': path,
+        'priority': priority,
+    } for task_id, path, priority in tasks])
+    with engine.begin() as connection:
+        connection.execute(statement.on_conflict_do_nothing(index_elements=[waiting_tasks.c.taskid]))
+
+
+@session_auto_reconnect
+def tasks_claim_waiting(stepid, limit, values):
+    """Claim the waiting tasks of a jobstep, the tasks with the longest critical path first
+
+    At most limit tasks are selected with FOR UPDATE SKIP LOCKED, removed from the waiting tasks
+    and updated in one statement, so a task is claimed only once, also by concurrent workflow instances.
+    Waiting tasks that are no longer new are removed without being claimed.
+
+    :param stepid: id of the jobstep
+    :param limit: the maximum number of tasks to claim
+    :param values: the Task attributes to set on the claimed tasks, eg the new status
+    :return: the claimed tasks as rows with the updated values and their path and priority
+    """
+    tasks = Task.__table__
+    claimable = select([waiting_tasks.c.taskid]) \
+        .where(waiting_tasks.c.stepid == stepid) \
+        .order_by(waiting_tasks.c.path.desc()) \
+        .limit(limit) \
+        .with_for_update(skip_locked=True)
+    waiting = waiting_tasks.delete() \
+        .where(waiting_tasks.c.taskid.in_(claimable)) \
+        .returning(waiting_tasks.c.taskid, waiting_tasks.c.path, waiting_tasks.c.priority) \
+        .cte('waiting')
+    statement = tasks.update() \
+        .where(and_(tasks.c.id == waiting.c.taskid, tasks.c.status == TASK_NEW, tasks.c.lock.is_(None))) \
+        .values(_column_values(Task, values)) \
+        .returning(*tasks.columns, waiting.c.path, waiting.c.priority)
+    with engine.begin() as connection:
+        return connection.execute(statement).fetchall()
+
+
+@session_auto_reconnect
+def get_next_waiting_step(key_prefix, after=None):
+    """Get the next jobstep with the given key prefix that has waiting tasks
+
+    The jobsteps are visited in the order of their id, so older jobsteps are queued first.
+
+    :param key_prefix: the key prefix of the tasks
+    :param after: the id of the previous jobstep, None to get the first jobstep
+    :return: the id of the jobstep, None if no more jobsteps have waiting tasks
+    """
+    condition = waiting_tasks.c.key_prefix == key_prefix
+    if after is not None:
+        condition = and_(condition, waiting_tasks.c.stepid > after)
+    query = select([functions.min(waiting_tasks.c.stepid)]).where(condition)
+    with engine.connect() as connection:
+        return connection.execute(query).scalar()
+
+
+@session_auto_reconnect
+def count_queued_tasks(key_prefix, stepid):
+    """Count the queued tasks with the given key prefix
+
+    :param key_prefix: the key prefix of the tasks
+    :param stepid: id of the jobstep
+    :return: tuple (number of queued tasks, number of queued tasks of the jobstep)
+    """
+    tasks = Task.__table__
+    query = select([functions.count(), functions.count().filter(tasks.c.stepid == stepid)]) \
+        .where(and_(tasks.c.key_prefix == key_prefix, tasks.c.status == TASK_QUEUED))
+    with engine.connect() as connection:
+        return tuple(connection.execute(query).first())
+
+
+@session_auto_reconnect
+def get_queued_tasks(key_prefix, queued_before):
+    """Get the tasks with the given key prefix that have been queued before the given time and are still queued
+
+    :param key_prefix: the key prefix of the tasks
+    :param queued_before: the time before which the tasks have been queued
+    :return: the tasks as rows, including the number of retries of each task
+    """
+    tasks = Task.__table__
+    query = select([tasks, task_scheduling.c.retries]) \
+        .select_from(tasks.join(task_scheduling, task_scheduling.c.taskid == tasks.c.id)) \
+        .where(and_(tasks.c.key_prefix == key_prefix,
+                    tasks.c.status == TASK_QUEUED,
+                    tasks.c.start < queued_before))
+    with engine.connect() as connection:
+        return connection.execute(query).fetchall()
+
+
+@session_auto_reconnect
+def tasks_requeue(tasks, start):
+    """Register that queued tasks are published again
+
+    The number of retries of each task is incremented and its start is reset.
+    Only tasks that are still queued and that have not been requeued since they have been read are updated,
+    so a task is requeued only once, also when multiple workflow instances requeue tasks concurrently.
+
+    :param tasks: list of (id, retries) of the tasks as they have been read
+    :param start: the new start of the tasks
+    :return: the requeued tasks as rows with the updated values, including the number of retries
+    """
+    if not tasks:
+        return []
+
+    table = Task.__table__
+    condition = and_(table.c.id == task_scheduling.c.taskid, table.c.status == TASK_QUEUED)
+    requeued = task_scheduling.update() \
+        .where(and_(condition, tuple_(task_scheduling.c.taskid, task_scheduling.c.retries).in_(tasks))) \
+        .values(retries=task_scheduling.c.retries + 1) \
+        .returning(task_scheduling.c.taskid, task_scheduling.c.retries) \
+        .cte('requeued')
+    statement = table.update() \
+        .where(and_(table.c.id == requeued.c.taskid, table.c.status == TASK_QUEUED)) \
+        .values(start=start) \
+        .returning(*table.columns, requeued.c.retries)
+    with engine.begin() as connection:
+        return connection.execute(statement).fetchall()
+
+
+@session_auto_reconnect
+def tasks_unpublished(task_ids):
+    """Register that the requests of queued tasks have not been published
+
+    The start of the tasks is cleared, tasks that are no longer queued are skipped.
+
+    :param task_ids: the ids of the tasks
+    :return: None
+    """
+    table = Task.__table__
+    statement = table.update() \
+        .where(and_(table.c.status == TASK_QUEUED, table.c.id.in_(task_ids))) \
+        .values(start=None)
+    with engine.begin() as connection:
+        connection.execute(statement)
+
+
+@session_auto_reconnect
+def tasks_claim_unpublished(start):
+    """Claim the queued tasks of which the request has not been published, to publish them again
+
+    The tasks are selected with FOR UPDATE SKIP LOCKED and get the given start,
+    so a task is claimed only once, also when multiple workflow instances claim tasks concurrently.
+
+    :param start: the new start of the tasks
+    :return: the claimed tasks as rows with the updated values
+    """
+    table = Task.__table__
+    claimable = select([table.c.id]) \
+        .where(and_(table.c.status == TASK_QUEUED, table.c.start.is_(None))) \
+        .with_for_update(skip_locked=True)
+    statement = table.update() \
+        .where(table.c.id.in_(claimable)) \
+        .values(start=start) \
+        .returning(*table.columns)
+    with engine.begin() as connection:
+        return connection.execute(statement).fetchall()
+
+
+@session_auto_reconnect
+def tasks_claim(stepid, task_ids, status, values):
+    """
+    Atomically update the given tasks of a jobstep that still have the given status and are not locked
+
+    The tasks are selected with FOR UPDATE SKIP LOCKED and updated in one statement.
+    Tasks that are being claimed by another transaction are skipped,
+    so a task is claimed only once, also when multiple workflow instances claim tasks concurrently.
+    Tasks that get an end status are counted in the task counts of the jobstep in the same transaction
+    and are removed from the waiting tasks.
+
+    :param stepid: id of the jobstep
+    :param task_ids: ids of the tasks to claim, None to claim all tasks of the jobstep
+    :param status: the status the tasks should have to be claimed
+    :param values: the Task attributes to set on the claimed tasks, eg the new status
+    :return: the claimed tasks as rows with the updated values
+    """
+    if task_ids is not None and not task_ids:
+        return []
+
+    tasks = Task.__table__
+    condition = and_(tasks.c.stepid == stepid, tasks.c.status == status, tasks.c.lock.is_(None))
+    if task_ids is not None:
+        condition = and_(condition, tasks.c.id.in_(task_ids))
+    claimable = select([tasks.c.id]).where(condition).with_for_update(skip_locked=True)
+    statement = tasks.update() \
+        .where(tasks.c.id.in_(claimable)) \
+        .values(_column_values(Task, values)) \
+        .returning(*tasks.columns)
+    with engine.begin() as connection:
+        claimed = connection.execute(statement).fetchall()
+        if claimed and values.get('status') in TASK_END_STATUSES:
+            # Ended tasks no longer wait for the limits of their key prefix
+            connection.execute(waiting_tasks.delete().where(waiting_tasks.c.taskid.in_([task.id for task in claimed])))
+        _count_ended_tasks(connection, stepid, values.get('status'), len(claimed))
+    return claimed
 
 
 @session_auto_reconnect
@@ -0,0 +1,112 @@
+"""Workflow tables
+
+Tables in the management database that are maintained by the workflow service only.
+
+The tables are not part of the GOB management model, they are accessed with SQLAlchemy Core.
+They are registered in the metadata of the management model so that alembic is aware of them.
+
+Constraints and indexes that the workflow service relies on are not added to the tables of the management model.
+They are created by migrations only and are excluded from the comparison of the model with the database
+(alembic/env.py).
+"""
+from sqlalchemy import Table, Column, ForeignKey, Index, Integer, String, DateTime, Float, JSON
+
+from gobcore.model.sa.management import Base
+
+# Register where the logs of each archived job have been stored
+log_archives = Table(
+    'log_archives', Base.metadata,
+    Column('jobid', Integer, ForeignKey('jobs.id'), primary_key=True),
+    Column('path', String, nullable=False),
+    Column('count', Integer, nullable=False),
+    Column('timestamp', DateTime, nullable=False),
+)
+
+# Number of logs per job, step and level, maintained when the logs are stored
+# The ids are not foreign keys, like in the monthly log partitions
+log_counts = Table(
+    'log_counts', Base.metadata,
+    Column('jobid', Integer, primary_key=True),
+    Column('stepid', Integer, primary_key=True),
+    Column('level', String, primary_key=True),
+    Column('count', Integer, nullable=False),
+)
+
+# Append-only history of service state changes
+# event is one of SERVICE_UP, SERVICE_DOWN, SERVICE_REMOVED, THREAD_STARTED, THREAD_STOPPED, task is the thread name
+service_transitions = Table(
+    'service_transitions', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('timestamp', DateTime, nullable=False, index=True),
+    Column('name', String, nullable=False),
+    Column('host', String),
+    Column('event', String, nullable=False),
+    Column('task', String),
+)
+
+SERVICE_UP = 'up'
+SERVICE_DOWN = 'down'
+SERVICE_REMOVED = 'removed'
+THREAD_STARTED = 'thread started'
+THREAD_STOPPED = 'thread stopped'
+
+# Number of tasks per jobstep and the number of tasks that have ended, per end status
+# The counts are maintained in the transactions that create the tasks and that change their status to an end status
+# The end status columns are named after the task statuses, see TASK_END_STATUSES
+# The warnings and errors in the summaries of the ended tasks are counted and a sample of them is kept
+# The summary columns are named after the summary categories, see TASK_SUMMARY_CATEGORIES
+task_counts = Table(
+    'task_counts', Base.metadata,
+    Column('stepid', Integer, primary_key=True),
+    Column('total', Integer, nullable=False),
+    Column('completed', Integer, nullable=False, default=0),
+    Column('failed', Integer, nullable=False, default=0),
+    Column('aborted', Integer, nullable=False, default=0),
+    Column('warnings', Integer, nullable=False, default=0),
+    Column('errors', Integer, nullable=False, default=0),
+    Column('warnings_sample', JSON, nullable=False, default=[]),
+    Column('errors_sample', JSON, nullable=False, default=[]),
+)
+
+# Scheduling data of the tasks that is not part of the management model, one row per task
+# The row of a task is inserted in the transaction that creates the task and is deleted with the task
+# level is the topological level of the task within its jobstep, the length of the longest chain of dependencies
+# that precedes it. It is NULL for tasks that have been created before the levels were stored
+# retries is the number of times that a queued task has been published again because it did not end in time
+task_scheduling = Table(
+    'task_scheduling', Base.metadata,
+    Column('taskid', Integer, ForeignKey('tasks.id', ondelete='CASCADE'), primary_key=True),
+    Column('level', Integer),
+    Column('retries', Integer, nullable=False, server_default='0'),
+)
+
+# The ready tasks that are held back by the limits of their key prefix, see TASK_LIMITS and TASK_STEP_LIMITS
+# A task is added when it has become ready and is removed when it is queued or aborted
+# The waiting tasks of a jobstep are queued the task with the longest critical path first,
+# priority is the message priority of the task request
+waiting_tasks = Table(
+    'waiting_tasks', Base.metadata,
+    Column('taskid', Integer, ForeignKey('tasks.id', ondelete='CASCADE'), primary_key=True),
+    Column('stepid', Integer, nullable=False),
+    Column('key_prefix', String, nullable=False),
+    Column('path', Float, nullable=False),
+    Column('priority', Integer, nullable=False),
+    Index('ix_waiting_tasks_stepid_path', 'stepid', 'path'),
+    Index('ix_waiting_tasks_key_prefix_stepid', 'key_prefix', 'stepid'),
+)
+
+TASK_NEW = 'new'
+TASK_QUEUED = 'queued'
+TASK_COMPLETED = 'completed'
+TASK_END_STATUSES = (TASK_COMPLETED, 'failed', 'aborted')
+TASK_SUMMARY_CATEGORIES = ('warnings', 'errors')
+
+# Average duration in seconds of the completed tasks per key prefix and task name
+# The duration of a task is the time between queueing the task and storing its result
+task_durations = Table(
+    'task_durations', Base.metadata,
+    Column('key_prefix', String, primary_key=True),
+    Column('name', String, primary_key=True),
+    Column('count', Integer, nullable=False),
+    Column('duration', Float, nullable=False),
+)
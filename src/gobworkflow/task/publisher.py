@@ -0,0 +1,56 @@
+"""Batch publisher
+
+Publishes a batch of messages on one channel of one connection, with publisher confirms.
+
+For each message the publisher tells whether the message broker has confirmed the message.
+Messages that are nacked or that cannot be routed are not confirmed.
+If the connection fails, the messages that have not yet been confirmed are not confirmed.
+
+Large message contents are offloaded to a file, like for messages that are published via gobcore.
+"""
+import json
+
+import pika
+
+from pika.exceptions import AMQPError
+
+from gobcore.message_broker.config import CONNECTION_PARAMS
+from gobcore.message_broker.offline_contents import offload_message
+from gobcore.typesystem.json import GobTypeJSONEncoder
+
+
+# Persistent messages, like the messages that are published by the message driven service
+_PROPERTIES = pika.BasicProperties(delivery_mode=2)
+
+
+def _properties(priority):
+    return _PROPERTIES if priority is None else pika.BasicProperties(delivery_mode=2, priority=priority)
+
+
+def _to_json(msg):
+    return json.dumps(msg, cls=GobTypeJSONEncoder)
+
+
+def publish_batch(exchange, messages, priorities=None):
+    """Publish messages and wait for their confirmation
+
+    The priorities only have effect on queues that are declared with a maximum priority
+
+    :param exchange: the exchange to publish the messages on
+    :param messages: list of (key, msg)
+    :param priorities: optional list with the priority of the message at the same position
+    :return: list of booleans, True if the message at the same position has been confirmed
+    """
+    priorities = priorities or [None] * len(messages)
+    confirmed = []
+    try:
+        with pika.BlockingConnection(CONNECTION_PARAMS) as connection:
+            channel = connection.channel()
+            channel.confirm_delivery()
+            for (key, msg), priority in zip(messages, priorities):
+                body = _to_json(offload_message(msg, _to_json))
+                confirmed.append(channel.basic_publish(exchange, key, body,
+                                                       properties=_properties(priority), mandatory=True))
+    except AMQPError as e:
+        print(f"Publish to {exchange} failed: {str(e)}")
+    return confirmed + [False] * (len(messages) - len(confirmed))
@@ -1,13 +1,21 @@
 import json
-from datetime import datetime
-from gobworkflow.storage.storage import get_job_step, task_save, get_tasks_for_stepid, task_lock, task_unlock, \
-    task_get, task_update
+from datetime import datetime, timedelta
+from gobworkflow.storage.storage import get_job_step, tasks_save, tasks_claim, get_tasks_for_stepid, task_get, \
+    task_end, get_task_counts, get_task_durations, count_queued_tasks, get_queued_tasks, tasks_requeue, \
+    tasks_unpublished, tasks_claim_unpublished, get_ready_tasks, tasks_wait, tasks_claim_waiting, get_next_waiting_step
 from gobcore.exceptions import GOBException
 from gobcore.message_broker import publish
 from gobcore.message_broker.offline_contents import load_message
 
 from gobcore.message_broker.config import WORKFLOW_EXCHANGE, TASK_COMPLETE, TASK_REQUEST
 
+from gobworkflow.config import TASK_LIMITS, TASK_STEP_LIMITS, TASK_TIMEOUTS, TASK_MAX_ATTEMPTS
+from gobworkflow.task.publisher import publish_batch
+from gobworkflow.task.scheduler import Scheduler, StepGraph, topological_levels
+from gobworkflow.task.summary import write_details, complete_summary
+
+WATCHDOG_INTERVAL = 60  # Duration in seconds between two checks for queued tasks that have timed out
+
 
 class TaskQueue:
     """TaskQueue
@@ -34,6 +42,9 @@ class TaskQueue:
     STATUS_ABORTED = 'aborted'
     STATUS_FAILED = 'failed'
 
+    def __init__(self):
+        self.scheduler = Scheduler(self._load_graph)
+
     def on_start_tasks(self, msg):
         """Entry method for TaskQueue. Creates tasks and puts task messages on the
 
@@ -60,82 +71,210 @@ class TaskQueue:
         if not step:
             raise GOBException(f"No jobstep found with id {stepid}")
 
-        self._validate_dependencies(tasks)
-        self._create_tasks(jobid, stepid, process_id, tasks, key_prefix, extra_msg, extra_header)
-        self._queue_free_tasks_for_jobstep(stepid)
+        levels = self._validate_dependencies(tasks)
+        self._create_tasks(jobid, stepid, process_id, tasks, key_prefix, extra_msg, extra_header, levels)
+        self._queue_free_tasks_for_jobstep(stepid, key_prefix)
 
     def _validate_dependencies(self, tasks):
-        """Basic validation of dependencies. Assumes tasks is already ordered.
+        """Validation of dependencies. The tasks may be given in any order.
+
+        The tasks are sorted topologically, which gives the level of each task.
+        All missing dependencies and all cycles are reported at once.
 
         :param tasks:
-        :return:
+        :return: dict with the topological level of each task
         """
         ids = [task['id'] for task in tasks if 'id' in task]
         assert len(set(ids)) == len(tasks), "All tasks should have a unique id"
 
-        done = []
-
         for task in tasks:
             assert 'dependencies' in task
 
-            for dependency in task['dependencies']:
-                if dependency not in done:
-                    raise GOBException(f"Task {task['id']} depends on task {dependency}, but isn't executed yet")
+        levels, missing, cycles = topological_levels([(task['id'], task['dependencies']) for task in tasks])
+
+        errors = [f"Task {task_id} depends on task {dependency}, which does not exist"
+                  for task_id, dependency in missing]
+        position = {task_id: n for n, task_id in enumerate(ids)}
+        errors.extend(f"Tasks {', '.join(str(task_id) for task_id in sorted(cycle, key=position.get))} "
+                      "depend on each other" for cycle in cycles)
+        if errors:
+            raise GOBException(f"Invalid task dependencies: {'; '.join(errors)}")
 
-            done.append(task['id'])
+        return levels
 
-    def _create_tasks(self, jobid, stepid, process_id, tasks, key_prefix, extra_msg, extra_header):
+    def _create_tasks(self, jobid, stepid, process_id, tasks, key_prefix, extra_msg, extra_header, levels):
         """Create Task objects for the input list 'tasks'.
 
+        All tasks are stored in one transaction and registered in the scheduler.
+
         :param jobid:
         :param stepid:
         :param tasks:
         :param key_prefix:
         :param extra_msg:
+        :param levels: the topological level of each task
         :return:
         """
-        existing = get_tasks_for_stepid(stepid)
-        assert len(existing) == 0, f"Already have tasks for jobstep {stepid}"
+        task_defs = [{
+            'name': task['id'],
+            'dependencies': task['dependencies'],
+            'status': self.STATUS_NEW,
+            'jobid': jobid,
+            'key_prefix': key_prefix,
+            'extra_header': {
+                **extra_header,
+            },
+            'extra_msg': {
+                # Add global extra msg and extra_msg on task level
+                **extra_msg,
+                **task.get('extra_msg', {}),
+            },
+            'process_id': process_id,
+        } for task in tasks]
 
-        for task in tasks:
-            task_def = {
-                'name': task['id'],
-                'dependencies': task['dependencies'],
-                'status': self.STATUS_NEW,
-                'jobid': jobid,
-                'stepid': stepid,
-                'key_prefix': key_prefix,
-                'extra_header': {
-                    **extra_header,
-                },
-                'extra_msg': {
-                    # Add global extra msg and extra_msg on task level
-                    **extra_msg,
-                    **task.get('extra_msg', {}),
-                },
-                'process_id': process_id,
-            }
-            task_save(task_def)
+        # Fails if the jobstep already has tasks
+        tasks_save(stepid, task_defs, levels)
 
-    def _queue_free_tasks_for_jobstep(self, jobstep_id):
-        """Queues the free tasks for jobstep.
+        self.scheduler.add(stepid, StepGraph([(task['id'], task['dependencies']) for task in tasks],
+                                             durations=get_task_durations(key_prefix)))
+
+    def _load_graph(self, stepid):
+        """Builds the dependency graph of the tasks of a step from storage
+
+        The tasks of a step all have the same key prefix, the durations of earlier tasks with this prefix are used
+        to determine the critical paths.
 
         :param stepid:
         :return:
         """
-        tasks = get_tasks_for_stepid(jobstep_id)
+        tasks = get_tasks_for_stepid(stepid)
+        durations = get_task_durations(tasks[0].key_prefix) if tasks else {}
+        return StepGraph([(task.name, task.dependencies) for task in tasks], durations=durations)
+
+    def _free_slots(self, key_prefix, jobstep_id):
+        """Returns the number of tasks that can be queued for jobstep within the limits of its key prefix
+
+        The limits are checked before the tasks are claimed,
+        tasks that are claimed concurrently for the same key prefix may exceed the limits briefly.
+
+        :param key_prefix:
+        :param jobstep_id:
+        :return: the number of tasks that can be queued, None if the key prefix has no limits
+        """
+        limit = TASK_LIMITS.get(key_prefix)
+        step_limit = TASK_STEP_LIMITS.get(key_prefix)
+        if limit is None and step_limit is None:
+            return None
+
+        counts = zip((limit, step_limit), count_queued_tasks(key_prefix, jobstep_id))
+        return max(0, min(limit - queued for limit, queued in counts if limit is not None))
+
+    def _queue_free_tasks_for_jobstep(self, jobstep_id, key_prefix, completed=None):
+        """Queues the free tasks for jobstep.
+
+        The free tasks are the new tasks of which all dependencies have been completed in storage.
+        Only the dependents of a just completed task are checked.
+        When the key prefix has limits the free tasks are registered as waiting tasks,
+        they are queued from storage as long as there are free slots.
+
+        The free tasks are claimed in storage in one statement.
+        Tasks that are no longer new or that are claimed concurrently are skipped.
+        The task requests for the claimed tasks are published in one batch,
+        the tasks with the longest critical path first and with the highest priority.
+
+        :param jobstep_id:
+        :param key_prefix:
+        :param completed: name of the task that has just been completed
+        :return:
+        """
+        names = None if completed is None else self.scheduler.dependents(jobstep_id, completed)
+        ready = get_ready_tasks(jobstep_id, names)
+
+        if key_prefix in TASK_LIMITS or key_prefix in TASK_STEP_LIMITS:
+            tasks_wait(jobstep_id, key_prefix, self.scheduler.priorities(jobstep_id, ready))
+            self._queue_waiting_tasks_for_jobstep(jobstep_id, key_prefix)
+            return
+
+        released = self.scheduler.order(jobstep_id, ready)
+        if not released:
+            return
+
+        priorities = dict(released)
+        tasks = tasks_claim(jobstep_id, list(priorities), self.STATUS_NEW, {
+            'status': self.STATUS_QUEUED,
+            'start': datetime.now(),
+        })
+        if not tasks:
+            return
+
+        # The claimed tasks are returned in any order, restore the order of release
+        rank = {task_id: n for n, task_id in enumerate(priorities)}
+        tasks = sorted(tasks, key=lambda task: rank.get(task.id, len(rank)))
+        self._publish_requests(tasks, [priorities.get(task.id) for task in tasks])
+
+    def _queue_waiting_tasks_for_jobstep(self, jobstep_id, key_prefix):
+        """Queues the waiting tasks of jobstep within the limits of the key prefix
+
+        The waiting tasks are ordered and limited in storage, the tasks with the longest critical path first.
+
+        :param jobstep_id:
+        :param key_prefix:
+        :return:
+        """
+        limit = self._free_slots(key_prefix, jobstep_id)
+        if limit == 0:
+            return
+
+        tasks = tasks_claim_waiting(jobstep_id, limit, {
+            'status': self.STATUS_QUEUED,
+            'start': datetime.now(),
+        })
+        if not tasks:
+            return
+
+        # The claimed tasks are returned in any order, restore the order of the critical paths
+        tasks = sorted(tasks, key=lambda task: -task.path)
+        self._publish_requests(tasks, [task.priority for task in tasks])
+
+    def _publish_requests(self, tasks, priorities=None):
+        """Publishes the requests for queued tasks
+
+        Tasks of which the request has not been confirmed stay queued without a start,
+        the watchdog publishes their requests again.
+
+        :param tasks:
+        :param priorities: optional list with the priority of the task at the same position
+        :return:
+        """
+        confirmed = publish_batch(WORKFLOW_EXCHANGE, [self._task_request(task) for task in tasks], priorities)
+        unconfirmed = [task.id for task, is_confirmed in zip(tasks, confirmed) if not is_confirmed]
+        if unconfirmed:
+            print(f"{len(unconfirmed)} task requests have not been confirmed")
+            tasks_unpublished(unconfirmed)
 
-        completed = [task.name for task in tasks if task.status == self.STATUS_COMPLETED]
-        new = [task for task in tasks if task.status == self.STATUS_NEW]
-        for task in new:
-            if all([dep in completed for dep in task.dependencies]):
-                if task_lock(task):
-                    if task_get(task.id).status == self.STATUS_NEW:
-                        self._queue_task(task)
-                    task_unlock(task)
+    def _queue_waiting_tasks(self, key_prefix):
+        """Queues the tasks of other jobsteps that have been held back by the limits of the key prefix
 
-    def _queue_task(self, task):
-        """Queues Task object
+        The oldest jobsteps with waiting tasks are queued first, as long as there are free slots.
+        The jobsteps are read from storage, the tasks may have been held back by any workflow instance.
+
+        :param key_prefix:
+        :return:
+        """
+        if key_prefix not in TASK_LIMITS:
+            # A jobstep limit only frees slots for its own jobstep
+            return
+
+        jobstep_id = get_next_waiting_step(key_prefix)
+        while jobstep_id is not None:
+            queued, _ = count_queued_tasks(key_prefix, jobstep_id)
+            if queued >= TASK_LIMITS[key_prefix]:
+                return
+            self._queue_waiting_tasks_for_jobstep(jobstep_id, key_prefix)
+            jobstep_id = get_next_waiting_step(key_prefix, jobstep_id)
+
+    def _task_request(self, task):
+        """Returns the routing key and message of the task request for a claimed (queued) task
 
         :param task:
         :return:
@@ -151,28 +290,24 @@ class TaskQueue:
                 **task.extra_header,
             }
         }
-        publish(WORKFLOW_EXCHANGE, task.key_prefix + '.' + TASK_REQUEST, msg)
+        return task.key_prefix + '.' + TASK_REQUEST, msg
 
-        task_update({
-            'status': self.STATUS_QUEUED,
-            'id': task.id,
-            'start': datetime.now(),
-        })
-
-    def _all_tasks_complete(self, stepid):
-        """Returns whether all tasks for given stepid have STATUS_COMPLETED
+    def _all_tasks_complete(self, counts):
+        """Returns whether all tasks of a jobstep have STATUS_COMPLETED
 
-        :param stepid:
+        :param counts: the task counts of the jobstep
         :return:
         """
-        tasks = get_tasks_for_stepid(stepid)
-        completed = [task for task in tasks if task.status == self.STATUS_COMPLETED]
-        return len(completed) == len(tasks)
+        return counts['completed'] == counts['total']
 
     def on_task_result(self, msg):
         """Callback method when a Task result comes in. Handles further processing of results and triggers new
         messages.
 
+        The task counts of the jobstep are updated together with the status of the task.
+        A result for a task that has already ended is ignored.
+        The warnings and errors of the task are written to the summary details of the jobstep.
+
         :param msg:
         :return:
         """
@@ -185,46 +320,124 @@ class TaskQueue:
             'summary': msg['summary'],
             'end': datetime.now(),
         }
-        task_update(task_info)
+        counts = task_end(task_info)
+        if counts is None:
+            print(f"Task {task.id} has already ended")
+            return
+
+        write_details(task.stepid, task.name, msg['summary'])
 
         if failed:
-            self._abort_tasks(task.stepid)
+            self._abort_tasks(task)
         else:
-            self._queue_free_tasks_for_jobstep(task.stepid)
+            self._queue_free_tasks_for_jobstep(task.stepid, task.key_prefix, task.name)
 
-            if self._all_tasks_complete(task.stepid):
+            if self._all_tasks_complete(counts):
+                self.scheduler.forget(task.stepid)
                 self._publish_complete(task)
 
-    def _abort_tasks(self, stepid):
-        """Aborts all tasks belonging to stepid, as long as they are not queued or started yet.
+        # The task has freed a slot for the tasks that wait for the limits of its key prefix
+        self._queue_waiting_tasks(task.key_prefix)
+
+    def _timed_out(self, task, now):
+        """Returns whether a queued task has not ended within its timeout
+
+        The timeout doubles with every retry
+
+        :param task:
+        :param now:
+        :return:
+        """
+        return task.start + timedelta(seconds=TASK_TIMEOUTS[task.key_prefix] * 2 ** task.retries) < now
+
+    def check_timeouts(self):
+        """Publishes the queued tasks that have timed out again, or fails them after TASK_MAX_ATTEMPTS attempts.
+
+        A worker that has crashed never returns the result of its task, without a retry the jobstep would never end.
+        The failure of a task is handled like a failed task result, the remaining tasks of the jobstep are aborted.
+
+        The requests of queued tasks that have not been confirmed by the message broker are published again first.
 
-        :param stepid:
         :return:
         """
-        all_tasks = get_tasks_for_stepid(stepid)
-        new = [task for task in all_tasks if task.status == self.STATUS_NEW]
+        now = datetime.now()
+        tasks = tasks_claim_unpublished(now)
+        if tasks:
+            self._publish_requests(tasks)
+
+        for key_prefix, timeout in TASK_TIMEOUTS.items():
+            tasks = [task for task in get_queued_tasks(key_prefix, now - timedelta(seconds=timeout))
+                     if self._timed_out(task, now)]
+            for task in tasks:
+                if task.retries + 1 >= TASK_MAX_ATTEMPTS:
+                    print(f"Task {task.id} has not ended after {task.retries + 1} attempts")
+                    self.on_task_result(self._timeout_result(task))
+            self._requeue_tasks([task for task in tasks if task.retries + 1 < TASK_MAX_ATTEMPTS], now)
+
+    def _timeout_result(self, task):
+        """Returns the result message for a task that has not ended in time
+
+        :param task:
+        :return:
+        """
+        return {
+            'header': {
+                'taskid': task.id,
+            },
+            'summary': {
+                'warnings': [],
+                'errors': [f"Task {task.name} has not ended after {task.retries + 1} attempts"],
+            }
+        }
 
-        for task in new:
-            if task_lock(task):
-                task_update({
-                    'id': task.id,
-                    'status': self.STATUS_ABORTED
-                })
-                task_unlock(task)
+    def _requeue_tasks(self, tasks, now):
+        """Publishes the requests for queued tasks again, with the number of the attempt in the header
+
+        Tasks that have ended or that have been requeued concurrently are skipped.
+
+        :param tasks:
+        :param now:
+        :return:
+        """
+        requeued = tasks_requeue([(task.id, task.retries) for task in tasks], now)
+        if not requeued:
+            return
+
+        requests = [self._task_request(task) for task in requeued]
+        for (_, msg), task in zip(requests, requeued):
+            msg['header']['attempt'] = task.retries + 1
+        confirmed = publish_batch(WORKFLOW_EXCHANGE, requests)
+        unconfirmed = [task.id for task, is_confirmed in zip(requeued, confirmed) if not is_confirmed]
+        if unconfirmed:
+            # The tasks will time out again
+            print(f"{len(unconfirmed)} requeued task requests have not been confirmed")
+
+    def _abort_tasks(self, task):
+        """Aborts all tasks belonging to the jobstep of task, as long as they are not queued or started yet.
+
+        :param task: the task that has failed
+        :return:
+        """
+        self.scheduler.forget(task.stepid)
+
+        tasks_claim(task.stepid, None, self.STATUS_NEW, {
+            'status': self.STATUS_ABORTED
+        })
 
         # Finish
-        self._publish_complete(all_tasks[0])
+        self._publish_complete(task)
 
     def _publish_complete(self, task):
         """Method is triggered when all tasks in a group have completed. Also triggered when tasks are stopped
         because of failures. Handles final callback message to the user of the queue.
 
+        The summary contains the number and a sample of the warnings and errors of all tasks
+        and the path of the file with all warnings and errors.
+
         :param task:
         :return:
         """
-        all_tasks = get_tasks_for_stepid(task.stepid)
-        warnings = [warning for sublist in [t.summary['warnings'] for t in all_tasks] for warning in sublist]
-        errors = [error for sublist in [t.summary['errors'] for t in all_tasks] for error in sublist]
+        counts = get_task_counts(task.stepid)
 
         msg = {
             **task.extra_msg,
@@ -233,10 +446,7 @@ class TaskQueue:
                 'stepid': task.stepid,
                 **task.extra_header,
             },
-            'summary': {
-                'warnings': warnings,
-                'errors': errors,
-            }
+            'summary': complete_summary(task.stepid, counts)
         }
 
         publish(WORKFLOW_EXCHANGE, task.key_prefix + '.' + TASK_COMPLETE, msg)
@@ -0,0 +1,318 @@
+"""Task scheduler
+
+Keeps for each step the dependency graph of its tasks in memory, to order the tasks that are ready.
+
+Whether a task is ready is determined by the status of its dependencies in storage, not by the graph.
+The results of the tasks of a step may be handled by any workflow instance,
+the graph of an instance does not know about the completions that have been handled by other instances.
+The graph is static, it holds for each task the tasks that depend on it (the dependents).
+Only the dependents of a completed task can have become ready, only these are checked in storage.
+
+The graph of a step is registered when its tasks are created, or built from the tasks in storage on a cache miss.
+The graphs are kept per process, at most MAX_STEPS graphs are kept (least recently used are dropped).
+
+Ready tasks are ordered by their critical path, the expected duration of the longest chain of tasks
+that starts with the task, so that long chains are started first.
+The expected duration of a task is the average duration of earlier tasks with the same key prefix and name.
+The message priority of a released task is its critical path relative to the longest critical path in the step.
+
+Ready tasks that are held back by limits are registered in storage with their critical path and priority,
+they are queued from storage, the task with the longest critical path first.
+
+The dependencies of submitted tasks are validated with a topological sort (Kahn's algorithm),
+which also determines the level of each task. Both the sort and the detection of cycles take linear time.
+"""
+import threading
+
+from collections import OrderedDict, defaultdict, deque
+
+MAX_STEPS = 100  # Maximum number of step graphs that are kept in memory
+MAX_PRIORITY = 9  # Message priority of the tasks with the longest critical path
+DEFAULT_DURATION = 1.0  # Expected duration in seconds of a task if no durations are known
+
+
+class _StronglyConnected:
+    """Strongly connected components of a graph
+
+    An iterative version of Tarjan's algorithm, so that long chains do not exceed the recursion limit
+    """
+
+    def __init__(self, successors):
+        """
+        :param successors: dict with the successors of each node
+        """
+        self.successors = successors
+        self.index = {}
+        self.lowlink = {}
+        self.stack = []
+        self.on_stack = set()
+        self.components = []
+
+    def _visit(self, node):
+        self.index[node] = self.lowlink[node] = len(self.index)
+        self.stack.append(node)
+        self.on_stack.add(node)
+        return node, iter(self.successors[node])
+
+    def _unvisited_child(self, node, children):
+        for child in children:
+            if child not in self.index:
+                return [child]
+            if child in self.on_stack:
+                self.lowlink[node] = min(self.lowlink[node], self.index[child])
+        return []
+
+    def _finish(self, node, parent):
+        if parent is not None:
+            self.lowlink[parent] = min(self.lowlink[parent], self.lowlink[node])
+        if self.lowlink[node] == self.index[node]:
+            component = []
+            while not component or component[-1] != node:
+                component.append(self.stack.pop())
+                self.on_stack.remove(component[-1])
+            self.components.append(component[::-1])
+
+    def search(self, root):
+        """Find the components that can be reached from root
+
+        :param root: the node to start from
+        :return: None
+        """
+        work = [self._visit(root)]
+        while work:
+            node, children = work[-1]
+            child = self._unvisited_child(node, children)
+            if child:
+                work.append(self._visit(child[0]))
+            else:
+                work.pop()
+                self._finish(node, work[-1][0] if work else None)
+
+
+def _cycles(nodes, successors):
+    """Find the cycles in a graph
+
+    The cycles are the strongly connected components of more than one node, or of one node that depends on itself.
+
+    :param nodes: the nodes of the graph
+    :param successors: dict with the successors of each node
+    :return: list of cycles, each cycle is a list of nodes
+    """
+    components = _StronglyConnected(successors)
+    for node in nodes:
+        if node not in components.index:
+            components.search(node)
+    return [component for component in components.components
+            if len(component) > 1 or component[0] in successors[component[0]]]
+
+
+def _dependency_graph(tasks):
+    """Get the number of dependencies and the dependents of each task
+
+    :param tasks: list of (name, dependencies)
+    :return: tuple (indegree, dependents, missing) with the missing dependencies as (name, dependency)
+    """
+    indegree = {name: 0 for name, _ in tasks}
+    dependents = defaultdict(list)
+    missing = []
+    for name, dependencies in tasks:
+        for dependency in dependencies:
+            if dependency in indegree:
+                indegree[name] += 1
+                dependents[dependency].append(name)
+            else:
+                missing.append((name, dependency))
+    return indegree, dependents, missing
+
+
+def _kahn(indegree, dependents):
+    """Kahn's algorithm
+
+    :param indegree: the number of dependencies of each task, the numbers are decremented to zero for sorted tasks
+    :param dependents: the dependents of each task
+    :return: the level of each task that can be sorted
+    """
+    levels = {name: 0 for name, degree in indegree.items() if degree == 0}
+    ready = deque(levels)
+    while ready:
+        name = ready.popleft()
+        for dependent in dependents.get(name, []):
+            levels[dependent] = max(levels.get(dependent, 0), levels[name] + 1)
+            indegree[dependent] -= 1
+            if indegree[dependent] == 0:
+                ready.append(dependent)
+    return {name: level for name, level in levels.items() if indegree[name] == 0}
+
+
+def topological_levels(tasks):
+    """Sort tasks topologically using Kahn's algorithm
+
+    The tasks may be given in any order.
+    The level of a task is the length of the longest chain of dependencies that precedes it,
+    tasks without dependencies have level 0.
+
+    :param tasks: list of (name, dependencies)
+    :return: tuple (levels, missing, cycles) with
+        the level of each task that could be sorted,
+        the missing dependencies as (name, dependency) and
+        the cycles as lists of names
+    """
+    indegree, dependents, missing = _dependency_graph(tasks)
+    levels = _kahn(indegree, dependents)
+
+    # Tasks that could not be sorted are in a cycle or depend on a cycle
+    blocked = {name for name in indegree if name not in levels}
+    successors = {name: [dependent for dependent in dependents[name] if dependent in blocked] for name in blocked}
+    cycles = _cycles([name for name in indegree if name in blocked], successors)
+    return levels, missing, cycles
+
+
+class StepGraph:
+    """Dependency graph of the tasks of a step
+    """
+
+    def __init__(self, tasks, durations=None):
+        """
+        :param tasks: list of (name, dependencies) for all tasks of the step
+        :param durations: dict with the expected duration in seconds of tasks by name
+        """
+        self.names = [name for name, _ in tasks]
+        self.dependents = defaultdict(list)
+        for name, dependencies in tasks:
+            for dependency in dependencies:
+                self.dependents[dependency].append(name)
+
+        self.paths = self._critical_paths(durations or {})
+        self.longest = max(self.paths.values(), default=0)
+
+    def _critical_paths(self, durations):
+        """Get the critical path of each task
+
+        Tasks of which the duration is not known are expected to take the average of the known durations
+
+        :param durations: dict with the expected duration in seconds of tasks by name
+        :return: dict with the expected duration of the longest chain of tasks that starts with each task
+        """
+        default = sum(durations.values()) / len(durations) if durations else DEFAULT_DURATION
+        indegree = {name: 0 for name in self.names}
+        for name in self.names:
+            for dependent in self.dependents.get(name, []):
+                indegree[dependent] += 1
+        levels = _kahn(indegree, self.dependents)
+
+        # Dependents have a higher level, their paths are known when the path of a task is determined
+        paths = {}
+        for name in sorted(levels, key=levels.get, reverse=True):
+            paths[name] = durations.get(name, default) + \
+                max((paths[dependent] for dependent in self.dependents.get(name, [])), default=0)
+        return paths
+
+    def priority(self, name):
+        """Get the message priority of a task
+
+        :param name: the name of the task
+        :return: the priority, from 0 to MAX_PRIORITY for the tasks with the longest critical path
+        """
+        return round(MAX_PRIORITY * self.paths.get(name, 0) / self.longest) if self.longest else 0
+
+    def order(self, tasks):
+        """Order ready tasks, the tasks with the longest critical path first
+
+        :param tasks: list of (id, name) of the ready tasks
+        :return: list of (id, priority) of the tasks
+        """
+        ordered = sorted(tasks, key=lambda task: -self.paths.get(task[1], 0))
+        return [(task_id, self.priority(name)) for task_id, name in ordered]
+
+    def priorities(self, tasks):
+        """Get the critical path and the message priority of ready tasks
+
+        :param tasks: list of (id, name) of the ready tasks
+        :return: list of (id, critical path, priority) of the tasks
+        """
+        return [(task_id, self.paths.get(name, 0), self.priority(name)) for task_id, name in tasks]
+
+
+class Scheduler:
+    """Cache of step graphs
+
+    The scheduler is shared by the threads of the process, access to the graphs is serialized.
+    """
+
+    def __init__(self, load, max_steps=MAX_STEPS):
+        """
+        :param load: function(stepid) that builds the StepGraph of a step from storage
+        :param max_steps: maximum number of step graphs to keep
+        """
+        self._load = load
+        self._max_steps = max_steps
+        self._graphs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _store(self, stepid, graph):
+        self._graphs[stepid] = graph
+        self._graphs.move_to_end(stepid)
+        if len(self._graphs) > self._max_steps:
+            self._graphs.popitem(last=False)
+
+    def _graph(self, stepid):
+        graph = self._graphs.get(stepid)
+        if graph is None:
+            graph = self._load(stepid)
+        self._store(stepid, graph)
+        return graph
+
+    def add(self, stepid, graph):
+        """Register the graph of a step that has just been created
+
+        This saves loading the graph from storage when the step is scheduled
+
+        :param stepid: the id of the step
+        :param graph: the StepGraph of the step
+        :return: None
+        """
+        with self._lock:
+            self._store(stepid, graph)
+
+    def dependents(self, stepid, name):
+        """Get the tasks of a step that depend on the given task
+
+        Only these tasks can have become ready by the completion of the task
+
+        :param stepid: the id of the step
+        :param name: the name of the task
+        :return: list of names of the dependent tasks
+        """
+        with self._lock:
+            return list(self._graph(stepid).dependents.get(name, []))
+
+    def order(self, stepid, tasks):
+        """Order the ready tasks of a step, the task with the longest critical path first
+
+        :param stepid: the id of the step
+        :param tasks: list of (id, name) of the ready tasks
+        :return: list of (id, priority) of the tasks
+        """
+        with self._lock:
+            return self._graph(stepid).order(tasks)
+
+    def priorities(self, stepid, tasks):
+        """Get the critical path and the message priority of the ready tasks of a step
+
+        :param stepid: the id of the step
+        :param tasks: list of (id, name) of the ready tasks
+        :return: list of (id, critical path, priority) of the tasks
+        """
+        with self._lock:
+            return self._graph(stepid).priorities(tasks)
+
+    def forget(self, stepid):
+        """Drop the graph of a step
+
+        The graph will be rebuilt from storage when the step is scheduled again
+
+        :param stepid: the id of the step
+        :return: None
+        """
+        with self._lock:
+            self._graphs.pop(stepid, None)
@@ -0,0 +1,78 @@
+"""Task summaries
+
+The warnings and errors of the tasks of a jobstep are aggregated as the task results come in.
+
+The number of warnings and errors and a sample of them are kept in the task counts of the jobstep,
+see storage.task_end. The completion message of the jobstep contains only these counts and samples.
+
+All warnings and errors are appended to an ndjson file per jobstep in TASK_SUMMARY_DIR,
+one line for each task that has warnings or errors.
+The path of the file is passed in the completion message.
+Files that have not been written to for TASK_SUMMARY_RETENTION days are removed periodically.
+"""
+import json
+import os
+import time
+
+from gobcore.typesystem.json import GobTypeJSONEncoder
+
+from gobworkflow.config import TASK_SUMMARY_DIR, TASK_SUMMARY_RETENTION
+from gobworkflow.storage.tables import TASK_SUMMARY_CATEGORIES
+
+CLEANUP_INTERVAL = 60 * 60  # Duration in seconds between two runs of the removal of old details files
+
+
+def details_path(stepid):
+    return os.path.join(TASK_SUMMARY_DIR, f"{stepid}.ndjson")
+
+
+def write_details(stepid, task_name, summary):
+    """Append the warnings and errors of a task to the details file of its jobstep
+
+    Nothing is written for a task without warnings and errors
+
+    :param stepid: the id of the jobstep
+    :param task_name: the name of the task
+    :param summary: the summary of the task
+    :return: None
+    """
+    details = {category: summary.get(category) or [] for category in TASK_SUMMARY_CATEGORIES}
+    if not any(details.values()):
+        return
+
+    os.makedirs(TASK_SUMMARY_DIR, exist_ok=True)
+    with open(details_path(stepid), 'a') as file:
+        file.write(json.dumps({'task': task_name, **details}, cls=GobTypeJSONEncoder) + '\n')
+
+
+def complete_summary(stepid, counts):
+    """Get the summary for the completion message of a jobstep
+
+    :param stepid: the id of the jobstep
+    :param counts: the task counts of the jobstep
+    :return: summary with a sample and the number of the warnings and errors and the path of the details file
+    """
+    path = details_path(stepid)
+    return {
+        **{category: counts[f"{category}_sample"] for category in TASK_SUMMARY_CATEGORIES},
+        'counts': {category: counts[category] for category in TASK_SUMMARY_CATEGORIES},
+        'details': path if os.path.exists(path) else None,
+    }
+
+
+def remove_old_details():
+    """Remove the details files that have not been written to for TASK_SUMMARY_RETENTION days
+
+    :return: None
+    """
+    if not TASK_SUMMARY_RETENTION or not os.path.isdir(TASK_SUMMARY_DIR):
+        return
+
+    modified_before = time.time() - TASK_SUMMARY_RETENTION * 24 * 60 * 60
+    count = 0
+    for entry in os.scandir(TASK_SUMMARY_DIR):
+        if entry.is_file() and entry.stat().st_mtime < modified_before:
+            os.remove(entry.path)
+            count += 1
+    if count:
+        print(f"Removed {count} task summary details files")
@@ -37,11 +37,10 @@ def job_start(job_name, msg):
         "status": STATUS_START,
         "user": msg.get("header", {}).get("user")
     }
-    job = job_save(job_info)
     # Store the job and register its id
-    job_info["id"] = job.id
+    job_info["id"] = job_save(job_info)
     # Enhance the message header with the job id
-    msg["header"]["jobid"] = job.id
+    msg["header"]["jobid"] = job_info["id"]
     return job_info
 
 
@@ -81,11 +80,10 @@ def step_start(step_name, header):
         "end": None,
         "status": STATUS_SCHEDULED,
     }
-    step = step_save(step_info)
     # Store the step and register its id
-    step_info["id"] = step.id
+    step_info["id"] = step_save(step_info)
     # Enhance the message with the job id
-    header["stepid"] = step.id
+    header["stepid"] = step_info["id"]
     return step_info
 
 
@@ -0,0 +1,54 @@
+from unittest import TestCase, mock
+
+from gobworkflow.logs import __main__
+from gobworkflow.logs.__main__ import _parse_arguments, read_logs
+
+
+class TestLogsMain(TestCase):
+
+    def test_parse_arguments(self):
+        args = _parse_arguments(['1'])
+        self.assertEqual(args.jobid, 1)
+        self.assertIsNone(args.step)
+        self.assertIsNone(args.limit)
+        self.assertIsNone(args.before)
+
+        args = _parse_arguments(['1', '--step', '2', '--limit', '10', '--before', '100'])
+        self.assertEqual((args.jobid, args.step, args.limit, args.before), (1, 2, 10, 100))
+
+    @mock.patch("gobworkflow.logs.__main__.sys")
+    @mock.patch("gobworkflow.logs.__main__.export_logs")
+    def test_read_logs(self, mock_export_logs, mock_sys):
+        read_logs(_parse_arguments(['1', '--step', '2']))
+        mock_export_logs.assert_called_with(1, mock_sys.stdout, 2)
+
+    @mock.patch("builtins.print")
+    @mock.patch("gobworkflow.logs.__main__.sys")
+    @mock.patch("gobworkflow.logs.__main__.get_logs")
+    def test_read_logs_page(self, mock_get_logs, mock_sys, mock_print):
+        mock_get_logs.return_value = [{'logid': 5, 'timestamp': None}], 5
+
+        read_logs(_parse_arguments(['1', '--limit', '1', '--before', '6']))
+        mock_get_logs.assert_called_with(1, None, before=6, limit=1)
+        mock_sys.stdout.write.assert_called_with('{"logid": 5, "timestamp": null}\n')
+        mock_print.assert_called_with("Next page: --before 5", file=mock_sys.stderr)
+
+        # Last page
+        mock_print.reset_mock()
+        mock_get_logs.return_value = [], None
+        read_logs(_parse_arguments(['1', '--limit', '1']))
+        mock_print.assert_not_called()
+
+    @mock.patch("gobworkflow.logs.__main__.read_logs")
+    @mock.patch("gobworkflow.logs.__main__.connect")
+    def test_init(self, mock_connect, mock_read_logs):
+        with mock.patch.object(__main__, "__name__", "__main__"), \
+                mock.patch.object(__main__.sys, "argv", ['logs', '1']):
+            __main__.init()
+        mock_read_logs.assert_called_once()
+
+        mock_connect.return_value = False
+        with mock.patch.object(__main__, "__name__", "__main__"), \
+                mock.patch.object(__main__.sys, "argv", ['logs', '1']), \
+                self.assertRaises(SystemExit):
+            __main__.init()
@@ -0,0 +1,63 @@
+from unittest import TestCase, mock
+
+from pika.exceptions import AMQPError
+
+from gobworkflow.task.publisher import publish_batch
+
+
+@mock.patch("gobworkflow.task.publisher.pika")
+class TestPublisher(TestCase):
+
+    def test_publish_batch(self, mock_pika):
+        channel = mock_pika.BlockingConnection.return_value.__enter__.return_value.channel.return_value
+        channel.basic_publish.side_effect = [True, False]
+
+        result = publish_batch('exchange', [('key 1', {'msg': 1}), ('key 2', {'msg': 2})])
+        self.assertEqual(result, [True, False])
+
+        # One connection and channel for the batch, with publisher confirms
+        mock_pika.BlockingConnection.assert_called_once()
+        channel.confirm_delivery.assert_called_once()
+        channel.basic_publish.assert_has_calls([
+            mock.call('exchange', 'key 1', '{"msg": 1}', properties=mock.ANY, mandatory=True),
+            mock.call('exchange', 'key 2', '{"msg": 2}', properties=mock.ANY, mandatory=True),
+        ])
+
+    @mock.patch("gobworkflow.task.publisher.offload_message")
+    def test_publish_batch_offload(self, mock_offload, mock_pika):
+        channel = mock_pika.BlockingConnection.return_value.__enter__.return_value.channel.return_value
+        mock_offload.return_value = {'contents_ref': 'any file'}
+
+        publish_batch('exchange', [('key', {'contents': 'large contents'})])
+
+        # Large contents are offloaded, like by the gobcore publish
+        mock_offload.assert_called_once_with({'contents': 'large contents'}, mock.ANY)
+        converter = mock_offload.call_args[0][1]
+        self.assertEqual(converter({'msg': 1}), '{"msg": 1}')
+        channel.basic_publish.assert_called_with('exchange', 'key', '{"contents_ref": "any file"}',
+                                                 properties=mock.ANY, mandatory=True)
+
+    def test_publish_batch_failure(self, mock_pika):
+        channel = mock_pika.BlockingConnection.return_value.__enter__.return_value.channel.return_value
+        channel.basic_publish.side_effect = [True, AMQPError]
+
+        result = publish_batch('exchange', [('key', {'msg': n}) for n in range(3)])
+        self.assertEqual(result, [True, False, False])
+
+    def test_publish_batch_connection_failure(self, mock_pika):
+        mock_pika.BlockingConnection.side_effect = AMQPError
+
+        result = publish_batch('exchange', [('key', {'msg': 1})])
+        self.assertEqual(result, [False])
+
+    def test_publish_batch_priorities(self, mock_pika):
+        channel = mock_pika.BlockingConnection.return_value.__enter__.return_value.channel.return_value
+        channel.basic_publish.return_value = True
+
+        publish_batch('exchange', [('key 1', {'msg': 1}), ('key 2', {'msg': 2})], [9, 3])
+        mock_pika.BasicProperties.assert_has_calls([
+            mock.call(delivery_mode=2, priority=9),
+            mock.call(delivery_mode=2, priority=3),
+        ])
+        properties = [kwargs['properties'] for _, _, kwargs in channel.basic_publish.mock_calls]
+        self.assertEqual(properties, [mock_pika.BasicProperties.return_value] * 2)
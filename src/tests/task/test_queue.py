@@ -1,7 +1,8 @@
 from unittest import TestCase
-from unittest.mock import patch, MagicMock, call
+from unittest.mock import patch, MagicMock, ANY
 from freezegun import freeze_time
-from datetime import datetime
+from datetime import datetime, timedelta
+from types import SimpleNamespace
 
 from gobworkflow.task.queue import TaskQueue
 from gobcore.model.sa.management import Job, JobStep, Task
@@ -51,11 +52,19 @@ class TestTaskQueue(TestCase):
 
         self.task_queue = TaskQueue()
 
+        patcher = patch("gobworkflow.task.queue.write_details")
+        self.mock_write_details = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch("gobworkflow.task.queue.get_task_durations", return_value={})
+        self.mock_get_durations = patcher.start()
+        self.addCleanup(patcher.stop)
+
     @patch("gobworkflow.task.queue.load_message")
     @patch("gobworkflow.task.queue.get_job_step")
     @patch("gobworkflow.task.queue.json")
     def test_on_start_tasks(self, mock_json, mock_get_job_step, mock_load_message):
-        self.task_queue._validate_dependencies = MagicMock()
+        self.task_queue._validate_dependencies = MagicMock(return_value={'levels': 'any levels'})
         self.task_queue._create_tasks = MagicMock()
         self.task_queue._queue_free_tasks_for_jobstep = MagicMock()
         mock_get_job_step.return_value = Job(id=self.jobid), JobStep(id=self.stepid)
@@ -68,8 +77,9 @@ class TestTaskQueue(TestCase):
         self.task_queue._validate_dependencies.assert_called_with(self.tasks)
         self.task_queue._create_tasks.assert_called_with(self.jobid, self.stepid, self.process_id, self.tasks,
                                                          'pref', self.start_message['contents']['extra_msg'],
-                                                         self.start_message['header']['extra'])
-        self.task_queue._queue_free_tasks_for_jobstep.assert_called_with(self.stepid)
+                                                         self.start_message['header']['extra'],
+                                                         {'levels': 'any levels'})
+        self.task_queue._queue_free_tasks_for_jobstep.assert_called_with(self.stepid, 'pref')
 
     @patch("gobworkflow.task.queue.load_message")
     @patch("gobworkflow.task.queue.get_job_step")
@@ -82,23 +92,48 @@ class TestTaskQueue(TestCase):
             self.task_queue.on_start_tasks(self.start_message)
 
     def test_validate_dependencies(self):
-        self.task_queue._validate_dependencies(self.tasks)
+        levels = self.task_queue._validate_dependencies(self.tasks)
+        self.assertEqual(levels, {'task id 1': 0, 'task id 2': 1, 'task id 3': 2})
+
+    def test_validate_dependencies_unordered(self):
+        levels = self.task_queue._validate_dependencies(self.tasks[::-1])
+        self.assertEqual(levels, {'task id 1': 0, 'task id 2': 1, 'task id 3': 2})
 
     def test_validate_dependencies_double_id(self):
         self.tasks[2]['id'] = self.tasks[1]['id']
         with self.assertRaises(AssertionError):
             self.task_queue._validate_dependencies(self.tasks)
 
+    def test_validate_dependencies_no_dependencies(self):
+        del self.tasks[2]['dependencies']
+        with self.assertRaises(AssertionError):
+            self.task_queue._validate_dependencies(self.tasks)
+
     def test_validate_dependencies_circular_dependency(self):
         self.tasks[0]['dependencies'] = [self.tasks[1]['id']]
 
         with self.assertRaises(GOBException):
             self.task_queue._validate_dependencies(self.tasks)
 
-    @patch("gobworkflow.task.queue.get_tasks_for_stepid")
-    @patch("gobworkflow.task.queue.task_save")
-    def test_create_tasks(self, mock_task_save, mock_get_tasks):
-        mock_get_tasks.return_value = []
+    def test_validate_dependencies_all_errors(self):
+        self.tasks[0]['dependencies'] = [self.tasks[1]['id']]
+        self.tasks.extend([
+            {'id': 'task id 4', 'dependencies': ['task id 4']},
+            {'id': 'task id 5', 'dependencies': ['missing task']},
+            {'id': 'task id 6', 'dependencies': ['task id 1', 'other missing task']},
+        ])
+
+        with self.assertRaisesRegex(GOBException,
+                                    "^Invalid task dependencies: "
+                                    "Task task id 5 depends on task missing task, which does not exist; "
+                                    "Task task id 6 depends on task other missing task, which does not exist; "
+                                    "Tasks task id 1, task id 2 depend on each other; "
+                                    "Tasks task id 4 depend on each other$"):
+            self.task_queue._validate_dependencies(self.tasks)
+
+    @patch("gobworkflow.task.queue.tasks_save")
+    def test_create_tasks(self, mock_tasks_save):
+        mock_tasks_save.return_value = [11, 12]
         key_prefix = "prefix",
         extra_msg = {"extra": "msg"}
         extra_header = {"extra": "header"}
@@ -106,15 +141,14 @@ class TestTaskQueue(TestCase):
         self.tasks[0]['extra_msg'] = {'extra2': 'fromtask'}
 
         self.task_queue._create_tasks(self.jobid, self.stepid, self.process_id, self.tasks[:2], key_prefix, extra_msg,
-                                      extra_header)
+                                      extra_header, {'task id 1': 0, 'task id 2': 1})
 
-        mock_task_save.assert_has_calls([
-            call({
+        mock_tasks_save.assert_called_once_with(self.stepid, [
+            {
                 'name': self.tasks[0]['id'],
                 'dependencies': self.tasks[0]['dependencies'],
                 'status': self.task_queue.STATUS_NEW,
                 'jobid': self.jobid,
-                'stepid': self.stepid,
                 'key_prefix': key_prefix,
                 'extra_header': extra_header,
                 'extra_msg': {
@@ -122,74 +156,251 @@ class TestTaskQueue(TestCase):
                     'extra2': 'fromtask',
                 },
                 'process_id': self.process_id,
-            }),
-            call({
+            },
+            {
                 'name': self.tasks[1]['id'],
                 'dependencies': self.tasks[1]['dependencies'],
                 'status': self.task_queue.STATUS_NEW,
                 'jobid': self.jobid,
-                'stepid': self.stepid,
                 'key_prefix': key_prefix,
                 'extra_header': extra_header,
                 'extra_msg': extra_msg,
                 'process_id': self.process_id,
-            })
-        ])
+            }
+        ], {'task id 1': 0, 'task id 2': 1})
 
+        # The tasks are registered in the scheduler
+        self.task_queue.scheduler._load = MagicMock()
+        self.assertEqual(self.task_queue.scheduler.dependents(self.stepid, self.tasks[0]['id']),
+                         [self.tasks[1]['id']])
+        self.assertEqual(self.task_queue.scheduler.order(self.stepid, [(12, 'task id 2'), (11, 'task id 1')]),
+                         [(11, 9), (12, 4)])
+        self.task_queue.scheduler._load.assert_not_called()
+        self.mock_get_durations.assert_called_once_with(key_prefix)
+
+    @patch("gobworkflow.task.queue.tasks_save")
+    def test_create_tasks_existing_steps(self, mock_tasks_save):
+        mock_tasks_save.side_effect = GOBException
+
+        with self.assertRaises(GOBException):
+            self.task_queue._create_tasks(self.jobid, self.stepid, self.process_id, [], '', {}, {}, {})
+
+    @patch("gobworkflow.task.queue.get_tasks_for_stepid")
+    def test_load_graph(self, mock_get_tasks):
+        mock_get_tasks.return_value = [
+            Task(id=1, name='task1', status=self.task_queue.STATUS_COMPLETED, dependencies=[]),
+            Task(id=2, name='task2', status=self.task_queue.STATUS_NEW, dependencies=['task3']),
+            Task(id=3, name='task3', status=self.task_queue.STATUS_NEW, dependencies=['task1']),
+            Task(id=4, name='task4', status=self.task_queue.STATUS_QUEUED, dependencies=['task1']),
+        ]
+        for task in mock_get_tasks.return_value:
+            task.key_prefix = 'prefix'
+        self.mock_get_durations.return_value = {'task2': 3.0, 'task4': 1.0}
+        graph = self.task_queue._load_graph(self.stepid)
         mock_get_tasks.assert_called_with(self.stepid)
+        self.mock_get_durations.assert_called_with('prefix')
+
+        self.assertEqual(graph.names, ['task1', 'task2', 'task3', 'task4'])
+        self.assertEqual(graph.dependents, {'task1': ['task3', 'task4'], 'task3': ['task2']})
+        # Task1 and task3 take the average of the known durations
+        self.assertEqual(graph.paths, {'task1': 7.0, 'task2': 3.0, 'task3': 5.0, 'task4': 1.0})
 
     @patch("gobworkflow.task.queue.get_tasks_for_stepid")
-    def test_create_tasks_existing_steps(self, mock_get_tasks):
-        mock_get_tasks.return_value = [1, 2, 3]
+    def test_load_graph_no_tasks(self, mock_get_tasks):
+        mock_get_tasks.return_value = []
+        graph = self.task_queue._load_graph(self.stepid)
+        self.assertEqual(graph.names, [])
+        self.mock_get_durations.assert_not_called()
 
-        with self.assertRaises(AssertionError):
-            self.task_queue._create_tasks(self.jobid, self.stepid, self.process_id, [], '', {}, {})
+    @patch("gobworkflow.task.queue.get_tasks_for_stepid")
+    @patch("gobworkflow.task.queue.get_ready_tasks")
+    @patch("gobworkflow.task.queue.tasks_claim")
+    @patch("gobworkflow.task.queue.publish_batch")
+    def test_queue_free_tasks_for_jobstep(self, mock_publish_batch, mock_claim, mock_get_ready, mock_get_tasks):
+        self.task_queue._task_request = MagicMock(side_effect=lambda task: ('key', task))
+        mock_get_tasks.return_value = [
+            Task(id=1, name='task1', status=self.task_queue.STATUS_COMPLETED, dependencies=[]),
+            Task(id=2, name='task2', status=self.task_queue.STATUS_NEW, dependencies=['task3']),
+            Task(id=3, name='task3', status=self.task_queue.STATUS_NEW, dependencies=['task1']),
+        ]
+        mock_get_ready.return_value = [(3, 'task3')]
+        claimed = Task(id=3, name='task3')
+        mock_claim.return_value = [claimed]
+        mock_publish_batch.return_value = [True]
+
+        with freeze_time():
+            self.task_queue._queue_free_tasks_for_jobstep(self.stepid, 'pref')
+            now = datetime.now()
+
+        # All tasks of the jobstep are checked
+        mock_get_ready.assert_called_with(self.stepid, None)
+        mock_claim.assert_called_once_with(self.stepid, [3], self.task_queue.STATUS_NEW, {
+            'status': self.task_queue.STATUS_QUEUED,
+            'start': now,
+        })
+        mock_publish_batch.assert_called_once_with(WORKFLOW_EXCHANGE, [('key', claimed)], [6])
+
+        # Completion of task3 can only make task2 ready, the graph is not read again
+        mock_get_tasks.reset_mock()
+        mock_get_ready.return_value = [(2, 'task2')]
+        self.task_queue._queue_free_tasks_for_jobstep(self.stepid, 'pref', 'task3')
+        mock_get_tasks.assert_not_called()
+        mock_get_ready.assert_called_with(self.stepid, ['task2'])
+        mock_claim.assert_called_with(self.stepid, [2], self.task_queue.STATUS_NEW, ANY)
+
+        # Nothing is ready
+        mock_claim.reset_mock()
+        mock_get_ready.return_value = []
+        self.task_queue._queue_free_tasks_for_jobstep(self.stepid, 'pref', 'task2')
+        mock_claim.assert_not_called()
 
     @patch("gobworkflow.task.queue.get_tasks_for_stepid")
-    @patch("gobworkflow.task.queue.task_lock")
-    @patch("gobworkflow.task.queue.task_unlock")
-    @patch("gobworkflow.task.queue.task_get")
-    def test_queue_free_tasks_for_jobstep(self, mock_task_get, mock_unlock, mock_lock, mock_get_tasks):
-        self.task_queue._queue_task = MagicMock()
+    @patch("gobworkflow.task.queue.get_ready_tasks")
+    @patch("gobworkflow.task.queue.tasks_claim")
+    @patch("gobworkflow.task.queue.publish_batch")
+    def test_queue_free_tasks_claimed(self, mock_publish_batch, mock_claim, mock_get_ready, mock_get_tasks):
         mock_get_tasks.return_value = [
-            Task(name='task1', status=self.task_queue.STATUS_COMPLETED, dependencies=[]),
-            Task(name='task2', status=self.task_queue.STATUS_NEW, dependencies=['task3']),
-            Task(name='task3', status=self.task_queue.STATUS_NEW, dependencies=['task1']),
+            Task(id=1, name='task1', status=self.task_queue.STATUS_NEW, dependencies=[]),
         ]
-        mock_task_get.return_value = mock_get_tasks.return_value[2]
-        self.task_queue._queue_free_tasks_for_jobstep(self.stepid)
-        mock_get_tasks.assert_called_with(self.stepid)
+        mock_get_ready.return_value = [(1, 'task1')]
+        # The task has already been claimed elsewhere
+        mock_claim.return_value = []
+        self.task_queue._queue_free_tasks_for_jobstep(self.stepid, 'pref')
 
-        self.task_queue._queue_task.assert_has_calls([
-            call(mock_get_tasks.return_value[2])
-        ])
+        mock_claim.assert_called_with(self.stepid, [1], self.task_queue.STATUS_NEW, ANY)
+        mock_publish_batch.assert_not_called()
 
     @patch("gobworkflow.task.queue.get_tasks_for_stepid")
-    @patch("gobworkflow.task.queue.task_lock")
-    def test_queue_free_tasks_locked(self, mock_lock, mock_get_tasks):
-        self.task_queue._queue_task = MagicMock()
+    @patch("gobworkflow.task.queue.get_ready_tasks")
+    @patch("gobworkflow.task.queue.tasks_claim")
+    @patch("gobworkflow.task.queue.publish_batch")
+    @patch("gobworkflow.task.queue.tasks_unpublished")
+    def test_queue_free_tasks_unconfirmed(self, mock_unpublished, mock_publish_batch, mock_claim, mock_get_ready,
+                                          mock_get_tasks):
+        self.task_queue._task_request = MagicMock(side_effect=lambda task: ('key', task.id))
         mock_get_tasks.return_value = [
-            Task(name='task1', status=self.task_queue.STATUS_COMPLETED, dependencies=[]),
-            Task(name='task2', status=self.task_queue.STATUS_NEW, dependencies=['task3']),
-            Task(name='task3', status=self.task_queue.STATUS_NEW, dependencies=['task1']),
+            Task(id=1, name='task1', status=self.task_queue.STATUS_NEW, dependencies=[]),
+            Task(id=2, name='task2', status=self.task_queue.STATUS_NEW, dependencies=[]),
         ]
-        mock_lock.return_value = False
-        self.task_queue._queue_free_tasks_for_jobstep(self.stepid)
-        mock_get_tasks.assert_called_with(self.stepid)
+        mock_get_ready.return_value = [(1, 'task1'), (2, 'task2')]
+        self.mock_get_durations.return_value = {'task1': 2.0, 'task2': 10.0}
+        mock_claim.return_value = mock_get_tasks.return_value
+        mock_publish_batch.return_value = [True, False]
+        self.task_queue._queue_free_tasks_for_jobstep(self.stepid, 'pref')
 
-        self.task_queue._queue_task.assert_not_called()
+        # The task with the longest critical path is published first
+        mock_publish_batch.assert_called_once_with(WORKFLOW_EXCHANGE, [('key', 2), ('key', 1)], [9, 2])
 
-    @patch("gobworkflow.task.queue.publish")
-    @patch("gobworkflow.task.queue.task_update")
-    def test_queue_task(self, mock_update, mock_publish):
-        task = Task(id=123, name='task name', jobid=self.jobid, stepid=self.stepid, extra_msg={'extra': 'msg'},
-                    key_prefix='prefix', process_id=self.process_id, extra_header={'extra': 'header'})
+        # The unconfirmed task stays queued, to be published again by the watchdog
+        mock_claim.assert_called_once()
+        mock_unpublished.assert_called_once_with([1])
+
+    @patch("gobworkflow.task.queue.count_queued_tasks")
+    def test_free_slots(self, mock_count):
+        mock_count.return_value = (7, 2)
+
+        self.assertIsNone(self.task_queue._free_slots('pref', self.stepid))
+        mock_count.assert_not_called()
 
+        with patch("gobworkflow.task.queue.TASK_LIMITS", {'pref': 10}):
+            self.assertEqual(self.task_queue._free_slots('pref', self.stepid), 3)
+            mock_count.assert_called_with('pref', self.stepid)
+
+            with patch("gobworkflow.task.queue.TASK_STEP_LIMITS", {'pref': 4}):
+                self.assertEqual(self.task_queue._free_slots('pref', self.stepid), 2)
+
+        # The limits have been lowered below the number of queued tasks
+        with patch("gobworkflow.task.queue.TASK_STEP_LIMITS", {'pref': 1}):
+            self.assertEqual(self.task_queue._free_slots('pref', self.stepid), 0)
+
+    @patch("gobworkflow.task.queue.get_tasks_for_stepid")
+    @patch("gobworkflow.task.queue.get_ready_tasks")
+    @patch("gobworkflow.task.queue.tasks_wait")
+    @patch("gobworkflow.task.queue.tasks_claim")
+    @patch("gobworkflow.task.queue.TASK_STEP_LIMITS", {'pref': 3})
+    def test_queue_free_tasks_limited(self, mock_claim, mock_wait, mock_get_ready, mock_get_tasks):
+        self.task_queue._queue_waiting_tasks_for_jobstep = MagicMock()
+        mock_get_tasks.return_value = [
+            Task(id=n, name=f"task{n}", status=self.task_queue.STATUS_NEW, dependencies=[]) for n in range(1, 4)
+        ]
+        mock_get_ready.return_value = [(n, f"task{n}") for n in range(1, 4)]
+        self.mock_get_durations.return_value = {'task1': 1.0, 'task2': 4.0, 'task3': 3.0}
+
+        # The ready tasks wait with their critical path and priority, the waiting tasks are queued from storage
+        self.task_queue._queue_free_tasks_for_jobstep(self.stepid, 'pref')
+        mock_get_ready.assert_called_with(self.stepid, None)
+        mock_wait.assert_called_once_with(self.stepid, 'pref', [(1, 1.0, 2), (2, 4.0, 9), (3, 3.0, 7)])
+        self.task_queue._queue_waiting_tasks_for_jobstep.assert_called_once_with(self.stepid, 'pref')
+        mock_claim.assert_not_called()
+
+        # Only the dependents of a completed task are checked
+        self.task_queue._queue_free_tasks_for_jobstep(self.stepid, 'pref', 'task2')
+        mock_get_ready.assert_called_with(self.stepid, [])
+
+    @patch("gobworkflow.task.queue.tasks_claim_waiting")
+    @patch("gobworkflow.task.queue.publish_batch")
+    def test_queue_waiting_tasks_for_jobstep(self, mock_publish_batch, mock_claim_waiting):
+        self.task_queue._task_request = MagicMock(side_effect=lambda task: ('key', task.id))
+        self.task_queue._free_slots = MagicMock(return_value=2)
+        mock_claim_waiting.return_value = [
+            MagicMock(id=3, path=3.0, priority=7),
+            MagicMock(id=2, path=4.0, priority=9),
+        ]
+        mock_publish_batch.return_value = [True, True]
+
+        # The waiting tasks are claimed up to the free slots and published, the longest critical path first
         with freeze_time():
-            self.task_queue._queue_task(task)
+            self.task_queue._queue_waiting_tasks_for_jobstep(self.stepid, 'pref')
             now = datetime.now()
+        self.task_queue._free_slots.assert_called_with('pref', self.stepid)
+        mock_claim_waiting.assert_called_once_with(self.stepid, 2, {
+            'status': self.task_queue.STATUS_QUEUED,
+            'start': now,
+        })
+        mock_publish_batch.assert_called_once_with(WORKFLOW_EXCHANGE, [('key', 2), ('key', 3)], [9, 7])
+
+        # No waiting tasks
+        mock_publish_batch.reset_mock()
+        mock_claim_waiting.return_value = []
+        self.task_queue._queue_waiting_tasks_for_jobstep(self.stepid, 'pref')
+        mock_publish_batch.assert_not_called()
+
+        # No free slots
+        mock_claim_waiting.reset_mock()
+        self.task_queue._free_slots.return_value = 0
+        self.task_queue._queue_waiting_tasks_for_jobstep(self.stepid, 'pref')
+        mock_claim_waiting.assert_not_called()
+
+    @patch("gobworkflow.task.queue.get_next_waiting_step")
+    @patch("gobworkflow.task.queue.count_queued_tasks")
+    def test_queue_waiting_tasks(self, mock_count, mock_get_next):
+        self.task_queue._queue_waiting_tasks_for_jobstep = MagicMock()
+        mock_get_next.side_effect = lambda key_prefix, after=None: {None: 1, 1: 2, 2: 3, 3: None}[after]
+
+        # Jobsteps without a limit over all jobsteps do not wait for other jobsteps
+        self.task_queue._queue_waiting_tasks('pref')
+        mock_get_next.assert_not_called()
+
+        # The waiting jobsteps are queued until the limit has been reached
+        mock_count.side_effect = [(1, 0), (2, 0), (3, 0)]
+        with patch("gobworkflow.task.queue.TASK_LIMITS", {'pref': 3}):
+            self.task_queue._queue_waiting_tasks('pref')
+        self.assertEqual([args[0] for args in self.task_queue._queue_waiting_tasks_for_jobstep.call_args_list],
+                         [(1, 'pref'), (2, 'pref')])
+
+        # All waiting jobsteps have been queued
+        self.task_queue._queue_waiting_tasks_for_jobstep.reset_mock()
+        mock_count.side_effect = None
+        mock_count.return_value = (0, 0)
+        with patch("gobworkflow.task.queue.TASK_LIMITS", {'pref': 3}):
+            self.task_queue._queue_waiting_tasks('pref')
+        self.assertEqual(self.task_queue._queue_waiting_tasks_for_jobstep.call_count, 3)
+
+    def test_task_request(self):
+        task = Task(id=123, name='task name', jobid=self.jobid, stepid=self.stepid, extra_msg={'extra': 'msg'},
+                    key_prefix='prefix', process_id=self.process_id, extra_header={'extra': 'header'})
 
-        mock_publish.assert_called_with(WORKFLOW_EXCHANGE, task.key_prefix + ".task.request", {
+        self.assertEqual(self.task_queue._task_request(task), (task.key_prefix + ".task.request", {
             'extra': 'msg',
             'taskid': task.id,
             'id': task.name,
@@ -199,54 +410,54 @@ class TestTaskQueue(TestCase):
                 'process_id': task.process_id,
                 'extra': 'header',
             }
-        })
-
-        mock_update.assert_called_with({
-            'id': task.id,
-            'start': now,
-            'status': self.task_queue.STATUS_QUEUED,
-        })
-
-    @patch("gobworkflow.task.queue.get_tasks_for_stepid")
-    def test_all_tasks_complete(self, mock_get_tasks):
-        mock_get_tasks.return_value = [
-            Task(name='task1', status=self.task_queue.STATUS_COMPLETED),
-            Task(name='task2', status=self.task_queue.STATUS_COMPLETED),
-        ]
-        self.assertTrue(self.task_queue._all_tasks_complete(self.stepid))
+        }))
 
-        mock_get_tasks.return_value = [
-            Task(name='task1', status=self.task_queue.STATUS_COMPLETED),
-            Task(name='task2', status=self.task_queue.STATUS_NEW),
-        ]
-        self.assertFalse(self.task_queue._all_tasks_complete(self.stepid))
-
-        mock_get_tasks.return_value = []
-        self.assertTrue(self.task_queue._all_tasks_complete(self.stepid))
+    def test_all_tasks_complete(self):
+        self.assertTrue(self.task_queue._all_tasks_complete({'total': 2, 'completed': 2}))
+        self.assertFalse(self.task_queue._all_tasks_complete({'total': 2, 'completed': 1}))
+        self.assertTrue(self.task_queue._all_tasks_complete({'total': 0, 'completed': 0}))
 
     @patch("gobworkflow.task.queue.task_get")
-    @patch("gobworkflow.task.queue.task_update")
-    def test_on_task_result(self, mock_task_update, mock_task_get):
+    @patch("gobworkflow.task.queue.task_end")
+    def test_on_task_result(self, mock_task_end, mock_task_get):
         self.task_queue._queue_free_tasks_for_jobstep = MagicMock()
+        self.task_queue._queue_waiting_tasks = MagicMock()
         self.task_queue._all_tasks_complete = MagicMock(return_value=False)
-        mock_task_get.return_value = Task(id=382, stepid=self.stepid)
+        mock_task_get.return_value = Task(id=382, name='task', stepid=self.stepid, key_prefix='pref')
 
         with freeze_time():
             self.task_queue.on_task_result(self.result_message)
             now = datetime.now()
 
-        mock_task_update.assert_called_with({
+        mock_task_end.assert_called_with({
             'id': 382,
             'status': self.task_queue.STATUS_COMPLETED,
             'summary': self.result_message['summary'],
             'end': now
         })
 
-        self.task_queue._queue_free_tasks_for_jobstep.assert_called_with(self.stepid)
+        self.task_queue._queue_free_tasks_for_jobstep.assert_called_with(self.stepid, 'pref', 'task')
+        self.task_queue._queue_waiting_tasks.assert_called_with('pref')
+        self.task_queue._all_tasks_complete.assert_called_with(mock_task_end.return_value)
+        self.mock_write_details.assert_called_with(self.stepid, 'task', self.result_message['summary'])
+
+    @patch("gobworkflow.task.queue.task_get")
+    @patch("gobworkflow.task.queue.task_end")
+    def test_on_task_result_ended(self, mock_task_end, mock_task_get):
+        self.task_queue._queue_free_tasks_for_jobstep = MagicMock()
+        self.task_queue._abort_tasks = MagicMock()
+        mock_task_get.return_value = Task(id=382, name='task', stepid=self.stepid, key_prefix='pref')
+        mock_task_end.return_value = None
+
+        self.task_queue.on_task_result(self.result_message)
+
+        self.task_queue._queue_free_tasks_for_jobstep.assert_not_called()
+        self.task_queue._abort_tasks.assert_not_called()
+        self.mock_write_details.assert_not_called()
 
     @patch("gobworkflow.task.queue.task_get")
-    @patch("gobworkflow.task.queue.task_update")
-    def test_on_task_result_failed(self, mock_task_update, mock_task_get):
+    @patch("gobworkflow.task.queue.task_end")
+    def test_on_task_result_failed(self, mock_task_end, mock_task_get):
         self.task_queue._abort_tasks = MagicMock()
         mock_task_get.return_value = Task(id=382, stepid=self.stepid)
         self.result_message['summary']['errors'] = ['error']
@@ -255,97 +466,138 @@ class TestTaskQueue(TestCase):
             self.task_queue.on_task_result(self.result_message)
             now = datetime.now()
 
-        mock_task_update.assert_called_with({
+        mock_task_end.assert_called_with({
             'id': 382,
             'status': self.task_queue.STATUS_FAILED,
             'summary': self.result_message['summary'],
             'end': now
         })
 
-        self.task_queue._abort_tasks.assert_called_with(self.stepid)
+        self.task_queue._abort_tasks.assert_called_with(mock_task_get.return_value)
 
     @patch("gobworkflow.task.queue.task_get")
-    @patch("gobworkflow.task.queue.task_update")
-    def test_on_task_result_complete(self, mock_task_update, mock_task_get):
+    @patch("gobworkflow.task.queue.task_end")
+    def test_on_task_result_complete(self, mock_task_end, mock_task_get):
         self.task_queue._queue_free_tasks_for_jobstep = MagicMock()
         self.task_queue._all_tasks_complete = MagicMock(return_value=True)
         self.task_queue._publish_complete = MagicMock()
-        mock_task_get.return_value = Task(id=382, stepid=self.stepid)
+        mock_task_get.return_value = Task(id=382, name='task', stepid=self.stepid, key_prefix='pref')
 
         with freeze_time():
             self.task_queue.on_task_result(self.result_message)
             now = datetime.now()
 
-        mock_task_update.assert_called_with({
+        mock_task_end.assert_called_with({
             'id': 382,
             'status': self.task_queue.STATUS_COMPLETED,
             'summary': self.result_message['summary'],
             'end': now
         })
 
-        self.task_queue._queue_free_tasks_for_jobstep.assert_called_with(self.stepid)
+        self.task_queue._queue_free_tasks_for_jobstep.assert_called_with(self.stepid, 'pref', 'task')
         self.task_queue._publish_complete.assert_called_with(mock_task_get.return_value)
 
-    @patch("gobworkflow.task.queue.task_update")
-    @patch("gobworkflow.task.queue.get_tasks_for_stepid")
-    @patch("gobworkflow.task.queue.task_lock")
-    @patch("gobworkflow.task.queue.task_unlock")
-    def test_abort_tasks(self, mock_unlock, mock_lock, mock_get_tasks, mock_update):
-        self.task_queue._publish_complete = MagicMock()
-        mock_lock.return_value = True
-        mock_get_tasks.return_value = [
-            Task(id=1, name='task1', status=self.task_queue.STATUS_COMPLETED),
-            Task(id=2, name='task2', status=self.task_queue.STATUS_NEW),
-        ]
-        self.task_queue._abort_tasks(self.stepid)
-        mock_get_tasks.assert_called_with(self.stepid)
-        mock_lock.assert_called_with(mock_get_tasks.return_value[1])
-        mock_unlock.assert_called_with(mock_get_tasks.return_value[1])
-        mock_update.assert_called_with({
-            'id': 2,
-            'status': self.task_queue.STATUS_ABORTED,
+    @patch("gobworkflow.task.queue.TASK_TIMEOUTS", {'pref': 60})
+    def test_timed_out(self):
+        now = datetime(2020, 1, 1, 12, 0, 0)
+        task = SimpleNamespace(key_prefix='pref', start=now - timedelta(seconds=90), retries=0)
+        self.assertTrue(self.task_queue._timed_out(task, now))
+
+        # The timeout doubles with every retry
+        task.retries = 1
+        self.assertFalse(self.task_queue._timed_out(task, now))
+        task.start = now - timedelta(seconds=121)
+        self.assertTrue(self.task_queue._timed_out(task, now))
+
+    @patch("gobworkflow.task.queue.tasks_claim_unpublished", MagicMock(return_value=[]))
+    @patch("gobworkflow.task.queue.get_queued_tasks")
+    @patch("gobworkflow.task.queue.TASK_TIMEOUTS", {'pref': 60})
+    @patch("gobworkflow.task.queue.TASK_MAX_ATTEMPTS", 3)
+    def test_check_timeouts(self, mock_get_queued):
+        self.task_queue.on_task_result = MagicMock()
+        self.task_queue._requeue_tasks = MagicMock()
+        with freeze_time():
+            now = datetime.now()
+            tasks = [
+                SimpleNamespace(id=1, name='task1', key_prefix='pref', start=now - timedelta(seconds=61), retries=0),
+                SimpleNamespace(id=2, name='task2', key_prefix='pref', start=now - timedelta(seconds=61), retries=1),
+                SimpleNamespace(id=3, name='task3', key_prefix='pref', start=now - timedelta(seconds=241), retries=2),
+            ]
+            mock_get_queued.return_value = tasks
+            self.task_queue.check_timeouts()
+
+        mock_get_queued.assert_called_once_with('pref', now - timedelta(seconds=60))
+        # Task 2 has been requeued and has a longer timeout, task 3 has had all its attempts
+        self.task_queue._requeue_tasks.assert_called_once_with([tasks[0]], now)
+        self.task_queue.on_task_result.assert_called_once_with({
+            'header': {'taskid': 3},
+            'summary': {'warnings': [], 'errors': ["Task task3 has not ended after 3 attempts"]}
         })
 
-        self.task_queue._publish_complete.assert_called_with(mock_get_tasks.return_value[0])
+    @patch("gobworkflow.task.queue.tasks_claim_unpublished", MagicMock(return_value=[]))
+    @patch("gobworkflow.task.queue.get_queued_tasks")
+    def test_check_timeouts_no_timeouts(self, mock_get_queued):
+        self.task_queue.check_timeouts()
+        mock_get_queued.assert_not_called()
 
-    @patch("gobworkflow.task.queue.task_update")
-    @patch("gobworkflow.task.queue.get_tasks_for_stepid")
-    @patch("gobworkflow.task.queue.task_lock")
-    @patch("gobworkflow.task.queue.task_unlock")
-    def test_abort_tasks_locked(self, mock_unlock, mock_lock, mock_get_tasks, mock_update):
+    @patch("gobworkflow.task.queue.tasks_claim_unpublished")
+    @patch("gobworkflow.task.queue.get_queued_tasks", MagicMock())
+    def test_check_timeouts_unpublished(self, mock_claim_unpublished):
+        self.task_queue._publish_requests = MagicMock()
+        mock_claim_unpublished.return_value = ['task']
+
+        with freeze_time():
+            self.task_queue.check_timeouts()
+            mock_claim_unpublished.assert_called_once_with(datetime.now())
+        self.task_queue._publish_requests.assert_called_once_with(['task'])
+
+    @patch("gobworkflow.task.queue.tasks_requeue")
+    @patch("gobworkflow.task.queue.publish_batch")
+    def test_requeue_tasks(self, mock_publish_batch, mock_requeue):
+        self.task_queue._task_request = MagicMock(side_effect=lambda task: ('key', {'header': {'taskid': task.id}}))
+        tasks = [SimpleNamespace(id=1, retries=0), SimpleNamespace(id=2, retries=1)]
+        mock_requeue.return_value = [SimpleNamespace(id=1, retries=1)]
+        mock_publish_batch.return_value = [True]
+
+        self.task_queue._requeue_tasks(tasks, 'now')
+        mock_requeue.assert_called_once_with([(1, 0), (2, 1)], 'now')
+        mock_publish_batch.assert_called_once_with(WORKFLOW_EXCHANGE, [('key', {'header': {'taskid': 1, 'attempt': 2}})])
+
+        # Unconfirmed requests are left to time out again
+        mock_publish_batch.return_value = [False]
+        self.task_queue._requeue_tasks(tasks, 'now')
+        self.assertEqual(mock_publish_batch.call_count, 2)
+
+        # No tasks are published if all tasks have ended or have been requeued concurrently
+        mock_publish_batch.reset_mock()
+        mock_requeue.return_value = []
+        self.task_queue._requeue_tasks(tasks, 'now')
+        mock_publish_batch.assert_not_called()
+
+    @patch("gobworkflow.task.queue.tasks_claim")
+    def test_abort_tasks(self, mock_claim):
         self.task_queue._publish_complete = MagicMock()
-        mock_lock.return_value = False
-        mock_get_tasks.return_value = [
-            Task(id=1, name='task1', status=self.task_queue.STATUS_COMPLETED),
-            Task(id=2, name='task2', status=self.task_queue.STATUS_NEW),
-        ]
+        self.task_queue.scheduler.forget = MagicMock()
+        task = Task(id=1, name='task1', stepid=self.stepid, status=self.task_queue.STATUS_FAILED)
 
-        self.task_queue._abort_tasks(self.stepid)
-        mock_lock.assert_called_with(mock_get_tasks.return_value[1])
-        mock_unlock.assert_not_called()
-        self.task_queue._publish_complete.assert_called_with(mock_get_tasks.return_value[0])
+        self.task_queue._abort_tasks(task)
+        self.task_queue.scheduler.forget.assert_called_with(self.stepid)
+        mock_claim.assert_called_with(self.stepid, None, self.task_queue.STATUS_NEW, {
+            'status': self.task_queue.STATUS_ABORTED,
+        })
 
-    @patch("gobworkflow.task.queue.get_tasks_for_stepid")
-    @patch("gobworkflow.task.queue.publish")
-    def test_publish_complete(self, mock_publish, mock_get_tasks):
-        summary1 = {
-            'warnings': ['w1', 'w2'],
-            'errors': [],
-        }
-        summary2 = {
-            'warnings': ['w3'],
-            'errors': ['e1'],
-        }
-        mock_get_tasks.return_value = [
-            Task(id=1, name='task1', status=self.task_queue.STATUS_COMPLETED, summary=summary1),
-            Task(id=2, name='task2', status=self.task_queue.STATUS_NEW, summary=summary2),
-        ]
+        self.task_queue._publish_complete.assert_called_with(task)
 
+    @patch("gobworkflow.task.queue.get_task_counts")
+    @patch("gobworkflow.task.queue.complete_summary")
+    @patch("gobworkflow.task.queue.publish")
+    def test_publish_complete(self, mock_publish, mock_complete_summary, mock_get_counts):
         task_arg = Task(stepid=self.stepid, jobid=self.jobid, key_prefix="prefix",
                         extra_msg={'extra': 'msg'}, extra_header={'extra': 'header'})
 
         self.task_queue._publish_complete(task_arg)
-        mock_get_tasks.assert_called_with(task_arg.stepid)
+        mock_get_counts.assert_called_with(task_arg.stepid)
+        mock_complete_summary.assert_called_with(task_arg.stepid, mock_get_counts.return_value)
 
         mock_publish.assert_called_with(WORKFLOW_EXCHANGE, task_arg.key_prefix + ".task.complete", {
             'extra': 'msg',
@@ -354,8 +606,5 @@ class TestTaskQueue(TestCase):
                 'stepid': self.stepid,
                 'extra': 'header',
             },
-            'summary': {
-                'warnings': ['w1', 'w2', 'w3'],
-                'errors': ['e1']
-            }
+            'summary': mock_complete_summary.return_value
         })
@@ -0,0 +1,154 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from gobworkflow.task.scheduler import StepGraph, Scheduler, topological_levels
+
+
+def _graph(durations=None):
+    tasks = [
+        ('a', []),
+        ('b', ['a']),
+        ('c', ['a']),
+        ('d', ['b', 'c']),
+    ]
+    return StepGraph(tasks, durations=durations)
+
+
+class TestStepGraph(TestCase):
+
+    def test_init(self):
+        graph = _graph()
+        self.assertEqual(graph.names, ['a', 'b', 'c', 'd'])
+        self.assertEqual(graph.dependents, {'a': ['b', 'c'], 'b': ['d'], 'c': ['d']})
+
+    def test_critical_paths(self):
+        graph = _graph()
+        self.assertEqual(graph.paths, {'a': 3.0, 'b': 2.0, 'c': 2.0, 'd': 1.0})
+        self.assertEqual(graph.longest, 3.0)
+
+        # Unknown durations are the average of the known durations
+        graph = _graph(durations={'a': 1.0, 'b': 10.0, 'd': 4.0})
+        self.assertEqual(graph.paths, {'a': 15.0, 'b': 14.0, 'c': 9.0, 'd': 4.0})
+        self.assertEqual([graph.priority(name) for name in 'abcd'], [9, 8, 5, 2])
+        self.assertEqual(graph.priority('x'), 0)
+
+    def test_order(self):
+        graph = _graph(durations={'a': 1.0, 'b': 1.0, 'c': 8.0, 'd': 1.0})
+
+        # The task with the longest critical path comes first
+        self.assertEqual(graph.order([(2, 'b'), (3, 'c')]), [(3, 8), (2, 2)])
+        self.assertEqual(graph.order([]), [])
+
+    def test_priorities(self):
+        graph = _graph(durations={'a': 1.0, 'b': 1.0, 'c': 8.0, 'd': 1.0})
+        self.assertEqual(graph.priorities([(2, 'b'), (3, 'c'), (5, 'x')]), [(2, 2.0, 2), (3, 9.0, 8), (5, 0, 0)])
+
+    def test_empty(self):
+        graph = StepGraph([])
+        self.assertEqual(graph.longest, 0)
+        self.assertEqual(graph.priority('a'), 0)
+
+
+class TestScheduler(TestCase):
+
+    def test_order(self):
+        load = MagicMock(side_effect=lambda stepid: _graph())
+        scheduler = Scheduler(load)
+
+        # Cache miss, load the graph
+        self.assertEqual(scheduler.order(1, [(1, 'a')]), [(1, 9)])
+        load.assert_called_once_with(1)
+
+        # Cache hit
+        self.assertEqual(scheduler.order(1, [(2, 'b'), (4, 'd')]), [(2, 6), (4, 3)])
+        load.assert_called_once_with(1)
+
+    def test_priorities(self):
+        load = MagicMock(side_effect=lambda stepid: _graph())
+        scheduler = Scheduler(load)
+        self.assertEqual(scheduler.priorities(1, [(2, 'b'), (4, 'd')]), [(2, 2.0, 6), (4, 1.0, 3)])
+
+    def test_dependents(self):
+        load = MagicMock(side_effect=lambda stepid: _graph())
+        scheduler = Scheduler(load)
+
+        self.assertEqual(scheduler.dependents(1, 'a'), ['b', 'c'])
+        self.assertEqual(scheduler.dependents(1, 'd'), [])
+        self.assertEqual(scheduler.dependents(1, 'x'), [])
+        load.assert_called_once_with(1)
+
+    def test_forget(self):
+        load = MagicMock(side_effect=lambda stepid: _graph())
+        scheduler = Scheduler(load)
+
+        scheduler.order(1, [])
+        scheduler.forget(1)
+        scheduler.forget(1)
+        scheduler.order(1, [])
+        self.assertEqual(load.call_count, 2)
+
+    def test_max_steps(self):
+        load = MagicMock(side_effect=lambda stepid: _graph())
+        scheduler = Scheduler(load, max_steps=2)
+
+        scheduler.order(1, [])
+        scheduler.order(2, [])
+        scheduler.order(1, [])
+        scheduler.order(3, [])
+        self.assertEqual(load.call_count, 3)
+
+        # Step 2 has been least recently used and has been dropped
+        scheduler.order(1, [])
+        self.assertEqual(load.call_count, 3)
+        scheduler.order(2, [])
+        self.assertEqual(load.call_count, 4)
+
+    def test_add(self):
+        load = MagicMock()
+        scheduler = Scheduler(load)
+
+        scheduler.add(1, _graph())
+        self.assertEqual(scheduler.dependents(1, 'a'), ['b', 'c'])
+        load.assert_not_called()
+
+
+class TestTopologicalLevels(TestCase):
+
+    def test_levels(self):
+        tasks = [
+            ('d', ['b', 'c']),
+            ('b', ['a']),
+            ('c', ['a', 'b']),
+            ('a', []),
+        ]
+        self.assertEqual(topological_levels(tasks), ({'a': 0, 'b': 1, 'c': 2, 'd': 3}, [], []))
+
+    def test_missing(self):
+        levels, missing, cycles = topological_levels([('a', ['x']), ('b', ['a', 'y'])])
+        self.assertEqual(missing, [('a', 'x'), ('b', 'y')])
+        self.assertEqual(cycles, [])
+
+    def test_cycles(self):
+        tasks = [
+            ('a', ['b']),
+            ('b', ['a']),
+            ('c', ['c']),
+            ('d', ['a']),
+            ('e', []),
+            ('f', ['g']),
+            ('g', ['h']),
+            ('h', ['f', 'e']),
+        ]
+        levels, missing, cycles = topological_levels(tasks)
+        self.assertEqual(levels, {'e': 0})
+        self.assertEqual(missing, [])
+        # d depends on a cycle but is not part of one
+        self.assertEqual(sorted(sorted(cycle) for cycle in cycles), [['a', 'b'], ['c'], ['f', 'g', 'h']])
+
+    def test_long_cycle(self):
+        # No recursion limit
+        n = 10000
+        levels, missing, cycles = topological_levels([(i, [(i + 1) % n]) for i in range(n)])
+        self.assertEqual(levels, {})
+        self.assertEqual(len(cycles), 1)
+        self.assertEqual(sorted(cycles[0]), list(range(n)))
@@ -0,0 +1,70 @@
+import json
+import os
+import tempfile
+
+from unittest import TestCase, mock
+
+from gobworkflow.task.summary import details_path, write_details, complete_summary, remove_old_details
+
+
+class TestSummary(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch("gobworkflow.task.summary.TASK_SUMMARY_DIR", os.path.join(self.dir.name, 'summaries'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.dir.cleanup)
+
+    def test_details_path(self):
+        self.assertEqual(details_path(123), os.path.join(self.dir.name, 'summaries', '123.ndjson'))
+
+    def test_write_details(self):
+        write_details(123, 'task 1', {'warnings': ['w1'], 'errors': []})
+        write_details(123, 'task 2', {'warnings': [], 'errors': []})
+        write_details(123, 'task 3', {'errors': ['e1', 'e2']})
+
+        with open(details_path(123)) as file:
+            lines = [json.loads(line) for line in file]
+        self.assertEqual(lines, [
+            {'task': 'task 1', 'warnings': ['w1'], 'errors': []},
+            {'task': 'task 3', 'warnings': [], 'errors': ['e1', 'e2']},
+        ])
+
+    def test_write_no_details(self):
+        write_details(123, 'task 1', {'warnings': [], 'errors': []})
+        self.assertFalse(os.path.exists(details_path(123)))
+
+    def test_complete_summary(self):
+        counts = {'warnings': 3, 'errors': 0, 'warnings_sample': ['w1', 'w2'], 'errors_sample': []}
+        self.assertEqual(complete_summary(123, counts), {
+            'warnings': ['w1', 'w2'],
+            'errors': [],
+            'counts': {'warnings': 3, 'errors': 0},
+            'details': None,
+        })
+
+        write_details(123, 'task 1', {'warnings': ['w1'], 'errors': []})
+        self.assertEqual(complete_summary(123, counts)['details'], details_path(123))
+
+    def test_remove_old_details(self):
+        write_details(123, 'task 1', {'warnings': ['w1'], 'errors': []})
+        write_details(124, 'task 1', {'warnings': ['w1'], 'errors': []})
+        old = os.path.getmtime(details_path(123)) - 31 * 24 * 60 * 60
+        os.utime(details_path(123), (old, old))
+
+        # Files that have not been written to during the retention period are removed
+        with mock.patch("gobworkflow.task.summary.TASK_SUMMARY_RETENTION", 0):
+            remove_old_details()
+        self.assertTrue(os.path.exists(details_path(123)))
+
+        with mock.patch("gobworkflow.task.summary.TASK_SUMMARY_RETENTION", 30):
+            remove_old_details()
+        self.assertFalse(os.path.exists(details_path(123)))
+        self.assertTrue(os.path.exists(details_path(124)))
+
+    @mock.patch("gobworkflow.task.summary.os.scandir")
+    def test_remove_old_details_no_dir(self, mock_scandir):
+        # Nothing has been written yet
+        remove_old_details()
+        mock_scandir.assert_not_called()
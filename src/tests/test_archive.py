@@ -0,0 +1,102 @@
+from unittest import TestCase, mock
+
+import datetime
+import gzip
+import os
+import tempfile
+
+from gobworkflow.storage.archive import _archive_path, _write_archive, archive_job_logs, \
+    get_jobs_to_archive, archive_logs, get_log_archive, read_archived_logs
+
+
+class MockArchive:
+
+    def __init__(self, path):
+        self.path = path
+
+
+class TestArchive(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @mock.patch("gobworkflow.storage.archive.LOG_ARCHIVE_DIR", "/any/dir")
+    def test_archive_path(self):
+        self.assertEqual(_archive_path(123), "/any/dir/123.ndjson.gz")
+
+    def test_write_archive(self):
+        connection = mock.MagicMock()
+        connection.execution_options.return_value.execute.return_value = [
+            {'logid': 1, 'timestamp': None},
+            {'logid': 2, 'timestamp': None},
+        ]
+        path = os.path.join(self.tmp_dir.name, "1.ndjson.gz")
+
+        result = _write_archive(connection, 1, path)
+
+        self.assertEqual(result, 2)
+        connection.execution_options.assert_called_with(stream_results=True)
+        with gzip.open(path, 'rt') as file:
+            self.assertEqual(file.read(), '{"logid": 1, "timestamp": null}\n{"logid": 2, "timestamp": null}\n')
+        self.assertFalse(os.path.exists(f"{path}.tmp"))
+
+    @mock.patch("gobworkflow.storage.archive._write_archive")
+    @mock.patch("gobworkflow.storage.archive.storage")
+    def test_archive_job_logs(self, mock_storage, mock_write_archive):
+        connection = mock_storage.engine.begin.return_value.__enter__.return_value
+        mock_write_archive.return_value = 5
+
+        result = archive_job_logs(1)
+
+        self.assertEqual(result, 5)
+        mock_write_archive.assert_called_with(connection, 1, _archive_path(1))
+        # Register archive and delete logs
+        self.assertEqual(connection.execute.call_count, 2)
+
+    @mock.patch("gobworkflow.storage.archive.storage")
+    def test_get_jobs_to_archive(self, mock_storage):
+        connection = mock_storage.engine.connect.return_value.__enter__.return_value
+        connection.execute.return_value = [(1,), (2,)]
+
+        result = get_jobs_to_archive(datetime.datetime.now())
+        self.assertEqual(result, [1, 2])
+
+    @mock.patch("gobworkflow.storage.archive.archive_job_logs")
+    @mock.patch("gobworkflow.storage.archive.get_jobs_to_archive")
+    def test_archive_logs(self, mock_get_jobs, mock_archive_job_logs):
+        mock_get_jobs.return_value = [1, 2]
+
+        with mock.patch("gobworkflow.storage.archive.LOG_ARCHIVE_DIR", self.tmp_dir.name), \
+                mock.patch("gobworkflow.storage.archive.LOG_ARCHIVE_AGE", 0):
+            archive_logs()
+            mock_get_jobs.assert_not_called()
+
+        with mock.patch("gobworkflow.storage.archive.LOG_ARCHIVE_DIR", self.tmp_dir.name), \
+                mock.patch("gobworkflow.storage.archive.LOG_ARCHIVE_AGE", 10):
+            archive_logs()
+
+        ended_before = mock_get_jobs.call_args[0][0]
+        self.assertLess(ended_before, datetime.datetime.utcnow() - datetime.timedelta(days=9))
+        self.assertEqual(mock_archive_job_logs.call_args_list, [mock.call(1), mock.call(2)])
+
+    @mock.patch("gobworkflow.storage.archive.storage")
+    def test_get_log_archive(self, mock_storage):
+        connection = mock_storage.engine.connect.return_value.__enter__.return_value
+
+        result = get_log_archive(1)
+        self.assertEqual(result, connection.execute.return_value.first.return_value)
+
+    @mock.patch("gobworkflow.storage.archive.get_log_archive")
+    def test_read_archived_logs(self, mock_get_log_archive):
+        mock_get_log_archive.return_value = None
+        self.assertEqual(list(read_archived_logs(1)), [])
+
+        path = os.path.join(self.tmp_dir.name, "1.ndjson.gz")
+        with gzip.open(path, 'wt') as file:
+            file.write('{"logid": 1}\n{"logid": 2}\n')
+        mock_get_log_archive.return_value = MockArchive(path)
+
+        self.assertEqual(list(read_archived_logs(1)), [{'logid': 1}, {'logid': 2}])
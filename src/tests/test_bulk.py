@@ -0,0 +1,170 @@
+from unittest import TestCase, mock
+
+import datetime
+import psycopg2
+from sqlalchemy.exc import DBAPIError
+
+from gobcore.model.sa.management import Log, AuditLog
+
+from gobworkflow.storage.bulk import _copy_value, _copy_data, _copy, _insert_rows, _to_rows, _bulk_save, \
+    copy_logs, copy_audit_logs, replay_spools, _replay_spool_dir
+from gobworkflow.storage.storage import update_log_counts
+from gobworkflow.config import LOG_BATCH_SIZE, LOG_SPOOL_ROOT, LOG_SPOOL_DIR
+
+
+class TestBulk(TestCase):
+
+    def test_copy_value(self):
+        table = Log.__table__
+        self.assertEqual(_copy_value(table.c.msg, None), '\\N')
+        self.assertEqual(_copy_value(table.c.msg, 'a\tb\nc\\d\re'), 'a\\tb\\nc\\\\d\\re')
+        self.assertEqual(_copy_value(table.c.jobid, 12), '12')
+        self.assertEqual(_copy_value(table.c.timestamp, datetime.datetime(2020, 6, 20, 12, 20, 20, 5)),
+                         '2020-06-20T12:20:20.000005')
+        self.assertEqual(_copy_value(table.c.data, {'a': 'b'}), '{"a": "b"}')
+        # Log data is stored as encoded json string, as SQLAlchemy does
+        self.assertEqual(_copy_value(table.c.data, '{"a": "b"}'), '"{\\\\"a\\\\": \\\\"b\\\\"}"')
+
+    def test_copy_data(self):
+        rows = [
+            {'msg': 'msg 1', 'jobid': 1},
+            {'msg': None, 'jobid': 2},
+        ]
+        data = _copy_data(Log.__table__, ['msg', 'jobid'], rows)
+        self.assertEqual(data.read(), 'msg 1\t1\n\\N\t2\n')
+
+    @mock.patch("gobworkflow.storage.bulk.storage")
+    def test_copy(self, mock_storage):
+        connection = mock_storage.engine.begin.return_value.__enter__.return_value
+        cursor = connection.connection.cursor.return_value.__enter__.return_value
+
+        _copy(Log.__table__, [{'msg': 'msg 1', 'jobid': 1}])
+        cursor.copy_expert.assert_called_with("COPY logs (msg, jobid) FROM STDIN", mock.ANY)
+
+        # on_save is called within the copy transaction
+        on_save = mock.MagicMock()
+        _copy(Log.__table__, [{'msg': 'msg 1', 'jobid': 1}], on_save)
+        on_save.assert_called_with(connection, [{'msg': 'msg 1', 'jobid': 1}])
+
+    @mock.patch("gobworkflow.storage.bulk.storage")
+    def test_copy_fails(self, mock_storage):
+        connection = mock_storage.engine.begin.return_value.__enter__.return_value
+        cursor = connection.connection.cursor.return_value.__enter__.return_value
+        cursor.copy_expert.side_effect = psycopg2.Error
+        on_save = mock.MagicMock()
+
+        with self.assertRaises(psycopg2.Error):
+            _copy(Log.__table__, [{'msg': 'msg 1', 'jobid': 1}], on_save)
+        on_save.assert_not_called()
+
+    @mock.patch("gobworkflow.storage.bulk.storage")
+    def test_insert_rows(self, mock_storage):
+        connection = mock_storage.engine.begin.return_value.__enter__.return_value
+        connection.execute.side_effect = [None, DBAPIError('stmt', {}, Exception()), None]
+        mock_storage.is_connected.return_value = True
+
+        # Any failing row is skipped
+        _insert_rows(Log.__table__, [{'msg': 'msg 1'}, {'msg': 'msg 2'}, {'msg': 'msg 3'}])
+        self.assertEqual(connection.execute.call_count, 3)
+
+        # Connection problems are raised
+        connection.execute.side_effect = DBAPIError('stmt', {}, Exception())
+        mock_storage.is_connected.return_value = False
+        with self.assertRaises(DBAPIError):
+            _insert_rows(Log.__table__, [{'msg': 'msg 1'}])
+
+        # on_save is called for each row within the row transaction
+        connection.execute.side_effect = None
+        on_save = mock.MagicMock()
+        _insert_rows(Log.__table__, [{'msg': 'msg 1'}, {'msg': 'msg 2'}], on_save)
+        self.assertEqual(on_save.call_args_list,
+                         [mock.call(connection, [{'msg': 'msg 1'}]), mock.call(connection, [{'msg': 'msg 2'}])])
+
+    def test_to_rows(self):
+        msgs = [
+            {'timestamp': '2020-06-20T12:20:20.000', 'id': 'any id'},
+            {'timestamp': 'invalid timestamp'},
+        ]
+        rows = _to_rows(Log, lambda msg: {
+            'timestamp': datetime.datetime.strptime(msg['timestamp'], '%Y-%m-%dT%H:%M:%S.%f'),
+            'msgid': msg.get('id')
+        }, msgs)
+        self.assertEqual(rows, [{'timestamp': datetime.datetime(2020, 6, 20, 12, 20, 20), 'id': 'any id'}])
+
+    @mock.patch("gobworkflow.storage.bulk._insert_rows")
+    @mock.patch("gobworkflow.storage.bulk._copy")
+    @mock.patch("gobworkflow.storage.bulk._to_rows")
+    def test_bulk_save(self, mock_to_rows, mock_copy, mock_insert_rows):
+        mock_to_rows.return_value = []
+        _bulk_save(Log, 'any values', ['any msg'])
+        mock_copy.assert_not_called()
+
+        mock_to_rows.return_value = ['any row']
+        _bulk_save(Log, 'any values', ['any msg'])
+        mock_to_rows.assert_called_with(Log, 'any values', ['any msg'])
+        mock_copy.assert_called_with(Log.__table__, ['any row'], None)
+        mock_insert_rows.assert_not_called()
+
+        # Fall back to row inserts
+        mock_copy.side_effect = psycopg2.Error
+        _bulk_save(Log, 'any values', ['any msg'], 'any on_save')
+        mock_insert_rows.assert_called_with(Log.__table__, ['any row'], 'any on_save')
+
+        # Also when on_save fails
+        mock_insert_rows.reset_mock()
+        mock_copy.side_effect = DBAPIError('stmt', {}, Exception())
+        _bulk_save(Log, 'any values', ['any msg'], 'any on_save')
+        mock_insert_rows.assert_called_with(Log.__table__, ['any row'], 'any on_save')
+
+    @mock.patch("gobworkflow.storage.bulk._bulk_save")
+    @mock.patch("gobworkflow.storage.bulk._audit_log_values")
+    @mock.patch("gobworkflow.storage.bulk._log_values")
+    @mock.patch("gobworkflow.storage.storage.log_spool.is_active", mock.MagicMock(return_value=False))
+    @mock.patch("gobworkflow.storage.storage.audit_log_spool.is_active", mock.MagicMock(return_value=False))
+    def test_copy_logs(self, mock_log_values, mock_audit_log_values, mock_bulk_save):
+        copy_logs(['any msg'])
+        mock_bulk_save.assert_called_with(Log, mock_log_values, ['any msg'], on_save=update_log_counts)
+
+        copy_audit_logs(['any msg'])
+        mock_bulk_save.assert_called_with(AuditLog, mock_audit_log_values, ['any msg'])
+
+    @mock.patch("gobworkflow.storage.bulk.replay_orphaned_spool_dirs")
+    @mock.patch("gobworkflow.storage.bulk._copy_audit_logs")
+    @mock.patch("gobworkflow.storage.bulk._copy_logs")
+    @mock.patch("gobworkflow.storage.bulk.audit_log_spool")
+    @mock.patch("gobworkflow.storage.bulk.log_spool")
+    @mock.patch("gobworkflow.storage.bulk.storage")
+    def test_replay_spools(self, mock_storage, mock_log_spool, mock_audit_log_spool, mock_copy_logs,
+                           mock_copy_audit_logs, mock_replay_orphaned):
+        mock_storage.is_connected.return_value = False
+        mock_storage.connect.return_value = False
+        replay_spools()
+        mock_log_spool.replay.assert_not_called()
+
+        mock_storage.connect.return_value = True
+        mock_log_spool.replay.return_value = 0
+        mock_audit_log_spool.replay.return_value = 0
+        replay_spools()
+        mock_log_spool.replay.assert_called_with(mock_copy_logs, LOG_BATCH_SIZE)
+        mock_audit_log_spool.replay.assert_called_with(mock_copy_audit_logs, LOG_BATCH_SIZE)
+        # The spool directories of stopped instances are replayed as well
+        mock_replay_orphaned.assert_called_with(LOG_SPOOL_ROOT, LOG_SPOOL_DIR, _replay_spool_dir)
+
+        # Replayed messages are reported
+        mock_log_spool.replay.return_value = 2
+        with mock.patch("builtins.print") as mock_print:
+            replay_spools()
+        mock_print.assert_called_once_with(f"Replayed 2 spooled messages from {mock_log_spool.path}")
+
+    @mock.patch("gobworkflow.storage.bulk._copy_audit_logs")
+    @mock.patch("gobworkflow.storage.bulk._copy_logs")
+    @mock.patch("gobworkflow.storage.bulk.Spool")
+    def test_replay_spool_dir(self, mock_spool, mock_copy_logs, mock_copy_audit_logs):
+        mock_spool.return_value.replay.return_value = 0
+        _replay_spool_dir('/any dir')
+
+        # The spools of the other instance are replayed like the own spools
+        self.assertEqual([args[0][0] for args in mock_spool.call_args_list],
+                         ['/any dir/logs.ndjson', '/any dir/audit_logs.ndjson'])
+        mock_spool.return_value.replay.assert_has_calls([mock.call(mock_copy_logs, LOG_BATCH_SIZE),
+                                                         mock.call(mock_copy_audit_logs, LOG_BATCH_SIZE)])
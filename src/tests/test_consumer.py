@@ -0,0 +1,152 @@
+from unittest import TestCase, mock
+
+from gobworkflow.consumer import Consumer, BatchConsumer, QueueConsumer
+
+
+class MockMethod:
+
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class TestConsumer(TestCase):
+
+    def test_consume(self):
+        # A consumer has to implement consume
+        with self.assertRaises(TypeError):
+            Consumer()
+
+
+class TestBatchConsumer(TestCase):
+
+    def setUp(self):
+        self.writer = mock.MagicMock()
+        self.writer.max_size = 10
+        self.writer.max_wait = 2
+        self.is_connected = mock.MagicMock(return_value=True)
+        self.consumer = BatchConsumer('any queue', self.writer, self.is_connected)
+
+    def test_init(self):
+        self.assertEqual(self.consumer.queue, 'any queue')
+        self.assertTrue(self.consumer.daemon)
+
+    @mock.patch("gobworkflow.consumer.time.sleep")
+    def test_run(self, mock_sleep):
+        # Consumption is restarted after any failure, KeyboardInterrupt is no Exception and ends the test
+        self.consumer.consume = mock.MagicMock(side_effect=[Exception, Exception, KeyboardInterrupt])
+        with self.assertRaises(KeyboardInterrupt):
+            self.consumer.run()
+        self.assertEqual(self.consumer.consume.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @mock.patch("gobworkflow.consumer.pika")
+    def test_consume(self, mock_pika):
+        channel = mock_pika.BlockingConnection.return_value.__enter__.return_value.channel.return_value
+        channel.consume.return_value = [
+            (MockMethod(1), None, '{"msg": 1}'),
+            (None, None, None),
+            (MockMethod(2), None, '{"msg": 2}'),
+        ]
+        self.writer.is_due.side_effect = [False, True, False]
+        self.consumer.flush = mock.MagicMock()
+
+        self.consumer.consume()
+
+        self.writer.discard.assert_called_once()
+        channel.basic_qos.assert_called_with(prefetch_count=10)
+        channel.consume.assert_called_with('any queue', inactivity_timeout=2)
+        self.writer.add.assert_has_calls([mock.call({'msg': 1}), mock.call({'msg': 2})])
+        self.consumer.flush.assert_called_once_with(channel)
+        self.assertEqual(self.consumer._last_tag, 2)
+
+    def test_flush(self):
+        channel = mock.MagicMock()
+        self.consumer._last_tag = 5
+
+        self.consumer.flush(channel)
+        self.writer.flush.assert_called_once()
+        channel.basic_ack.assert_called_with(delivery_tag=5, multiple=True)
+        channel.basic_nack.assert_not_called()
+
+    def test_add(self):
+        channel = mock.MagicMock()
+        self.writer.__len__.return_value = 0
+
+        self.consumer.add(channel, 1, '{"msg": 1}')
+        self.writer.add.assert_called_once_with({'msg': 1})
+        self.assertEqual(self.consumer._last_tag, 1)
+        channel.basic_ack.assert_not_called()
+
+        # An invalid message is skipped, nothing waits to be acknowledged
+        self.writer.add.reset_mock()
+        self.consumer.add(channel, 2, '{"msg"')
+        self.writer.add.assert_not_called()
+        channel.basic_ack.assert_called_once_with(delivery_tag=2)
+
+        # An invalid message is acknowledged with the waiting messages
+        channel.basic_ack.reset_mock()
+        self.writer.__len__.return_value = 1
+        self.consumer.add(channel, 3, 'not json')
+        self.assertEqual(self.consumer._last_tag, 3)
+        channel.basic_ack.assert_not_called()
+
+    def test_flush_fails(self):
+        channel = mock.MagicMock()
+        self.consumer._last_tag = 5
+        self.writer.flush.side_effect = Exception
+
+        # The storage is unreachable, the messages are requeued
+        self.is_connected.return_value = False
+        self.consumer.flush(channel)
+        channel.basic_nack.assert_called_with(delivery_tag=5, multiple=True, requeue=True)
+        channel.basic_ack.assert_not_called()
+
+        # The messages cannot be saved, they are dropped instead of being delivered again forever
+        channel.reset_mock()
+        self.is_connected.return_value = True
+        self.consumer.flush(channel)
+        channel.basic_ack.assert_called_with(delivery_tag=5, multiple=True)
+        channel.basic_nack.assert_not_called()
+
+
+class TestQueueConsumer(TestCase):
+
+    def setUp(self):
+        self.handler = mock.MagicMock()
+        self.servicedefinition = {
+            'any service': {
+                'queue': 'any queue',
+                'handler': self.handler
+            }
+        }
+        self.consumer = QueueConsumer('any name', self.servicedefinition, 5)
+
+    def test_init(self):
+        self.assertEqual(self.consumer.name, 'QueueConsumer any name')
+        self.assertEqual(self.consumer.prefetch_count, 5)
+        self.assertTrue(self.consumer.daemon)
+
+    @mock.patch("gobworkflow.consumer.pika")
+    def test_consume(self, mock_pika):
+        channel = mock_pika.BlockingConnection.return_value.__enter__.return_value.channel.return_value
+        self.consumer._on_message = mock.MagicMock()
+
+        self.consumer.consume()
+
+        channel.basic_qos.assert_called_with(prefetch_count=5)
+        self.consumer._on_message.assert_called_with(self.handler)
+        channel.basic_consume.assert_called_with(self.consumer._on_message.return_value, queue='any queue')
+        channel.start_consuming.assert_called_once()
+
+    def test_on_message(self):
+        channel = mock.MagicMock()
+        on_message = self.consumer._on_message(self.handler)
+
+        on_message(channel, MockMethod(3), None, '{"msg": 1}')
+        self.handler.assert_called_with({'msg': 1})
+        channel.basic_ack.assert_called_with(delivery_tag=3)
+
+        # Failed messages are acknowledged as well
+        self.handler.side_effect = Exception
+        on_message(channel, MockMethod(4), None, '{"msg": 2}')
+        channel.basic_ack.assert_called_with(delivery_tag=4)
@@ -1,21 +1,29 @@
 from unittest import TestCase, mock
-from collections import namedtuple
 
 import datetime
 
-from gobworkflow.heartbeats import on_heartbeat, check_services
+from gobcore.status.heartbeat import HEARTBEAT_INTERVAL
+
+import gobworkflow.heartbeats
+from gobworkflow.heartbeats import on_heartbeat, on_heartbeats, check_services, ServiceRegistry
+
 
 class TestHeartbeats(TestCase):
 
-    @mock.patch('gobworkflow.heartbeats.get_services')
-    @mock.patch('gobworkflow.heartbeats.update_service')
-    def test_on_heartbeat(self, update_service, get_services):
+    def setUp(self):
+        patcher = mock.patch('gobworkflow.heartbeats.registry', ServiceRegistry())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('gobworkflow.heartbeats.refresh_services')
+    @mock.patch('gobworkflow.heartbeats.update_services')
+    def test_on_heartbeat(self, update_services, refresh_services):
         service = {
             "name": "AnyService",
             "is_alive": True,
             "host": None,
             "pid": None,
-            "timestamp": datetime.datetime.now().isoformat(),
+            "timestamp": datetime.datetime(2020, 6, 20, 12, 20, 20).isoformat(),
         }
         msg = {
             "threads": [
@@ -30,79 +38,161 @@ class TestHeartbeats(TestCase):
             ]
         }
         msg.update(service)
+        refresh_services.return_value = set()
 
         on_heartbeat(msg)
 
-        self.assertEqual(update_service.call_count, 1)
-
-        service_parameter, tasks = update_service.call_args[0]
+        self.assertEqual(update_services.call_count, 1)
+        [(service_parameter, tasks)] = update_services.call_args[0][0]
         self.assertEqual(service_parameter, service)
         self.assertEqual(len(tasks), len(msg["threads"]))
+        refresh_services.assert_called_with([])
 
-    @mock.patch('gobworkflow.heartbeats.update_service')
-    @mock.patch('gobworkflow.heartbeats.get_services')
-    @mock.patch('gobworkflow.heartbeats.remove_service')
-    @mock.patch('gobworkflow.heartbeats.mark_service_dead')
-    def test_check_services(self, mark_service_dead, remove_service, get_services, update_service):
-        service = {
-            "name": "AnyService",
-            "is_alive": True,
-            "timestamp": (datetime.datetime.now() - datetime.timedelta(hours=1)).isoformat(),
-        }
-        msg = {
-            "threads": [
-                {
-                    "name": "thread1",
-                    "is_alive": True
-                },
-                {
-                    "name": "thread2",
-                    "is_alive": False
-                }
-            ]
-        }
-        msg.update(service)
-
-        get_services.return_value = []
+        # Only the timestamp of an unchanged service is stored
+        refresh_services.return_value = {("AnyService", None)}
+        on_heartbeat(msg)
+        self.assertEqual(update_services.call_count, 1)
+        refresh_services.assert_called_with([("AnyService", None, True, datetime.datetime(2020, 6, 20, 12, 20, 20))])
 
+        # An unchanged service that is stored with another liveness, eg by another workflow instance, is stored
+        refresh_services.return_value = set()
         on_heartbeat(msg)
+        self.assertEqual(update_services.call_count, 2)
 
-        # Assure that the service has been marked dead because of a heartbeat timeout
-        self.assertEqual(get_services.call_count, 1)
-        self.assertEqual(remove_service.call_count, 0)
-        self.assertEqual(mark_service_dead.call_count, 0)
+        # A changed service is stored
+        msg["threads"][1]["is_alive"] = True
+        on_heartbeat(msg)
+        self.assertEqual(update_services.call_count, 3)
+
+    @mock.patch('gobworkflow.heartbeats.refresh_services')
+    @mock.patch('gobworkflow.heartbeats.update_services')
+    def test_on_heartbeats(self, update_services, refresh_services):
+        def heartbeat(name, timestamp, threads):
+            return {
+                "name": name,
+                "host": "any host",
+                "pid": 123,
+                "is_alive": True,
+                "timestamp": timestamp,
+                "threads": [{"name": thread, "is_alive": True} for thread in threads]
+            }
+
+        refresh_services.return_value = set()
+        on_heartbeats([
+            heartbeat("AnyService", "2020-06-20T12:20:22.000000", ["thread2"]),
+            heartbeat("AnyService", "2020-06-20T12:20:20.000000", ["thread1"]),
+            heartbeat("OtherService", "2020-06-20T12:20:21.000000", ["thread1"]),
+            heartbeat("AnyService", "2020-06-20T12:20:21.000000", ["thread1"]),
+        ])
+
+        # Only the newest heartbeat of each service is stored, in one transaction
+        update_services.assert_called_once()
+        services = sorted(update_services.call_args[0][0], key=lambda service: service[0]["name"])
+        self.assertEqual([(service["name"], service["timestamp"], [task["name"] for task in tasks])
+                          for service, tasks in services], [
+            ("AnyService", "2020-06-20T12:20:22.000000", ["thread2"]),
+            ("OtherService", "2020-06-20T12:20:21.000000", ["thread1"]),
+        ])
+
+        # The timestamps of unchanged services are refreshed with one statement
+        update_services.reset_mock()
+        refresh_services.return_value = {("AnyService", "any host")}
+        on_heartbeats([
+            heartbeat("AnyService", "2020-06-20T12:20:32.000000", ["thread2"]),
+            heartbeat("OtherService", "2020-06-20T12:20:31.000000", ["thread1", "thread2"]),
+        ])
+        refresh_services.assert_called_with([
+            ("AnyService", "any host", True, datetime.datetime(2020, 6, 20, 12, 20, 32))
+        ])
+        services = update_services.call_args[0][0]
+        self.assertEqual([service["name"] for service, _ in services], ["OtherService"])
+
+        update_services.reset_mock()
+        on_heartbeats([heartbeat("AnyService", "2020-06-20T12:20:42.000000", ["thread2"])])
+        update_services.assert_not_called()
+
+        # Invalid heartbeats are skipped, the other heartbeats are stored
+        invalid = heartbeat("AnyService", "2020-06-20T12:20:52.000000", ["thread3"])
+        del invalid["is_alive"]
+        with mock.patch("builtins.print") as mock_print:
+            on_heartbeats([
+                invalid,
+                heartbeat("AnyService", "not a timestamp", ["thread3"]),
+                heartbeat("OtherService", "2020-06-20T12:20:51.000000", ["thread1"]),
+            ])
+        self.assertEqual(mock_print.call_count, 2)
+        services = update_services.call_args[0][0]
+        self.assertEqual([service["name"] for service, _ in services], ["OtherService"])
+
+    @mock.patch('gobworkflow.heartbeats.sweep_services')
+    @mock.patch('gobworkflow.heartbeats.datetime')
+    def test_check_services(self, mock_datetime, mock_sweep_services):
+        now = datetime.datetime(2020, 6, 20, 12, 20, 20)
+        mock_datetime.datetime.utcnow.return_value = now
+        mock_datetime.timedelta = datetime.timedelta
+        mock_sweep_services.return_value = [], []
+
+        check_services()
+        mock_sweep_services.assert_called_with(dead_before=now - datetime.timedelta(seconds=HEARTBEAT_INTERVAL),
+                                               remove_before=now - datetime.timedelta(seconds=HEARTBEAT_INTERVAL * 60))
+
+        # The registry is updated with the result
+        registry = gobworkflow.heartbeats.registry
+        for name in ["DeadService", "RemovedService"]:
+            registry.register({"name": name, "host": "any host", "pid": 1, "is_alive": True,
+                               "timestamp": "2020-06-20T12:00:00.000000"}, [])
+        mock_sweep_services.return_value = [("DeadService", "any host")], [("RemovedService", "any host")]
+
+        check_services()
+        alive = {"name": "DeadService", "host": "any host", "pid": 1, "is_alive": True}
+        self.assertTrue(registry.needs_update(alive, []))
+        self.assertFalse(registry.needs_update({**alive, "is_alive": False}, []))
+        self.assertTrue(registry.needs_update({**alive, "name": "RemovedService", "is_alive": False}, []))
+
+
+class TestServiceRegistry(TestCase):
+
+    def setUp(self):
+        self.registry = ServiceRegistry()
+        self.service = {
+            "name": "AnyService",
+            "host": "any host",
+            "pid": 123,
+            "is_alive": True,
+            "timestamp": "2020-06-20T12:20:20.000123"
+        }
+        self.tasks = [{"name": "thread1", "is_alive": True}, {"name": "thread2", "is_alive": True}]
 
-        Service = namedtuple('Service', ['timestamp'])
-        service = Service(datetime.datetime.utcnow())
-        get_services.return_value = [service]
-        get_services.reset_mock()
+    def test_needs_update(self):
+        self.assertTrue(self.registry.needs_update(self.service, self.tasks))
 
-        on_heartbeat(msg)
+        self.registry.register(self.service, self.tasks)
+        self.assertFalse(self.registry.needs_update(self.service, self.tasks))
 
-        # Assure that the service has been marked dead because of a heartbeat timeout
-        self.assertEqual(get_services.call_count, 1)
-        self.assertEqual(remove_service.call_count, 0)
-        self.assertEqual(mark_service_dead.call_count, 0)
+        # The order of the tasks is not relevant
+        self.assertFalse(self.registry.needs_update(self.service, list(reversed(self.tasks))))
 
-        service = Service(datetime.datetime.utcnow() - datetime.timedelta(minutes=15))
-        get_services.return_value = [service]
-        get_services.reset_mock()
+        # Changes in liveness, pid or tasks
+        self.assertTrue(self.registry.needs_update({**self.service, "is_alive": False}, self.tasks))
+        self.assertTrue(self.registry.needs_update({**self.service, "pid": 456}, self.tasks))
+        self.assertTrue(self.registry.needs_update(self.service, self.tasks[:1]))
+        self.assertTrue(self.registry.needs_update(self.service, [{"name": "thread1", "is_alive": False}]))
 
-        on_heartbeat(msg)
+        # Another host is another service
+        self.assertTrue(self.registry.needs_update({**self.service, "host": "other host"}, self.tasks))
 
-        # Assure that the service has been marked dead because of a heartbeat timeout
-        self.assertEqual(get_services.call_count, 1)
-        self.assertEqual(remove_service.call_count, 0)
-        self.assertEqual(mark_service_dead.call_count, 1)
+    def test_mark_dead(self):
+        # Unknown services are ignored
+        self.registry.mark_dead(self.service)
 
-        service = Service(datetime.datetime.utcnow() - datetime.timedelta(days=1))
-        get_services.return_value = [service]
-        get_services.reset_mock()
-        mark_service_dead.reset_mock()
+        self.registry.register(self.service, self.tasks)
+        self.registry.mark_dead(self.service)
+        self.assertTrue(self.registry.needs_update(self.service, self.tasks))
+        self.assertFalse(self.registry.needs_update({**self.service, "is_alive": False}, []))
 
-        on_heartbeat(msg)
+    def test_remove(self):
+        self.registry.remove(self.service)
 
-        # Assure that the service has been marked dead because of a heartbeat timeout
-        self.assertEqual(get_services.call_count, 1)
-        self.assertEqual(remove_service.call_count, 1)
-        self.assertEqual(mark_service_dead.call_count, 0)
+        self.registry.register(self.service, self.tasks)
+        self.registry.remove(self.service)
+        self.assertTrue(self.registry.needs_update(self.service, self.tasks))
@@ -0,0 +1,60 @@
+from unittest import TestCase, mock
+
+from gobworkflow.storage.log_writer import BufferedWriter
+
+
+class TestBufferedWriter(TestCase):
+
+    def setUp(self):
+        self.save = mock.MagicMock()
+        self.writer = BufferedWriter(self.save, max_size=3, max_wait=5)
+
+    def test_add(self):
+        self.assertEqual(len(self.writer), 0)
+        self.writer.add({'msg': 'any msg'})
+        self.assertEqual(len(self.writer), 1)
+
+    def test_is_due_empty(self):
+        self.assertFalse(self.writer.is_due())
+
+    @mock.patch("gobworkflow.storage.log_writer.time.monotonic")
+    def test_is_due_size(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        self.writer.add({})
+        self.writer.add({})
+        self.assertFalse(self.writer.is_due())
+        self.writer.add({})
+        self.assertTrue(self.writer.is_due())
+
+    @mock.patch("gobworkflow.storage.log_writer.time.monotonic")
+    def test_is_due_wait(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        self.writer.add({})
+        mock_monotonic.return_value = 104
+        self.writer.add({})
+        self.assertFalse(self.writer.is_due())
+        mock_monotonic.return_value = 105
+        self.assertTrue(self.writer.is_due())
+
+    def test_discard(self):
+        self.writer.add({})
+        self.writer.discard()
+        self.assertEqual(len(self.writer), 0)
+        self.save.assert_not_called()
+
+    def test_flush(self):
+        self.assertEqual(self.writer.flush(), 0)
+        self.save.assert_not_called()
+
+        self.writer.add({'msg': 1})
+        self.writer.add({'msg': 2})
+        self.assertEqual(self.writer.flush(), 2)
+        self.save.assert_called_with([{'msg': 1}, {'msg': 2}])
+        self.assertEqual(len(self.writer), 0)
+
+    def test_flush_fails(self):
+        self.save.side_effect = Exception
+        self.writer.add({})
+        with self.assertRaises(Exception):
+            self.writer.flush()
+        self.assertEqual(len(self.writer), 0)
@@ -0,0 +1,66 @@
+from unittest import TestCase, mock
+
+import io
+
+from gobworkflow.storage.logs import get_logs, stream_logs, export_logs
+
+
+class TestLogs(TestCase):
+
+    @mock.patch("gobworkflow.storage.logs.storage")
+    def test_get_logs(self, mock_storage):
+        connection = mock_storage.engine.connect.return_value.__enter__.return_value
+        connection.execute.return_value = [{'logid': 3}, {'logid': 2}]
+
+        logs, before = get_logs(1, limit=2)
+        self.assertEqual(logs, [{'logid': 3}, {'logid': 2}])
+        # A full page, there may be more logs
+        self.assertEqual(before, 2)
+
+        query = str(connection.execute.call_args[0][0])
+        self.assertIn("WHERE logs.jobid = ", query)
+        self.assertIn("ORDER BY logs.logid DESC", query)
+        self.assertNotIn("logs.stepid =", query)
+        self.assertNotIn("logs.logid <", query)
+
+        logs, before = get_logs(1, stepid=2, before=2, limit=10)
+        self.assertIsNone(before)
+        query = str(connection.execute.call_args[0][0])
+        self.assertIn("logs.stepid =", query)
+        self.assertIn("logs.logid <", query)
+
+    @mock.patch("gobworkflow.storage.logs.get_log_archive", mock.MagicMock(return_value=None))
+    @mock.patch("gobworkflow.storage.logs.storage")
+    def test_stream_logs(self, mock_storage):
+        connection = mock_storage.engine.connect.return_value.__enter__.return_value
+        connection.execution_options.return_value.execute.return_value = [{'logid': 1}, {'logid': 2}]
+
+        result = list(stream_logs(1, 2))
+        self.assertEqual(result, [{'logid': 1}, {'logid': 2}])
+
+        # The logs are read through a server side cursor
+        connection.execution_options.assert_called_with(stream_results=True)
+        query = str(connection.execution_options.return_value.execute.call_args[0][0])
+        self.assertIn("logs.stepid =", query)
+        self.assertIn("ORDER BY logs.logid", query)
+
+    @mock.patch("gobworkflow.storage.logs.read_archived_logs")
+    @mock.patch("gobworkflow.storage.logs.get_log_archive", mock.MagicMock())
+    @mock.patch("gobworkflow.storage.logs.storage")
+    def test_stream_archived_logs(self, mock_storage, mock_read_archived_logs):
+        mock_read_archived_logs.return_value = iter([{'logid': 1, 'stepid': 2}, {'logid': 2, 'stepid': 3}])
+
+        result = list(stream_logs(1, 2))
+        self.assertEqual(result, [{'logid': 1, 'stepid': 2}])
+        mock_read_archived_logs.assert_called_with(1)
+        mock_storage.engine.connect.assert_not_called()
+
+    @mock.patch("gobworkflow.storage.logs.stream_logs")
+    def test_export_logs(self, mock_stream_logs):
+        mock_stream_logs.return_value = iter([{'logid': 1, 'timestamp': None}, {'logid': 2, 'timestamp': None}])
+        file = io.StringIO()
+
+        result = export_logs(1, file, 2)
+        self.assertEqual(result, 2)
+        mock_stream_logs.assert_called_with(1, 2)
+        self.assertEqual(file.getvalue(), '{"logid": 1, "timestamp": null}\n{"logid": 2, "timestamp": null}\n')
@@ -4,6 +4,7 @@ import importlib
 from unittest import TestCase, mock
 
 from gobcore.status.heartbeat import STATUS_FAIL
+from gobcore.message_broker.config import LOG_QUEUE, AUDIT_LOG_QUEUE, HEARTBEAT_QUEUE
 from collections import namedtuple
 
 class MockWorkflow:
@@ -36,6 +37,51 @@ class TestMain(TestCase):
         # Should connect to the storage
         mock_connect.assert_called_with(force_migrate=True)
 
+    @mock.patch('gobcore.logging.logger.logger', mock.MagicMock())
+    @mock.patch('gobcore.message_broker.messagedriven_service.messagedriven_service')
+    @mock.patch('gobworkflow.storage.storage.connect')
+    @mock.patch('gobworkflow.consumer.QueueConsumer')
+    @mock.patch('gobworkflow.consumer.BatchConsumer')
+    @mock.patch('gobworkflow.periodic.Periodic')
+    @mock.patch('gobcore.status.heartbeat.Heartbeat')
+    @mock.patch('gobcore.message_broker.publish')
+    @mock.patch('gobworkflow.storage.spool.lock_spool_dir', mock.MagicMock())
+    @mock.patch('time.sleep')
+    def test_threaded(self, mock_sleep, mock_publish, mock_heartbeat, mock_periodic, mock_batch_consumer,
+                      mock_queue_consumer, mock_connect, mock_messagedriven_service):
+        sys.argv = ['python -m gobworkflow', '--threaded']
+
+        # The first import of __main__ in the test run executes the module as well
+        mock_queue_consumer.return_value.is_alive.return_value = False
+        from gobworkflow import __main__
+        groups = len(__main__.CONSUMER_GROUPS)
+        for mock_object in [mock_batch_consumer, mock_periodic, mock_queue_consumer, mock_heartbeat, mock_sleep]:
+            mock_object.reset_mock()
+        # Heartbeats are sent while all consumers are alive, a failing heartbeat does not stop the service
+        mock_queue_consumer.return_value.is_alive.side_effect = [True] * 2 * groups + [False]
+        mock_heartbeat.return_value.send.side_effect = [Exception, None]
+        importlib.reload(__main__)
+
+        mock_messagedriven_service.assert_not_called()
+        # Log messages are still saved in batches and periodic maintenance is still started
+        self.assertEqual([args[0][0] for args in mock_batch_consumer.call_args_list], [LOG_QUEUE, AUDIT_LOG_QUEUE])
+        self.assertEqual(mock_batch_consumer.return_value.start.call_count, 2)
+        self.assertEqual(mock_periodic.return_value.start.call_count, mock_periodic.call_count)
+        mock_periodic.return_value.start.assert_called()
+        # Every consumer group is consumed on its own thread
+        self.assertEqual(mock_queue_consumer.call_count, groups)
+        name, servicedefinition, prefetch_count = mock_queue_consumer.call_args_list[0][0]
+        self.assertEqual(name, 'workflow')
+        self.assertEqual(servicedefinition['step_completed'], __main__.SERVICEDEFINITION['step_completed'])
+        self.assertEqual(mock_queue_consumer.return_value.start.call_count, groups)
+        # The main thread sends the heartbeats of the service
+        connection, name = mock_heartbeat.call_args[0]
+        self.assertEqual(name, "Workflow")
+        self.assertEqual(mock_heartbeat.return_value.send.call_count, 2)
+        self.assertEqual(mock_sleep.call_count, 2)
+        connection.publish('any exchange', 'any key', 'any msg')
+        mock_publish.assert_called_with('any exchange', 'any key', 'any msg')
+
     @mock.patch('gobcore.logging.logger.logger', mock.MagicMock())
     @mock.patch('gobcore.message_broker.messagedriven_service.messagedriven_service')
     @mock.patch('gobworkflow.storage.storage.connect')
@@ -43,21 +89,43 @@ class TestMain(TestCase):
     @mock.patch('gobworkflow.workflow.jobs.step_status')
     @mock.patch('gobworkflow.workflow.workflow.Workflow')
     @mock.patch('gobworkflow.workflow.hooks.handle_result')
-    def test_main(self, mock_handle, mock_workflow, mock_status, mock_get_job_step, mock_connect, mock_messagedriven_service):
+    @mock.patch('gobworkflow.consumer.BatchConsumer')
+    @mock.patch('gobworkflow.periodic.Periodic')
+    @mock.patch('gobworkflow.storage.spool.lock_spool_dir')
+    def test_main(self, mock_lock_spool_dir, mock_periodic, mock_consumer, mock_handle, mock_workflow, mock_status, mock_get_job_step,
+                  mock_connect, mock_messagedriven_service):
 
         # With command line arguments
         sys.argv = ['python -m gobworkflow']
 
+        # The first import of __main__ in the test run executes the module as well
         from gobworkflow import __main__
+        mock_consumer.reset_mock()
+        mock_periodic.reset_mock()
         importlib.reload(__main__)
 
         # Should connect to the storage
         mock_connect.assert_called_with()
+        # Should lock its spool directory
+        mock_lock_spool_dir.assert_called_with(__main__.LOG_SPOOL_DIR)
+        # Should consume the log queues in batches
+        self.assertEqual([args[0][0] for args in mock_consumer.call_args_list], [LOG_QUEUE, AUDIT_LOG_QUEUE])
+        self.assertEqual(mock_consumer.return_value.start.call_count, 2)
+        # Should start periodic maintenance
+        mock_periodic.return_value.start.assert_called()
         # Should start as a service
         mock_messagedriven_service.assert_called_with(__main__.SERVICEDEFINITION,
                                                  "Workflow",
                                                       {'prefetch_count': 1, 'load_message': False})
 
+        # Heartbeats can be consumed in batches instead of by the message driven service
+        sys.argv = ['python -m gobworkflow', '--coalesce-heartbeats']
+        mock_consumer.reset_mock()
+        importlib.reload(__main__)
+        self.assertNotIn('heartbeat_monitor', __main__.SERVICEDEFINITION)
+        self.assertEqual([args[0][0] for args in mock_consumer.call_args_list],
+                         [LOG_QUEUE, AUDIT_LOG_QUEUE, HEARTBEAT_QUEUE])
+
         mock_get_job_step.return_value = namedtuple('Job', ['type'])('any jobtype'),\
                                          namedtuple('Step', ['name'])('any stepname')
 
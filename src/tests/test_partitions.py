@@ -0,0 +1,72 @@
+from unittest import TestCase, mock
+
+import datetime
+
+from gobworkflow.storage.partitions import _add_months, _partition_name, _get_partitions, _create_partitions, \
+    _detach_partitions, maintain_log_partitions
+
+
+class TestPartitions(TestCase):
+
+    def test_add_months(self):
+        self.assertEqual(_add_months(datetime.date(2020, 6, 1), 1), datetime.date(2020, 7, 1))
+        self.assertEqual(_add_months(datetime.date(2020, 12, 1), 1), datetime.date(2021, 1, 1))
+        self.assertEqual(_add_months(datetime.date(2020, 1, 1), -1), datetime.date(2019, 12, 1))
+        self.assertEqual(_add_months(datetime.date(2020, 6, 1), -12), datetime.date(2019, 6, 1))
+
+    def test_partition_name(self):
+        self.assertEqual(_partition_name(datetime.date(2020, 6, 1)), "logs_y2020m06")
+
+    def test_get_partitions(self):
+        connection = mock.MagicMock()
+        connection.execute.return_value = [("logs_y2020m07",), ("logs_legacy",), ("logs_y2020m06",)]
+        result = _get_partitions(connection)
+        self.assertEqual(result, [datetime.date(2020, 6, 1), datetime.date(2020, 7, 1)])
+
+    @mock.patch("gobworkflow.storage.partitions.PARTITIONS_AHEAD", 2)
+    def test_create_partitions(self):
+        connection = mock.MagicMock()
+        this_month = datetime.date(2020, 6, 1)
+
+        _create_partitions(connection, [datetime.date(2020, 7, 1)], this_month)
+        connection.execute.assert_called_once_with(
+            "CREATE TABLE logs_y2020m08 PARTITION OF logs FOR VALUES FROM ('2020-08-01') TO ('2020-09-01')")
+
+        # Without monthly partitions, start after the current month
+        connection.reset_mock()
+        _create_partitions(connection, [], this_month)
+        self.assertEqual(connection.execute.call_count, 2)
+
+        # Nothing to create
+        connection.reset_mock()
+        _create_partitions(connection, [datetime.date(2020, 8, 1)], this_month)
+        connection.execute.assert_not_called()
+
+    @mock.patch("gobworkflow.storage.partitions.LOG_PARTITION_RETENTION", 12)
+    def test_detach_partitions(self):
+        connection = mock.MagicMock()
+        partitions = [datetime.date(2019, 5, 1), datetime.date(2019, 6, 1), datetime.date(2020, 6, 1)]
+
+        _detach_partitions(connection, partitions, datetime.date(2020, 6, 1))
+        connection.execute.assert_called_once_with("ALTER TABLE logs DETACH PARTITION logs_y2019m05")
+
+    @mock.patch("gobworkflow.storage.partitions.LOG_PARTITION_RETENTION", 0)
+    def test_detach_partitions_no_retention(self):
+        connection = mock.MagicMock()
+
+        _detach_partitions(connection, [datetime.date(2000, 1, 1)], datetime.date(2020, 6, 1))
+        connection.execute.assert_not_called()
+
+    @mock.patch("gobworkflow.storage.partitions._detach_partitions")
+    @mock.patch("gobworkflow.storage.partitions._create_partitions")
+    @mock.patch("gobworkflow.storage.partitions._get_partitions")
+    @mock.patch("gobworkflow.storage.partitions.storage")
+    def test_maintain_log_partitions(self, mock_storage, mock_get, mock_create, mock_detach):
+        connection = mock_storage.engine.begin.return_value.__enter__.return_value
+
+        maintain_log_partitions()
+
+        mock_get.assert_called_with(connection)
+        this_month = datetime.date.today().replace(day=1)
+        mock_create.assert_called_with(connection, mock_get.return_value, this_month)
+        mock_detach.assert_called_with(connection, mock_get.return_value, this_month)
@@ -0,0 +1,34 @@
+from unittest import TestCase, mock
+
+from gobworkflow.periodic import Periodic
+
+
+class TestPeriodic(TestCase):
+
+    def test_init(self):
+        def any_func():
+            pass
+
+        periodic = Periodic(10, any_func)
+        self.assertEqual(periodic.interval, 10)
+        self.assertEqual(periodic.func, any_func)
+        self.assertEqual(periodic.name, "Periodic any_func")
+        self.assertTrue(periodic.daemon)
+
+    def test_run(self):
+        func = mock.MagicMock(__name__="func")
+        periodic = Periodic(10, func)
+        periodic._stopped = mock.MagicMock()
+        periodic._stopped.is_set.side_effect = [False, False, True]
+
+        # Exceptions do not stop the periodic run
+        func.side_effect = [Exception, None]
+        periodic.run()
+
+        self.assertEqual(func.call_count, 2)
+        periodic._stopped.wait.assert_called_with(10)
+
+    def test_stop(self):
+        periodic = Periodic(10, mock.MagicMock(__name__="func"))
+        periodic.stop()
+        self.assertTrue(periodic._stopped.is_set())
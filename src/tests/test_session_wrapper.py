@@ -67,6 +67,16 @@ class TestAutoReconnect(TestCase):
         with self.assertRaises(Exception):
             obj.exec(lambda: raise_exception())
 
+    def test_reconnect_already_connected(self):
+        # Another thread has restored the connection
+        mock_connect = mock.MagicMock()
+        mock_disconnect = mock.MagicMock()
+        obj = AutoReconnector(is_connected=lambda: True, connect=mock_connect, disconnect=mock_disconnect)
+
+        obj.reconnect()
+        mock_disconnect.assert_not_called()
+        mock_connect.assert_not_called()
+
     def test_max_reconnects(self):
         is_connected = lambda: False
         mock_connect = lambda: False
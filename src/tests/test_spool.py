@@ -0,0 +1,152 @@
+from unittest import TestCase, mock
+
+import io
+import os
+import tempfile
+
+from gobworkflow.storage.spool import _read_batches, _lock, Spool, spool_wrapper, lock_spool_dir, \
+    replay_orphaned_spool_dirs
+
+
+class TestSpool(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "spool", "logs.ndjson")
+        self.spool = Spool(self.path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_read_batches(self):
+        file = io.StringIO('{"msg": 1}\n{"msg": 2}\n{"msg": 3}\n{"msg"')
+        result = list(_read_batches(file, 2))
+        self.assertEqual(result, [[{'msg': 1}, {'msg': 2}], [{'msg': 3}]])
+
+    def test_append(self):
+        self.assertFalse(self.spool.is_active())
+
+        self.spool.append([{'msg': 1}, {'msg': 2}])
+        self.spool.append({'msg': 3})
+
+        self.assertTrue(self.spool.is_active())
+        with open(self.path) as file:
+            self.assertEqual(file.read(), '{"msg": 1}\n{"msg": 2}\n{"msg": 3}\n')
+
+    def test_exec(self):
+        func = mock.MagicMock()
+        is_connected = mock.MagicMock(return_value=True)
+
+        result = self.spool.exec(func, [{'msg': 1}], is_connected)
+        self.assertEqual(result, func.return_value)
+        func.assert_called_with([{'msg': 1}])
+        self.assertFalse(self.spool.is_active())
+
+    def test_exec_fails(self):
+        func = mock.MagicMock(side_effect=Exception)
+        is_connected = mock.MagicMock(return_value=True)
+
+        # Raise when the failure is not caused by a connection problem
+        with self.assertRaises(Exception):
+            self.spool.exec(func, [{'msg': 1}], is_connected)
+        self.assertFalse(self.spool.is_active())
+
+        # Spool when the connection is lost
+        is_connected.return_value = False
+        result = self.spool.exec(func, [{'msg': 1}], is_connected)
+        self.assertIsNone(result)
+        self.assertTrue(self.spool.is_active())
+
+        # Once active, messages are spooled without trying to store them
+        func.reset_mock()
+        self.spool.exec(func, {'msg': 2}, is_connected)
+        func.assert_not_called()
+        with open(self.path) as file:
+            self.assertEqual(file.read(), '{"msg": 1}\n{"msg": 2}\n')
+
+    def test_replay(self):
+        save = mock.MagicMock()
+        self.assertEqual(self.spool.replay(save, 2), 0)
+        save.assert_not_called()
+
+        self.spool.append([{'msg': 1}, {'msg': 2}, {'msg': 3}])
+        self.assertEqual(self.spool.replay(save, 2), 3)
+        save.assert_has_calls([mock.call([{'msg': 1}, {'msg': 2}]), mock.call([{'msg': 3}])])
+        self.assertFalse(self.spool.is_active())
+        self.assertFalse(os.path.exists(self.spool.replay_path))
+
+    def test_replay_fails(self):
+        save = mock.MagicMock(side_effect=Exception)
+        self.spool.append([{'msg': 1}])
+
+        with self.assertRaises(Exception):
+            self.spool.replay(save, 2)
+        # New messages are no longer spooled, the failed replay is kept
+        self.assertFalse(self.spool.is_active())
+        self.assertTrue(os.path.exists(self.spool.replay_path))
+
+        # The failed replay is replayed first
+        self.spool.append([{'msg': 2}])
+        save = mock.MagicMock()
+        self.assertEqual(self.spool.replay(save, 2), 1)
+        save.assert_called_once_with([{'msg': 1}])
+        self.assertEqual(self.spool.replay(save, 2), 1)
+        save.assert_called_with([{'msg': 2}])
+
+    def test_spool_wrapper(self):
+        spool = mock.MagicMock()
+        is_connected = mock.MagicMock()
+
+        def save(msgs):
+            return msgs
+
+        wrapped = spool_wrapper(spool, is_connected)(save)
+        self.assertEqual(wrapped.__name__, 'save')
+
+        result = wrapped(['any msg'])
+        self.assertEqual(result, spool.exec.return_value)
+        spool.exec.assert_called_with(save, ['any msg'], is_connected)
+
+    def test_lock_spool_dir(self):
+        path = os.path.join(self.tmp_dir.name, "instance")
+        lock = lock_spool_dir(path)
+        self.assertTrue(os.path.isdir(path))
+
+        # The directory cannot be locked by others while the lock is held
+        self.assertIsNone(_lock(path, blocking=False))
+        lock.close()
+        other = _lock(path, blocking=False)
+        self.assertIsNotNone(other)
+        other.close()
+
+    def test_replay_orphaned_spool_dirs(self):
+        root = self.tmp_dir.name
+        own, running, stopped = [os.path.join(root, name) for name in ["own", "running", "stopped"]]
+        own_lock = lock_spool_dir(own)
+        running_lock = lock_spool_dir(running)
+        os.makedirs(stopped)
+        open(os.path.join(root, "not a directory"), 'w').close()
+        replay = mock.MagicMock()
+
+        # Only the directory of the stopped instance is replayed and removed
+        replay_orphaned_spool_dirs(root, own, replay)
+        replay.assert_called_once_with(stopped)
+        self.assertFalse(os.path.exists(stopped))
+        self.assertTrue(os.path.exists(running))
+
+        # The directory is kept when replay fails, it can be claimed again
+        os.makedirs(stopped)
+        replay.side_effect = Exception
+        with self.assertRaises(Exception):
+            replay_orphaned_spool_dirs(root, own, replay)
+        self.assertTrue(os.path.exists(stopped))
+        lock = _lock(stopped, blocking=False)
+        self.assertIsNotNone(lock)
+
+        for file in [lock, own_lock, running_lock]:
+            file.close()
+
+        # Nothing has been spooled yet
+        replay.reset_mock()
+        replay_orphaned_spool_dirs(os.path.join(root, "missing"), own, replay)
+        replay.assert_not_called()
@@ -1,27 +1,23 @@
 from unittest import TestCase, mock
 
 import datetime
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.exc import DBAPIError
 
-from gobcore.model.sa.management import Job, JobStep, Task
+from gobcore.exceptions import GOBException
+from gobcore.model.sa.management import Job, JobStep, Task, Log
 
 import gobworkflow.storage
 
-from gobworkflow.storage.storage import connect, migrate_storage, disconnect, is_connected
-from gobworkflow.storage.storage import save_log, get_services, remove_service, mark_service_dead, update_service, \
-    _update_servicetasks, save_audit_log
+from gobworkflow.storage.storage import connect, migrate_storage, disconnect, is_connected, end_session, \
+    session_scope
+from gobworkflow.storage.storage import sweep_services, refresh_services, update_service, update_services, _save_service, \
+    _sync_servicetasks, _service_transitions, _log_values, _audit_log_values, log_to_json, _column_values, \
+    _insert, _log_level_counts, update_log_counts, get_log_counts
 from gobworkflow.storage.storage import job_save, job_update, step_save, step_update, get_job_step, job_runs, job_get
-from gobworkflow.storage.storage import task_get, task_save, task_update, task_lock, task_unlock, get_tasks_for_stepid
-
-class MockedService:
-
-    service_id = None
-    id = None
-    host = None
-    name = None
-
-    def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
+from gobworkflow.storage.storage import task_get, tasks_save, tasks_claim, task_end, get_tasks_for_stepid, \
+    get_task_counts, _count_ended_tasks, get_task_durations, count_queued_tasks, get_queued_tasks, tasks_requeue, \
+    tasks_unpublished, tasks_claim_unpublished, get_ready_tasks, tasks_wait, tasks_claim_waiting, get_next_waiting_step
 
 class MockedSession:
 
@@ -109,12 +105,52 @@ class TestStorage(TestCase):
         gobworkflow.storage.storage.engine = MockedEngine()
         gobworkflow.storage.storage.session = MockedSession()
 
-    def test_update_service(self):
-        mockedSession = MockedSession()
-        gobworkflow.storage.storage.session = mockedSession
-        gobworkflow.storage.storage.Service = MockedService
-        gobworkflow.storage.storage.ServiceTask = MockedService
-
+    @mock.patch("gobworkflow.storage.storage._service_transitions", mock.MagicMock(return_value=[]))
+    @mock.patch("gobworkflow.storage.storage._sync_servicetasks")
+    @mock.patch("gobworkflow.storage.storage._save_service")
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_update_service(self, mock_engine, mock_save_service, mock_sync_servicetasks):
+        mock_save_service.return_value = 1, True
+        mock_sync_servicetasks.return_value = [], []
+        update_service({"name": "AnyService"}, [{"name": "AnyTask"}])
+
+        # The service and its tasks are updated in one transaction
+        connection = mock_engine.begin.return_value.__enter__.return_value
+        mock_engine.begin.assert_called_once()
+        mock_save_service.assert_called_with(connection, {"name": "AnyService"})
+        mock_sync_servicetasks.assert_called_with(connection, 1, [{"name": "AnyTask"}])
+        # No transitions
+        self.assertEqual(connection.execute.call_count, 0)
+
+    @mock.patch("gobworkflow.storage.storage._service_transitions")
+    @mock.patch("gobworkflow.storage.storage._sync_servicetasks")
+    @mock.patch("gobworkflow.storage.storage._save_service")
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_update_services(self, mock_engine, mock_save_service, mock_sync_servicetasks, mock_transitions):
+        mock_save_service.side_effect = [(1, None), (2, True)]
+        mock_sync_servicetasks.side_effect = [([], []), (["AnyTask"], [])]
+        mock_transitions.side_effect = [[{"event": "up"}], [{"event": "thread started"}]]
+        update_services([({"name": "AnyService"}, []), ({"name": "OtherService"}, [{"name": "AnyTask"}])])
+
+        # All services are updated in one transaction
+        connection = mock_engine.begin.return_value.__enter__.return_value
+        mock_engine.begin.assert_called_once()
+        mock_save_service.assert_has_calls([mock.call(connection, {"name": "AnyService"}),
+                                            mock.call(connection, {"name": "OtherService"})])
+        mock_sync_servicetasks.assert_has_calls([mock.call(connection, 1, []),
+                                                 mock.call(connection, 2, [{"name": "AnyTask"}])])
+        mock_transitions.assert_has_calls([mock.call({"name": "AnyService"}, None, [], []),
+                                           mock.call({"name": "OtherService"}, True, ["AnyTask"], [])])
+
+        # The transitions are recorded with one statement
+        connection.execute.assert_called_once()
+        statement = connection.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+        self.assertIn("INSERT INTO service_transitions", str(statement))
+        self.assertEqual(statement.params["event_m0"], "up")
+        self.assertEqual(statement.params["event_m1"], "thread started")
+
+    def test_save_service(self):
+        connection = mock.MagicMock()
         service = {
             "name": "AnyService",
             "host": "AnyHost",
@@ -123,15 +159,22 @@ class TestStorage(TestCase):
             "timestamp": "timestamp"
         }
 
-        # If the service is not found, it should be added
-        mockedSession._first = None
-        update_service(service, [])
-        self.assertEqual(mockedSession._add.name, "AnyService")
-
         # If the service is found, it should be updated
-        mockedSession._first = MockedService(**{"name": "AnyService", "is_alive": None, "timestamp": None})
-        update_service(service, [])
-        self.assertEqual(mockedSession._first.is_alive, service["is_alive"])
+        connection.execute.return_value.first.return_value = (1, False)
+        self.assertEqual(_save_service(connection, service), (1, False))
+        self.assertEqual(connection.execute.call_count, 1)
+        statement = str(connection.execute.call_args[0][0].compile(dialect=postgresql.dialect()))
+        self.assertIn("UPDATE services", statement)
+        self.assertIn("FOR UPDATE) AS previous", statement)
+        self.assertIn("RETURNING services.id, previous.is_alive", statement)
+
+        # If the service is not found, it should be added
+        connection.execute.reset_mock()
+        connection.execute.return_value.first.return_value = None
+        connection.execute.return_value.scalar.return_value = 2
+        self.assertEqual(_save_service(connection, service), (2, None))
+        self.assertEqual(connection.execute.call_count, 2)
+        self.assertIn("INSERT INTO services", str(connection.execute.call_args[0][0].compile(dialect=postgresql.dialect())))
 
     @mock.patch("gobworkflow.storage.storage.migrate_storage")
     @mock.patch("gobworkflow.storage.storage.create_engine")
@@ -196,31 +239,125 @@ class TestStorage(TestCase):
         with self.assertRaises(MockException):
             disconnect()
 
+    def test_end_session(self):
+        mock_session = mock.MagicMock()
+        gobworkflow.storage.storage.session = mock_session
+        end_session()
+        mock_session.remove.assert_called_once()
+
+        # No session, no action
+        gobworkflow.storage.storage.session = None
+        end_session()
+
+    @mock.patch("gobworkflow.storage.storage.end_session")
+    def test_session_scope(self, mock_end_session):
+        func = session_scope(lambda x: x * 2)
+        self.assertEqual(func(2), 4)
+        mock_end_session.assert_called_once()
+
+        # Also end the session on failure
+        mock_end_session.reset_mock()
+        func = session_scope(lambda: raise_exception(MockException))
+        with self.assertRaises(MockException):
+            func()
+        mock_end_session.assert_called_once()
+
     def test_is_connected_not_ok(self):
         result = is_connected()
         self.assertEqual(result, False)
 
-    @mock.patch("gobworkflow.storage.storage.session.execute", mock.MagicMock())
-    def test_is_connected_ok(self):
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_is_connected_ok(self, mock_engine):
         result = is_connected()
         self.assertEqual(result, True)
+        connection = mock_engine.connect.return_value.__enter__.return_value
+        connection.execute.assert_called_with("SELECT 1")
 
-    @mock.patch("gobworkflow.storage.storage.session.add")
-    @mock.patch("gobworkflow.storage.storage.session.commit")
-    def test_save_log(self, mock_commit, mock_add):
+    def test_log_values(self):
         msg = {
-            "timestamp": "2020-06-20T12:20:20.000"
+            "timestamp": "2020-06-20T12:20:20.000",
+            "id": "any id"
         }
 
-        save_log(msg)
-
-        mock_add.assert_called_with(mock.ANY)
-        mock_commit.assert_called_with()
+        values = _log_values(msg)
+        self.assertEqual(values['timestamp'], datetime.datetime(2020, 6, 20, 12, 20, 20))
+        self.assertEqual(values['msgid'], "any id")
+
+    def test_log_to_json(self):
+        row = {'logid': 1, 'timestamp': datetime.datetime(2020, 6, 20, 12, 20, 20), 'data': '{}'}
+        self.assertEqual(log_to_json(row), '{"logid": 1, "timestamp": "2020-06-20T12:20:20", "data": "{}"}')
+
+        row = {'logid': 1, 'timestamp': None}
+        self.assertEqual(log_to_json(row), '{"logid": 1, "timestamp": null}')
+
+        # Archived logs have already been converted
+        row = {'logid': 1, 'timestamp': '2020-06-20T12:20:20'}
+        self.assertEqual(log_to_json(row), '{"logid": 1, "timestamp": "2020-06-20T12:20:20"}')
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_insert(self, mock_engine):
+        connection = mock_engine.begin.return_value.__enter__.return_value
+        connection.execute.return_value.scalar.return_value = 123
+
+        result = _insert(Log, {"msgid": "any id"})
+        self.assertEqual(result, 123)
+        connection.execute.assert_called_once()
+
+        on_insert = mock.MagicMock()
+        _insert(Log, {"msgid": "any id"}, on_insert=on_insert)
+        on_insert.assert_called_with(connection, [{"id": "any id"}])
+
+    def test_log_level_counts(self):
+        rows = [
+            {"jobid": 1, "stepid": 2, "level": "ERROR"},
+            {"jobid": 1, "stepid": 2, "level": "ERROR"},
+            {"jobid": 1, "stepid": 2, "level": "INFO"},
+            {"jobid": 1, "stepid": 3, "level": "ERROR"},
+            {"jobid": 1, "stepid": None, "level": "ERROR"},
+            {"level": "ERROR"},
+        ]
+        result = _log_level_counts(rows)
+        self.assertEqual(result, {(1, 2, "ERROR"): 2, (1, 2, "INFO"): 1, (1, 3, "ERROR"): 1})
+
+    def test_update_log_counts(self):
+        connection = mock.MagicMock()
+        update_log_counts(connection, [{"level": "ERROR"}])
+        connection.execute.assert_not_called()
+
+        update_log_counts(connection, [
+            {"jobid": 1, "stepid": 3, "level": "ERROR"},
+            {"jobid": 1, "stepid": 2, "level": "ERROR"},
+            {"jobid": 1, "stepid": 2, "level": "ERROR"},
+        ])
+        # All counts are upserted with one statement, in key order
+        connection.execute.assert_called_once()
+        statement = connection.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+        self.assertIn("ON CONFLICT (jobid, stepid, level) DO UPDATE", str(statement))
+        self.assertEqual(statement.params['stepid_m0'], 2)
+        self.assertEqual(statement.params['count_m0'], 2)
+        self.assertEqual(statement.params['stepid_m1'], 3)
+        self.assertEqual(statement.params['count_m1'], 1)
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_get_log_counts(self, mock_engine):
+        connection = mock_engine.connect.return_value.__enter__.return_value
+        connection.execute.return_value = [("ERROR", 2), ("INFO", 5)]
+
+        result = get_log_counts(1)
+        self.assertEqual(result, {"ERROR": 2, "INFO": 5})
+        query = connection.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+        self.assertNotIn("log_counts.stepid =", str(query))
+
+        get_log_counts(1, 2)
+        query = connection.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+        self.assertIn("log_counts.stepid =", str(query))
+
+    def test_column_values(self):
+        result = _column_values(Log, {"msgid": "any id", "msg": "any msg"})
+        self.assertEqual(result, {"id": "any id", "msg": "any msg"})
 
-    @mock.patch("gobworkflow.storage.storage.session")
     @mock.patch("gobworkflow.storage.storage.datetime.datetime")
-    @mock.patch("gobworkflow.storage.storage.AuditLog")
-    def test_save_audit_log(self, mock_audit_log, mock_datetime, mock_session):
+    def test_audit_log_values(self, mock_datetime):
         msg = {
             'timestamp': 'the timestamp',
             'source': 'the source',
@@ -230,83 +367,128 @@ class TestStorage(TestCase):
             'request_uuid': 'the uuid',
         }
 
-        save_audit_log(msg)
-
-        mock_audit_log.assert_called_with(
-            timestamp=mock_datetime.strptime.return_value,
-            source='the source',
-            destination='the destination',
-            type='the type',
-            data='the data',
-            request_uuid='the uuid',
-        )
-
-        mock_session.add.assert_called_with(mock_audit_log.return_value)
-        mock_session.commit_assert_called_once()
-
+        result = _audit_log_values(msg)
+        self.assertEqual(result, {
+            'timestamp': mock_datetime.strptime.return_value,
+            'source': 'the source',
+            'destination': 'the destination',
+            'type': 'the type',
+            'data': 'the data',
+            'request_uuid': 'the uuid',
+        })
 
-    def test_update_servicetasks(self):
-        gobworkflow.storage.storage.Service = MockedService
-        gobworkflow.storage.storage.ServiceTask = MockedService
+    def test_sync_servicetasks(self):
+        connection = mock.MagicMock()
 
-        mockedSession = MockedSession()
-        gobworkflow.storage.storage.session = mockedSession
         # No action on empty lists
-        _update_servicetasks(MockedService(), tasks=[])
-        self.assertEqual(mockedSession._add, None)
-        self.assertEqual(mockedSession._delete, None)
-
-        mockedSession = MockedSession()
-        gobworkflow.storage.storage.session = mockedSession
-        # add task when not yet exists
-        _update_servicetasks(MockedService(), tasks=[{"name": "AnyTask"}])
-        self.assertEqual(mockedSession._add.name, "AnyTask")
-
-        mockedSession = MockedSession()
-        gobworkflow.storage.storage.session = mockedSession
-        # delete task when it no longer exists
-        _update_servicetasks(MockedService(), tasks=[])
-        self.assertEqual(mockedSession._delete, None)
-
-        mockedSession = MockedSession()
-        gobworkflow.storage.storage.session = mockedSession
-        mocked_task = MockedService(**{"name": "AnyTask", "is_alive": None})
-        other_task = MockedService(**{"name": "AnyTask2", "is_alive": None})
-        # update task
-        mockedSession._all = [mocked_task, other_task]
-        _update_servicetasks(MockedService(), tasks=[{"name": "AnyTask", "is_alive": True}])
-        self.assertEqual(mocked_task.is_alive, True)
-
-    def test_get_services(self):
-        mockedSession = MockedSession()
-        gobworkflow.storage.storage.session = mockedSession
-        services = get_services()
-        self.assertEqual(services, [])
-
-    @mock.patch("gobworkflow.storage.storage._update_servicetasks")
-    def test_mark_as_dead(self, mock_update_servicetasks):
-        mockedSession = MockedSession()
-        gobworkflow.storage.storage.session = mockedSession
-
-        mockedService = MockedService()
-        mark_service_dead(mockedService)
-
-        self.assertEqual(mockedService.is_alive, False)
-        mock_update_servicetasks.assert_called_with(mockedService, [])
-
-    def test_remove_service(self):
-        mockedSession = MockedSession()
-        gobworkflow.storage.storage.session = mockedSession
-
-        mockedService = MockedService()
-        remove_service(mockedService)
-
-        self.assertEqual(mockedSession._delete, None)
-
-    def test_job_save(self):
+        connection.execute.return_value.fetchall.return_value = []
+        self.assertEqual(_sync_servicetasks(connection, 1, []), ([], []))
+        self.assertEqual(connection.execute.call_count, 1)
+
+        # No action on unchanged tasks
+        connection.execute.reset_mock()
+        connection.execute.return_value.fetchall.return_value = [("AnyTask", True)]
+        tasks = [{"service_name": "AnyService", "name": "AnyTask", "is_alive": True}]
+        self.assertEqual(_sync_servicetasks(connection, 1, tasks), ([], []))
+        self.assertEqual(connection.execute.call_count, 1)
+
+        # Upsert new and changed tasks, delete ended tasks
+        connection.execute.reset_mock()
+        connection.execute.return_value.fetchall.return_value = [("AnyTask", True), ("OtherTask", True),
+                                                                 ("EndedTask", True), ("DeadTask", False)]
+        result = _sync_servicetasks(connection, 1, [
+            {"service_name": "AnyService", "name": "AnyTask", "is_alive": True},
+            {"service_name": "AnyService", "name": "OtherTask", "is_alive": False},
+            {"service_name": "AnyService", "name": "NewTask", "is_alive": True},
+        ])
+        self.assertEqual(result, (["NewTask"], ["OtherTask", "EndedTask"]))
+        self.assertEqual(connection.execute.call_count, 3)
+        _, upsert, delete = connection.execute.call_args_list
+
+        upsert = upsert[0][0].compile(dialect=postgresql.dialect())
+        self.assertIn("ON CONFLICT (service_id, name) DO UPDATE", str(upsert))
+        self.assertEqual(sorted(value for key, value in upsert.params.items() if key.startswith("name_")),
+                         ["NewTask", "OtherTask"])
+
+        delete = delete[0][0].compile(dialect=postgresql.dialect())
+        self.assertIn("DELETE FROM service_tasks", str(delete))
+        self.assertIn("EndedTask", str(delete.params))
+        self.assertIn("DeadTask", str(delete.params))
+        self.assertNotIn("AnyTask", str(delete.params))
+
+    def test_service_transitions(self):
+        service = {"name": "AnyService", "host": "any host", "is_alive": True, "timestamp": "any timestamp"}
+
+        def events(*args):
+            return [(transition["event"], transition["task"]) for transition in _service_transitions(*args)]
+
+        for transition in _service_transitions(service, None, [], []):
+            self.assertEqual(transition, {"timestamp": "any timestamp", "name": "AnyService", "host": "any host",
+                                          "event": "up", "task": None})
+
+        self.assertEqual(events(service, None, ["thread1"], []), [("up", None), ("thread started", "thread1")])
+        self.assertEqual(events(service, False, [], []), [("up", None)])
+        self.assertEqual(events(service, True, [], []), [])
+        self.assertEqual(events(service, True, ["thread2", "thread1"], ["thread3"]),
+                         [("thread started", "thread1"), ("thread started", "thread2"), ("thread stopped", "thread3")])
+
+        # The tasks of a service that is down are not reported
+        service["is_alive"] = False
+        self.assertEqual(events(service, True, [], ["thread1"]), [("down", None)])
+        self.assertEqual(events(service, False, [], []), [])
+        self.assertEqual(events(service, None, [], []), [])
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_refresh_services(self, mock_engine):
+        connection = mock_engine.begin.return_value.__enter__.return_value
+        connection.execute.return_value = [("AnyService", "any host")]
+        heartbeats = [
+            ("AnyService", "any host", True, datetime.datetime(2020, 6, 20, 12, 20, 20)),
+            ("OtherService", None, False, datetime.datetime(2020, 6, 20, 12, 20, 21)),
+        ]
+
+        # Only the services that are stored with the same liveness are refreshed
+        self.assertEqual(refresh_services(heartbeats), {("AnyService", "any host")})
+        connection.execute.assert_called_once()
+        statement, params = connection.execute.call_args
+        self.assertIn("services.is_alive = heartbeats.is_alive", str(statement[0]))
+        self.assertEqual(params, {
+            'names': ["AnyService", "OtherService"],
+            'hosts': ["any host", None],
+            'alive': [True, False],
+            'timestamps': [datetime.datetime(2020, 6, 20, 12, 20, 20), datetime.datetime(2020, 6, 20, 12, 20, 21)]
+        })
+
+        # Nothing to refresh
+        mock_engine.begin.reset_mock()
+        self.assertEqual(refresh_services([]), set())
+        mock_engine.begin.assert_not_called()
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_sweep_services(self, mock_engine):
+        connection = mock_engine.begin.return_value.__enter__.return_value
+        connection.execute.side_effect = [
+            [("RemovedService", "any host")],
+            [("DeadService", None)],
+        ]
+
+        result = sweep_services('dead before', 'remove before')
+        self.assertEqual(result, ([("DeadService", None)], [("RemovedService", "any host")]))
+
+        # Remove and mark dead with one statement each, in one transaction
+        mock_engine.begin.assert_called_once()
+        self.assertEqual(connection.execute.call_count, 2)
+        remove, dead = connection.execute.call_args_list
+        self.assertIn("DELETE FROM services", str(remove[0][0]))
+        self.assertEqual(remove[1], {'remove_before': 'remove before', 'event': 'removed'})
+        self.assertIn("SET    is_alive = FALSE", str(dead[0][0]))
+        self.assertEqual(dead[1], {'dead_before': 'dead before', 'event': 'down'})
+
+    @mock.patch("gobworkflow.storage.storage._insert")
+    def test_job_save(self, mock_insert):
         result = job_save({"name": "any name"})
-        self.assertIsInstance(result, Job)
-        self.assertEqual(result.name, "any name")
+        mock_insert.assert_called_with(Job, {"name": "any name"})
+        self.assertEqual(result, mock_insert.return_value)
 
     def test_job_update(self):
         mockedSession = MockedSession()
@@ -321,10 +503,11 @@ class TestStorage(TestCase):
         result = job_get('someid')
         self.assertEqual('someid', result)
 
-    def test_step_save(self):
+    @mock.patch("gobworkflow.storage.storage._insert")
+    def test_step_save(self, mock_insert):
         result = step_save({"name": "any name"})
-        self.assertIsInstance(result, JobStep)
-        self.assertEqual(result.name, "any name")
+        mock_insert.assert_called_with(JobStep, {"name": "any name"})
+        self.assertEqual(result, mock_insert.return_value)
 
     def test_step_update(self):
         mockedSession = MockedSession()
@@ -346,41 +529,325 @@ class TestStorage(TestCase):
         result = task_get('someid')
         self.assertEqual('someid', result)
 
-    def test_task_save(self):
-        result = task_save({"name": "any name"})
-        self.assertIsInstance(result, Task)
-        self.assertEqual(result.name, "any name")
+    @mock.patch("gobworkflow.storage.storage.TASK_INSERT_BATCH_SIZE", 2)
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_tasks_save(self, mock_engine):
+        connection = mock_engine.begin.return_value.__enter__.return_value
+        connection.execute.return_value.first.return_value = None
+        connection.execute.side_effect = [
+            None,
+            connection.execute.return_value,
+            [(2, "task b"), (1, "task a")],
+            None,
+            [(3, "task c")],
+            None,
+            None,
+        ]
+        tasks = [{"name": name, "status": "new"} for name in ["task a", "task b", "task c"]]
+
+        result = tasks_save(123, tasks, {"task a": 0, "task b": 1, "task c": 2})
+        self.assertEqual(result, [1, 2, 3])
+
+        # Lock the step, check for existing tasks and insert the tasks with their scheduling data in batches,
+        # in one transaction
+        mock_engine.begin.assert_called_once()
+        lock, existing, batch1, scheduling1, batch2, scheduling2, counts = \
+            [args[0][0] for args in connection.execute.call_args_list]
+        self.assertIn("FOR UPDATE", str(lock.compile(dialect=postgresql.dialect())))
+        self.assertIn("tasks.stepid =", str(existing.compile(dialect=postgresql.dialect())))
+        self.assertEqual(batch1.compile(dialect=postgresql.dialect()).params, {
+            'name_m0': 'task a', 'status_m0': 'new', 'stepid_m0': 123,
+            'name_m1': 'task b', 'status_m1': 'new', 'stepid_m1': 123,
+        })
+        self.assertIn("RETURNING tasks.id, tasks.name", str(batch2.compile(dialect=postgresql.dialect())))
+        self.assertEqual(scheduling1.compile(dialect=postgresql.dialect()).params, {
+            'taskid_m0': 2, 'level_m0': 1, 'taskid_m1': 1, 'level_m1': 0,
+        })
+        self.assertEqual(scheduling2.compile(dialect=postgresql.dialect()).params, {'taskid_m0': 3, 'level_m0': 2})
+        self.assertEqual(counts.compile(dialect=postgresql.dialect()).params['stepid'], 123)
+        self.assertEqual(counts.compile(dialect=postgresql.dialect()).params['total'], 3)
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_tasks_save_existing(self, mock_engine):
+        connection = mock_engine.begin.return_value.__enter__.return_value
+        connection.execute.return_value.first.return_value = (1,)
+
+        with self.assertRaisesRegex(GOBException, "Already have tasks for jobstep 123"):
+            tasks_save(123, [{"name": "task a"}], {"task a": 0})
+        self.assertEqual(connection.execute.call_count, 2)
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_tasks_claim(self, mock_engine):
+        connection = mock_engine.begin.return_value.__enter__.return_value
+
+        result = tasks_claim(123, [1, 2], "new", {"status": "queued", "start": "now"})
+        self.assertEqual(result, connection.execute.return_value.fetchall.return_value)
+
+        # Select, update and return the tasks in one statement
+        connection.execute.assert_called_once()
+        statement = connection.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+        self.assertIn("FOR UPDATE SKIP LOCKED", str(statement))
+        self.assertIn("tasks.lock IS NULL", str(statement))
+        self.assertIn("RETURNING tasks.id", str(statement))
+        self.assertEqual(statement.params['status'], "queued")
+        self.assertEqual(statement.params['start'], "now")
+
+        # Nothing to claim
+        mock_engine.begin.reset_mock()
+        self.assertEqual(tasks_claim(123, [], "new", {"status": "queued"}), [])
+        mock_engine.begin.assert_not_called()
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_tasks_claim_ended(self, mock_engine):
+        connection = mock_engine.begin.return_value.__enter__.return_value
+        connection.execute.return_value.fetchall.return_value = [mock.MagicMock(id=1), mock.MagicMock(id=2)]
+
+        # Claim all new tasks of the step, remove them from the waiting tasks and count them as aborted
+        tasks_claim(123, None, "new", {"status": "aborted"})
+        claim, waiting, count = [args[0][0] for args in connection.execute.call_args_list]
+        self.assertNotIn("tasks.id IN (", str(claim.compile(dialect=postgresql.dialect())).split("SELECT")[1])
+        statement = waiting.compile(dialect=postgresql.dialect())
+        self.assertIn("DELETE FROM waiting_tasks", str(statement))
+        self.assertEqual(statement.params, {'taskid_1': 1, 'taskid_2': 2})
+        statement = count.compile(dialect=postgresql.dialect())
+        self.assertIn("SET aborted=(task_counts.aborted +", str(statement))
+        self.assertEqual(statement.params, {'aborted_1': 2, 'stepid_1': 123})
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_task_end(self, mock_engine):
+        connection = mock_engine.begin.return_value.__enter__.return_value
+        connection.execute.return_value.first.side_effect = [mock.MagicMock(stepid=123, start=None),
+                                                             {'total': 2, 'completed': 1}]
+
+        result = task_end({"id": 1, "status": "completed"})
+        self.assertEqual(result, {'total': 2, 'completed': 1})
+
+        end, count = [args[0][0] for args in connection.execute.call_args_list]
+        self.assertIn("tasks.status NOT IN", str(end.compile(dialect=postgresql.dialect())))
+        self.assertIn("SET completed=(task_counts.completed +", str(count.compile(dialect=postgresql.dialect())))
+        mock_engine.begin.assert_called_once()
+
+        # The task has already ended
+        connection.execute.reset_mock()
+        connection.execute.return_value.first.side_effect = [None]
+        self.assertIsNone(task_end({"id": 1, "status": "completed"}))
+        connection.execute.assert_called_once()
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_task_end_duration(self, mock_engine):
+        connection = mock_engine.begin.return_value.__enter__.return_value
+        start = datetime.datetime(2020, 1, 1, 12, 0, 0)
+        row = mock.MagicMock(stepid=123, key_prefix='prefix', start=start, end=start + datetime.timedelta(seconds=30))
+        row.name = 'task'
+        connection.execute.return_value.first.side_effect = [row, {'total': 2, 'completed': 1}]
+
+        task_end({"id": 1, "status": "completed"})
+
+        end, duration, count = [args[0][0] for args in connection.execute.call_args_list]
+        statement = duration.compile(dialect=postgresql.dialect())
+        self.assertIn("INSERT INTO task_durations", str(statement))
+        self.assertIn("ON CONFLICT (key_prefix, name) DO UPDATE", str(statement))
+        self.assertEqual(statement.params['duration'], 30)
+        self.assertEqual(statement.params['name'], 'task')
+
+        # Only completed tasks are timed
+        connection.execute.reset_mock()
+        connection.execute.return_value.first.side_effect = [row, {'total': 2, 'failed': 1}]
+        task_end({"id": 1, "status": "failed"})
+        self.assertEqual(connection.execute.call_count, 2)
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_get_task_durations(self, mock_engine):
+        connection = mock_engine.connect.return_value.__enter__.return_value
+        connection.execute.return_value = [('a', 1.5), ('b', 3.0)]
+        self.assertEqual(get_task_durations('prefix'), {'a': 1.5, 'b': 3.0})
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_get_ready_tasks(self, mock_engine):
+        connection = mock_engine.connect.return_value.__enter__.return_value
+        connection.execute.return_value = [(1, 'a'), (2, 'b')]
+        self.assertEqual(get_ready_tasks(123), [(1, 'a'), (2, 'b')])
+
+        # New and unlocked tasks without any uncompleted dependency
+        query = connection.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+        self.assertIn("NOT (EXISTS (SELECT *", str(query))
+        self.assertIn("dependency.name = ANY (tasks.dependencies)", str(query))
+        self.assertIn("tasks.lock IS NULL", str(query))
+        self.assertNotIn("tasks.name IN", str(query))
+        self.assertEqual(query.params['stepid_1'], 123)
+        self.assertIn('completed', query.params.values())
+        self.assertIn('new', query.params.values())
+
+        # Only check the given tasks
+        get_ready_tasks(123, ['a'])
+        query = connection.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+        self.assertIn("tasks.name IN", str(query))
+
+        # No tasks to check
+        mock_engine.connect.reset_mock()
+        self.assertEqual(get_ready_tasks(123, []), [])
+        mock_engine.connect.assert_not_called()
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_tasks_wait(self, mock_engine):
+        connection = mock_engine.begin.return_value.__enter__.return_value
+        tasks_wait(123, 'prefix', [(1, 4.0, 9), (2, 3.0, 7)])
+
+        statement = connection.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+        self.assertIn("INSERT INTO waiting_tasks", str(statement))
+        self.assertIn("ON CONFLICT (taskid) DO NOTHING", str(statement))
+        self.assertEqual(statement.params['taskid_m1'], 2)
+        self.assertEqual(statement.params['path_m1'], 3.0)
+        self.assertEqual(statement.params['priority_m1'], 7)
+        self.assertEqual(statement.params['key_prefix_m0'], 'prefix')
+
+        # No ready tasks
+        mock_engine.begin.reset_mock()
+        tasks_wait(123, 'prefix', [])
+        mock_engine.begin.assert_not_called()
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_tasks_claim_waiting(self, mock_engine):
+        connection = mock_engine.begin.return_value.__enter__.return_value
+        result = tasks_claim_waiting(123, 2, {"status": "queued", "start": "now"})
+        self.assertEqual(result, connection.execute.return_value.fetchall.return_value)
+
+        # Remove the waiting tasks with the longest critical paths and claim them in one statement
+        connection.execute.assert_called_once()
+        statement = connection.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+        self.assertIn("WITH waiting AS \n(DELETE FROM waiting_tasks", str(statement))
+        self.assertIn("ORDER BY waiting_tasks.path DESC", str(statement))
+        self.assertIn("FOR UPDATE SKIP LOCKED", str(statement))
+        self.assertIn("tasks.lock IS NULL", str(statement))
+        self.assertIn("waiting.path, waiting.priority", str(statement))
+        self.assertEqual(statement.params['param_1'], 2)
+        self.assertEqual(statement.params['status'], "queued")
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_get_next_waiting_step(self, mock_engine):
+        connection = mock_engine.connect.return_value.__enter__.return_value
+        connection.execute.return_value.scalar.return_value = 2
+        self.assertEqual(get_next_waiting_step('prefix'), 2)
+
+        query = connection.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+        self.assertIn("SELECT min(waiting_tasks.stepid)", str(query))
+        self.assertNotIn("waiting_tasks.stepid >", str(query))
+
+        # The jobstep after the given jobstep
+        get_next_waiting_step('prefix', 2)
+        query = connection.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+        self.assertIn("waiting_tasks.stepid >", str(query))
+        self.assertEqual(query.params['stepid_1'], 2)
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_count_queued_tasks(self, mock_engine):
+        connection = mock_engine.connect.return_value.__enter__.return_value
+        connection.execute.return_value.first.return_value = (5, 2)
+        self.assertEqual(count_queued_tasks('prefix', 123), (5, 2))
+
+        query = str(connection.execute.call_args[0][0].compile(dialect=postgresql.dialect()))
+        self.assertIn("count(*) FILTER (WHERE tasks.stepid =", query)
+        self.assertIn("tasks.status =", query)
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_get_queued_tasks(self, mock_engine):
+        connection = mock_engine.connect.return_value.__enter__.return_value
+        connection.execute.return_value.fetchall.return_value = ['task']
+        self.assertEqual(get_queued_tasks('prefix', datetime.datetime(2020, 1, 1)), ['task'])
+
+        query = str(connection.execute.call_args[0][0].compile(dialect=postgresql.dialect()))
+        self.assertIn("tasks.status =", query)
+        self.assertIn("tasks.start <", query)
+        self.assertIn("task_scheduling.retries", query.split("FROM")[0])
+        self.assertIn("JOIN task_scheduling ON task_scheduling.taskid = tasks.id", query)
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_tasks_requeue(self, mock_engine):
+        connection = mock_engine.begin.return_value.__enter__.return_value
+        connection.execute.return_value.fetchall.return_value = ['task']
+
+        self.assertEqual(tasks_requeue([(1, 0), (2, 1)], datetime.datetime(2020, 1, 1)), ['task'])
+        statement = connection.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+        # The retries are incremented and the start is reset in one statement
+        self.assertIn("UPDATE task_scheduling SET retries=(task_scheduling.retries +", str(statement))
+        self.assertIn("(task_scheduling.taskid, task_scheduling.retries) IN", str(statement))
+        self.assertIn("UPDATE tasks SET start=%(start)s FROM requeued", str(statement))
+        self.assertIn("RETURNING tasks.id", str(statement))
+        self.assertIn("requeued.retries", str(statement).split("RETURNING")[-1])
+        self.assertEqual(statement.params['start'], datetime.datetime(2020, 1, 1))
+
+        # Nothing to requeue
+        connection.execute.reset_mock()
+        self.assertEqual(tasks_requeue([], datetime.datetime(2020, 1, 1)), [])
+        connection.execute.assert_not_called()
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_tasks_unpublished(self, mock_engine):
+        connection = mock_engine.begin.return_value.__enter__.return_value
+
+        tasks_unpublished([1, 2])
+        statement = connection.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+        self.assertIn("SET start=%(start)s", str(statement))
+        self.assertIsNone(statement.params['start'])
+        self.assertIn("tasks.status = %(status_1)s AND tasks.id IN", str(statement))
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_tasks_claim_unpublished(self, mock_engine):
+        connection = mock_engine.begin.return_value.__enter__.return_value
+        connection.execute.return_value.fetchall.return_value = ['task']
+
+        self.assertEqual(tasks_claim_unpublished(datetime.datetime(2020, 1, 1)), ['task'])
+        statement = connection.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+        self.assertIn("tasks.start IS NULL FOR UPDATE SKIP LOCKED", str(statement))
+        self.assertEqual(statement.params['start'], datetime.datetime(2020, 1, 1))
+
+    @mock.patch("gobworkflow.storage.storage.TASK_SUMMARY_SAMPLE_SIZE", 3)
+    def test_count_ended_tasks_summary(self):
+        connection = mock.MagicMock()
+        connection.execute.return_value.first.return_value = {
+            'stepid': 123, 'total': 5, 'completed': 2, 'warnings': 4, 'errors': 1,
+            'warnings_sample': ['w1', 'w2'], 'errors_sample': ['e1'],
+        }
 
-    def test_task_update(self):
-        mockedSession = MockedSession()
-        gobworkflow.storage.storage.session = mockedSession
-        mockedSession.get = lambda id: Task()
+        result = _count_ended_tasks(connection, 123, 'completed', 1, {'warnings': ['w3', 'w4'], 'errors': []})
 
-        result = task_update({"id": 123})
-        self.assertIsInstance(result, Task)
-        self.assertEqual(result.id, 123)
+        count, sample = [args[0][0] for args in connection.execute.call_args_list]
+        statement = count.compile(dialect=postgresql.dialect())
+        self.assertIn("warnings=(task_counts.warnings +", str(statement))
+        self.assertNotIn("errors=", str(statement))
+        self.assertEqual(statement.params['warnings_1'], 2)
 
-    def test_task_lock(self):
-        mock_session = MockedSession()
-        gobworkflow.storage.storage.session = mock_session
+        # The warnings sample is completed up to the sample size
+        self.assertEqual(sample.compile(dialect=postgresql.dialect()).params['warnings_sample'], ['w1', 'w2', 'w3'])
+        self.assertEqual(result['warnings_sample'], ['w1', 'w2', 'w3'])
+        self.assertEqual(result['errors_sample'], ['e1'])
 
-        result = task_lock(Task())
-        self.assertTrue(result)
-        self.assertTrue(len(mock_session.update_args) == 1)
-        self.assertTrue(type(mock_session.update_args[0]['lock']) == int)
-
-    def test_task_lock_fail(self):
-        mock_session = MockedSession()
-        gobworkflow.storage.storage.session = mock_session
-        mock_session.update = lambda _: 0
-        result = task_lock(Task())
-        self.assertFalse(result)
-
-    def test_task_unlock(self):
-        mock_session = MockedSession()
-        gobworkflow.storage.storage.session = mock_session
-        task_unlock(Task())
-        self.assertEqual(({'lock': None},), mock_session.update_args)
+        # Full samples are not updated
+        connection.execute.reset_mock()
+        connection.execute.return_value.first.return_value = {
+            'warnings_sample': ['w1', 'w2', 'w3'], 'errors_sample': ['e1'],
+        }
+        _count_ended_tasks(connection, 123, 'completed', 1, {'warnings': ['w4']})
+        connection.execute.assert_called_once()
+
+        # Other statuses are not counted
+        connection.execute.reset_mock()
+        self.assertIsNone(_count_ended_tasks(connection, 123, 'queued', 1))
+        connection.execute.assert_not_called()
+
+        # Jobsteps without task counts are not counted
+        connection.execute.return_value.first.return_value = None
+        self.assertIsNone(_count_ended_tasks(connection, 123, 'completed', 1))
+        connection.execute.assert_called_once()
+
+    @mock.patch("gobworkflow.storage.storage.engine")
+    def test_get_task_counts(self, mock_engine):
+        connection = mock_engine.connect.return_value.__enter__.return_value
+        connection.execute.return_value.first.return_value = {'stepid': 123, 'total': 2}
+        self.assertEqual(get_task_counts(123), {'stepid': 123, 'total': 2})
+
+        connection.execute.return_value.first.return_value = None
+        self.assertIsNone(get_task_counts(123))
 
     def test_get_tasks_for_stepid(self):
         mock_session = MockedSession()
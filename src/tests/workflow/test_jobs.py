@@ -1,14 +1,10 @@
 import datetime
-from collections import namedtuple
 
 from unittest import TestCase, mock
 
 from gobcore.status.heartbeat import STATUS_START, STATUS_OK, STATUS_FAIL
 from gobworkflow.workflow.jobs import job_start, job_end, step_start, step_status
 
-Job = namedtuple("Job", ["id"])
-Step = namedtuple("Job", ["id"])
-
 
 class TestJobManagement(TestCase):
 
@@ -17,8 +13,11 @@ class TestJobManagement(TestCase):
 
     @mock.patch("gobworkflow.workflow.jobs.job_save")
     def test_job_start(self, job_save):
-        job_save.return_value = Job("any id")
-        job = job_start("any job", {"header": {"a": 1, "b": "string", "c": True}})
+        job_save.return_value = "any id"
+        msg = {"header": {"a": 1, "b": "string", "c": True}}
+        job = job_start("any job", msg)
+        self.assertEqual(job["id"], "any id")
+        self.assertEqual(msg["header"]["jobid"], "any id")
         self.assertEqual(job["name"], "any job.1.string.True")
         self.assertEqual(job["type"], "any job")
         self.assertEqual(job["args"], ["1", "string", "True"])
@@ -40,8 +39,11 @@ class TestJobManagement(TestCase):
 
     @mock.patch("gobworkflow.workflow.jobs.step_save")
     def test_step_start(self, step_save):
-        step_save.return_value = Step("any id")
-        step = step_start("any step", {})
+        step_save.return_value = "any id"
+        header = {}
+        step = step_start("any step", header)
+        self.assertEqual(step["id"], "any id")
+        self.assertEqual(header["stepid"], "any id")
         self.assertEqual(step["name"], "any step")
         self.assertIsNone(step["start"])
         self.assertIsNone(step["end"])